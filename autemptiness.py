@@ -12,6 +12,10 @@ import cssfile
 import cssautomaton
 from cssautomaton import CSSAutomaton, Tran, Arrow
 import stringcons
+import poscons
+import buildprofile
+import memocache
+import cssselect_parser
 
 # define specified id and class attribute names and namespaces
 # None is really default, but assuming we're just going to get CSS for HTML
@@ -35,10 +39,144 @@ _of_type_cons = set(["nth-of-type",
                      "last-of-type"])
 _emp_z3 = Solver()
 
+# if True, the position constraints decided with Z3 are each asserted once,
+# under a guard literal, into one solver kept until reset_z3_solver, and each
+# query is checked with the guards of its constraints as assumptions, so that
+# constraints and learned lemmas are shared between queries and checkers;
+# else _emp_z3 is pushed and popped around each query
+incremental_z3 = False
+
+# number of guarded constraints after which the incremental solver is
+# replaced by a new one, None for no limit
+incremental_z3_budget = 20000
+
+# the solver used if incremental_z3, made on first use
+_inc_z3 = None
+# map from the id of a Z3 constraint asserted in _inc_z3 to (constraint,
+# guard literal), the constraint is kept so that its id is not reused
+_inc_z3_guards = dict()
+
+# budget (in node selectors) of the normalisation memo used by
+# reset_normalisation_memo, None for no limit
+normalisation_memo_budget = 100000
+
+# map from interned node selector to its interned normalised form or
+# _unsatisfiable, see _normalise_node_selector
+_normalised_selectors = memocache.MemoCache(normalisation_memo_budget)
+_unsatisfiable = "unsatisfiable"
+
+# budget (in queries) of the position constraint memo used by
+# reset_positions_memo, None for no limit
+positions_memo_budget = 100000
+
+# map from AutEmptinessChecker.__pos_cons_key to the result of
+# __pos_cons_satisfiable
+_positions_memo = memocache.MemoCache(positions_memo_budget)
+
+def reset_normalisation_memo():
+    """
+    _normalise_node_selector is memoized, call this to reset it.  The new
+    memo uses the budget in normalisation_memo_budget.
+    """
+    global _normalised_selectors
+    _normalised_selectors = memocache.MemoCache(normalisation_memo_budget)
+
+def normalisation_memo_stats():
+    """
+    :returns:
+        The stats (as memocache.MemoCache.stats) of the normalisation memo,
+        where hits are normalisations saved
+    """
+    return _normalised_selectors.stats()
+
+def reset_positions_memo():
+    """
+    The position constraint satisfiability checks of AutEmptinessChecker
+    are memoized, call this to reset.  The new memo uses the budget in
+    positions_memo_budget.
+    """
+    global _positions_memo
+    _positions_memo = memocache.MemoCache(positions_memo_budget)
+
+def positions_memo_stats():
+    """
+    :returns:
+        The stats (as memocache.MemoCache.stats) of the position constraint
+        memo
+    """
+    return _positions_memo.stats()
+
+def reset_z3_solver():
+    """
+    Drops the solver used if incremental_z3 is set, with everything asserted
+    in it.  Call between builds to stop it growing.
+    """
+    global _inc_z3
+    global _inc_z3_guards
+    _inc_z3 = None
+    _inc_z3_guards = dict()
+
+def _incremental_z3_check(cons):
+    """Decides a conjunction of constraints with the incremental solver,
+    asserting under a new guard literal those not asserted before
+
+    :param cons:
+        An iterable of HashableZ3 constraints
+    :returns:
+        The result of the Z3 check (sat, unsat or unknown)
+    """
+    global _inc_z3
+    if (_inc_z3 is None or
+        (incremental_z3_budget is not None and
+         len(_inc_z3_guards) > incremental_z3_budget)):
+        reset_z3_solver()
+        _inc_z3 = Solver()
+    guards = []
+    for c in cons:
+        # constraints on fixed positions may be python bools
+        z = BoolVal(c.z3) if isinstance(c.z3, bool) else c.z3
+        # Z3 shares equal terms, so equal constraints made by different
+        # checkers have the same id
+        key = z.get_id()
+        if key not in _inc_z3_guards:
+            g = Bool("_guard" + str(len(_inc_z3_guards)))
+            _inc_z3.add(Implies(g, z))
+            _inc_z3_guards[key] = (z, g)
+            buildprofile.count("z3_assertions")
+        guards.append(_inc_z3_guards[key][1])
+    return _inc_z3.check(*guards)
+
+def _form_shape(form):
+    """
+    :param form:
+        The form of a HashableZ3
+    :returns:
+        The form with its PositionVariables replaced by None
+    """
+    return tuple(None if isinstance(x, PositionVariables) else x
+                 for x in form)
+
 class HashableZ3:
     """Some kind of hashable constraints for z3 constraints and variables"""
-    def __init__(self, z3):
+    def __init__(self, z3, form = None):
+        """
+        :param z3:
+            The z3 constraint
+        :param form:
+            For position constraints, a tuple describing the constraint in
+            terms of the PositionVariables it is on (given the
+            AutEmptinessChecker that made it), or None if there is none.
+            The kinds decided by AutEmptinessChecker.__native_pos_cons_satisfiable
+            are
+
+                ("nth", pvs, from_last, a, b, negated) as for poscons,
+                ("link", pvs, next_pvs, pd, pdstar) as for __get_pos_constraint,
+                ("true",)
+
+            the others are only used to memoize satisfiability.
+        """
         self.z3 = z3
+        self.form = form
 
     def __eq__(self, other):
         return self is other
@@ -63,6 +201,13 @@ def get_local_conflict_ps():
     """
     return _local_conflict_ps
 
+def get_locally_checkable_ps():
+    """
+    :returns:
+        Set of pseudo classes that only constrain the node they appear on
+    """
+    return _locally_checkable_ps
+
 def isempty(aut, data=None):
     """Checks using SAT whether the given CSSAutomaton is empty
 
@@ -73,9 +218,125 @@ def isempty(aut, data=None):
     :returns:
         True iff the automaton is empty
     """
-    naut = _normalise_automaton(aut)
-    checker = AutEmptinessChecker(naut)
-    return checker.check()
+    with buildprofile.timer("normalisation"):
+        naut = _normalise_automaton(aut)
+    with buildprofile.timer("graph_search"):
+        checker = AutEmptinessChecker(naut)
+        return checker.check()
+
+def isempty_intersection(aut1, aut2, data=None):
+    """Checks whether the intersection of two CSSAutomaton is empty without
+    building all of cssautomaton.intersect(aut1, aut2).  The product is
+    explored backwards from the final state, see _backward_product, so the
+    product of node selectors is only formed for the transitions reached.
+
+    :param aut1:
+        The first CSSAutomaton
+    :param aut2:
+        The second CSSAutomaton, with the same namespaces as aut1
+    :param data:
+        As in isempty
+    :returns:
+        True iff the intersection of the automata is empty
+    """
+    with buildprofile.timer("intersection"):
+        naut = _backward_product(aut1, aut2)
+    if naut is None:
+        buildprofile.count("product_early_exits")
+        return False
+    if naut.qinit is None:
+        return True
+    with buildprofile.timer("graph_search"):
+        checker = AutEmptinessChecker(naut)
+        return checker.check()
+
+def _backward_product(aut1, aut2):
+    """Builds the normalised (with _normalise_selector) part of the
+    intersection of two automata that can reach its final state.
+
+    The search stops early if the initial state is reached through
+    transitions whose normalised node selectors are just an element, since
+    then AutEmptinessChecker would accept along that path.
+
+    :param aut1:
+        The first CSSAutomaton
+    :param aut2:
+        The second CSSAutomaton, with the same namespaces as aut1
+    :returns:
+        None if the search stopped early (so the intersection is not empty),
+        else a normalised CSSAutomaton for the part of the intersection that
+        can reach the final state, with qinit None if that does not include
+        the initial state
+    """
+    if (aut1.namespaces != aut2.namespaces):
+        raise cssautomaton.CSSAutConstructionException("Can only intersect automata with matching namespaces.")
+    naut = CSSAutomaton(aut1.namespaces)
+    # map from q1 * n2 + q2 to the state of naut for q1xq2
+    n2 = aut2.num_states()
+    states = dict()
+    # map from i1 * m2 + i2 to the index in naut of the normalised product
+    # of selectors i1 of aut1 and i2 of aut2, or None if it is unsatisfiable
+    m2 = len(aut2.selectors)
+    selectors = dict()
+    # states of naut reached from the final state by transitions with just
+    # an element as node selector
+    free = set()
+
+    init = aut1.qinit * n2 + aut2.qinit
+    naut.qfinal = naut._new_state()
+    states[aut1.qfinal * n2 + aut2.qfinal] = naut.qfinal
+    free.add(naut.qfinal)
+
+    # pairs of states to find the transitions into, a state is expanded
+    # again when it becomes free
+    worklist = [(aut1.qfinal, aut2.qfinal)]
+    while len(worklist) > 0:
+        (qa, qb) = worklist.pop()
+        q = states[qa * n2 + qb]
+        qfree = q in free
+        srcs1 = aut1.srcs[qa]
+        arrows1 = aut1.arrows[qa]
+        sels1 = aut1.sels[qa]
+        srcs2 = aut2.srcs[qb]
+        arrows2 = aut2.arrows[qb]
+        sels2 = aut2.sels[qb]
+        for k1 in xrange(len(srcs1)):
+            for k2 in xrange(len(srcs2)):
+                arrow = cssautomaton._product_arrows(arrows1[k1], arrows2[k2])
+                if arrow is None:
+                    continue
+                key = sels1[k1] * m2 + sels2[k2]
+                if key in selectors:
+                    i = selectors[key]
+                else:
+                    sel = cssautomaton._product_selectors(aut1.selectors[sels1[k1]],
+                                                          aut2.selectors[sels2[k2]])
+                    if sel is not None:
+                        with buildprofile.timer("normalisation"):
+                            sel = _normalise_node_selector(sel)
+                    i = None if sel is None else naut.selector_id(sel)
+                    selectors[key] = i
+                if i is None:
+                    continue
+
+                src = srcs1[k1] * n2 + srcs2[k2]
+                p = states.get(src)
+                if p is None:
+                    p = naut._new_state()
+                    states[src] = p
+                    worklist.append((srcs1[k1], srcs2[k2]))
+                naut.add_indexed_tran(p, arrow, i, q)
+
+                if (qfree and
+                    p not in free and
+                    type(naut.selectors[i]).__name__ == "Element"):
+                    if src == init:
+                        return None
+                    free.add(p)
+                    worklist.append((srcs1[k1], srcs2[k2]))
+
+    naut.qinit = states.get(init)
+    return naut
 
 def _normalise_automaton(aut):
     """Builds a new normalised automaton without class, local pseudo,
@@ -89,15 +350,40 @@ def _normalise_automaton(aut):
     naut = CSSAutomaton()
     naut.qinit = aut.qinit
     naut.qfinal = aut.qfinal
-    for t in aut:
-        sel = _normalise_selector(t.node_selector)
-        if sel is not None:
-            naut.add_tran(Tran(t.q1,
-                               t.arrow,
-                               sel,
-                               t.q2))
+    naut.ensure_states(aut.num_states())
+    # each node selector is normalised once however many transitions use it
+    ids = []
+    for sel in aut.selectors:
+        sel = _normalise_node_selector(sel)
+        ids.append(None if sel is None else naut.selector_id(sel))
+    for q2 in xrange(aut.num_states()):
+        for (q1, arrow, i) in izip(aut.srcs[q2],
+                                   aut.arrows[q2],
+                                   aut.sels[q2]):
+            if ids[i] is not None:
+                naut.add_indexed_tran(q1, arrow, ids[i], q2)
     return naut
 
+def _normalise_node_selector(sel):
+    """_normalise_selector memoized on the interned node selector
+
+    Note: is memoized, call reset_normalisation_memo to reset
+
+    :param sel:
+        The selector as Selector.parsed_tree from cssselect
+    :returns:
+        The interned normalised selector, or None if its inconsistent
+    """
+    sel = cssselect_parser.intern_selector(sel)
+    nsel = _normalised_selectors.get(sel)
+    if nsel is None:
+        nsel = _normalise_selector(sel)
+        nsel = (_unsatisfiable
+                if nsel is None
+                else cssselect_parser.intern_selector(nsel))
+        _normalised_selectors.put(sel, nsel)
+    return None if nsel is _unsatisfiable else nsel
+
 def _normalise_selector(sel):
     """Normalises the selector, which means (at all steps,
        return None if selector becomes unsatisfiable):
@@ -362,6 +648,33 @@ class PositionVariables:
         return id(self)
 
 
+def _subsumes(tup1, tup2):
+    """Whether a worklist tuple of AutEmptinessChecker.check for a state
+    has no obligation that another for the same state lacks, so that the
+    first can accept wherever the second can
+
+    :param tup1:
+        A worklist tuple (q, ids, target, root, arrs, pos_cons, pvs, pd,
+        pdstar)
+    :param tup2:
+        A worklist tuple for the same state
+    :returns:
+        True iff tup1 subsumes tup2
+    """
+    (_, ids1, targ1, root1, arrs1, pos_cons1, pvs1, pd1, pdstar1) = tup1
+    (_, ids2, targ2, root2, arrs2, pos_cons2, pvs2, pd2, pdstar2) = tup2
+    if (targ1 and not targ2) or (root1 and not root2):
+        return False
+    if not (ids1 <= ids2 and arrs1 <= arrs2 and pos_cons1 <= pos_cons2):
+        return False
+    # without position variables the distance is not constrained, else the
+    # distance to the same variables must be the same, or tup1's a lower
+    # bound on tup2's
+    return (pvs1 is None or
+            (pvs1 is pvs2 and
+             (pd1 == pd2 if not pdstar1 else pd1 <= pd2) and
+             (pdstar1 or not pdstar2)))
+
 class AutEmptinessChecker:
     """Emptiness checker for normalised a given CSSAutomaton"""
 
@@ -396,14 +709,16 @@ class AutEmptinessChecker:
         self.nss.append("_null_ns")
         self.eles.append("_null_ele")
         i = 0
-        for t in self.aut:
-            (dummy_ns, dummy_ele) = self.__get_tran_dummies(t)
-            if dummy_ns:
-                self.nss.append("_dummy_ns" + str(i))
-                i += 1
-            if dummy_ele:
-                self.eles.append("_dummy_ele" + str(i))
-                i += 1
+        for sels in self.aut.sels:
+            for sel in sels:
+                (dummy_ns,
+                 dummy_ele) = self.__get_tran_dummies(self.aut.selectors[sel])
+                if dummy_ns:
+                    self.nss.append("_dummy_ns" + str(i))
+                    i += 1
+                if dummy_ele:
+                    self.eles.append("_dummy_ele" + str(i))
+                    i += 1
 
         self.nssort, vals = EnumSort("Namespace", map(str, self.nss))
         self.nsvals = { ns : v for (ns, v) in izip(self.nss, vals) }
@@ -416,6 +731,10 @@ class AutEmptinessChecker:
         self.__tsum = { (ns,e) : Int("sum" + str((ns, e)))
                         for (ns, e) in product(self.nss, self.eles) }
 
+        # map from fixed_pos to (pvs, new_cons) for the current node of Z3
+        # queries if incremental_z3
+        self.__query_pvs = dict()
+
 
     def __has_pseudo_elements(self, cons):
         """
@@ -424,8 +743,8 @@ class AutEmptinessChecker:
         :returns:
             True iff something from cons appears in a transition of self.aut
         """
-        for t in self.aut:
-            if self.__sel_has_pseudo_elements(t.node_selector, cons):
+        for sel in self.aut.selectors:
+            if self.__sel_has_pseudo_elements(sel, cons):
                 return True
         return False
 
@@ -493,18 +812,16 @@ class AutEmptinessChecker:
         return self.__has_pseudo_elements(cons)
 
 
-    def __get_tran_dummies(self, t):
+    def __get_tran_dummies(self, sel):
         """
-        :param t:
-            A transition Tran
+        :param sel:
+            The node selector of a transition
         :returns:
             (dummy_ns, dummy_ele)
             where dummy_ns is True iff transition implies need for a dummy namespace
             and dummy_ele is True iff transition implies need for a dummy element
         """
 
-        sel = t.node_selector
-
         # if selector is just * no dummy required
         if (type(sel).__name__ == "Element" and
             sel.namespace is None and
@@ -569,59 +886,63 @@ class AutEmptinessChecker:
         # p* is True if pd is a lower bound not exact (i.e. there was a ~ on the
         # way)
 
-        worklist = set([(self.aut.qfinal,
-                         frozenset(), False, False,
-                         frozenset(),
-                         frozenset(), None, 0, False)])
-        donelist = set()
-
-        # don't need a done list because we only have self-loops and the arrs field
-        # prevents looping on a single state
+        inittup = (self.aut.qfinal,
+                   frozenset(), False, False,
+                   frozenset(),
+                   frozenset(), None, 0, False)
+        worklist = set([inittup])
+        # map from state to the tuples for it added to the worklist so far
+        # that are not subsumed (see _subsumes) by another such tuple, only
+        # tuples not subsumed by one of these are added
+        antichains = defaultdict(list)
+        antichains[self.aut.qfinal].append(inittup)
 
         while len(worklist) > 0:
             oldtup = worklist.pop()
+            buildprofile.count("explored_tuples")
             (q,
              ids, targ, root,
              arrs,
              pos_cons, pvs, pd, pdstar) = oldtup
-            donelist.add(oldtup)
 
-            for t in self.aut.trans[q]:
-                if root and not t.arrow == Arrow.noop:
+            for (q1, arrow, sel) in izip(self.aut.srcs[q],
+                                         self.aut.arrows[q],
+                                         self.aut.sels[q]):
+                if root and not arrow == Arrow.noop:
                     continue
-                if t.q1 == t.q2 and t.q1 == q and t.arrow in arrs:
+                if q1 == q and arrow in arrs:
                     continue
 
-                new_pvs = pvs if t.arrow == Arrow.noop else None
+                new_pvs = pvs if arrow == Arrow.noop else None
 
                 (sat,
                  tids, ttarg, troot, tempty,
-                 tpos_cons, new_pvs) = self.__get_sel_info(t.node_selector)
+                 tpos_cons, new_pvs) = self.__get_sel_info(self.aut.selectors[sel])
 
                 if (sat and
                     tids.isdisjoint(ids) and
                     not (targ and ttarg) and
                     # here we use that noop transition only go to final state and
                     # say if we have to be empty, we can't go immediately down
-                    not (tempty and t.arrow == Arrow.child) and
-                    not (troot and t.arrow in [Arrow.neighbour, Arrow.sibling]) and
+                    not (tempty and arrow == Arrow.child) and
+                    not (troot and arrow in [Arrow.neighbour, Arrow.sibling]) and
                     # if going up the tree, make sure we can satisfy the nth-child
                     # constraints
-                    (t.arrow != Arrow.child or
+                    (arrow != Arrow.child or
                      self.__pos_cons_satisfiable(pos_cons,
                                                  pvs,
                                                  pd,
                                                  pdstar,
                                                  1))):
 
-                    new_arrs = set([t.arrow])
-                    if t.q1 == q:
+                    new_arrs = set([arrow])
+                    if q1 == q:
                         new_arrs |= arrs
 
                     new_pos_cons = set(tpos_cons)
                     new_pd = 0
                     new_pdstar = False
-                    if t.arrow == Arrow.noop:
+                    if arrow == Arrow.noop:
                         new_pos_cons |= pos_cons
                         if new_pvs is not None:
                             new_pos_cons.add(self.__get_pos_constraint(new_pvs,
@@ -632,7 +953,7 @@ class AutEmptinessChecker:
                             new_pd = pd
                             new_pdstar = pdstar
                             new_pvs = pvs
-                    elif t.arrow == Arrow.neighbour:
+                    elif arrow == Arrow.neighbour:
                         new_pos_cons |= pos_cons
                         if new_pvs is not None:
                             new_pos_cons.add(self.__get_pos_constraint(new_pvs,
@@ -643,7 +964,7 @@ class AutEmptinessChecker:
                             new_pd = pd + 1
                             new_pdstar = pdstar
                             new_pvs = pvs
-                    elif t.arrow == Arrow.sibling:
+                    elif arrow == Arrow.sibling:
                         new_pos_cons |= pos_cons
                         if new_pvs is not None:
                             new_pos_cons.add(self.__get_pos_constraint(new_pvs,
@@ -655,7 +976,7 @@ class AutEmptinessChecker:
                             new_pdstar = True
                             new_pvs = pvs
 
-                    if (t.q1 == self.aut.qinit and
+                    if (q1 == self.aut.qinit and
                         # root can't have position constraints cos it's not a
                         # child
                         (not troot or len(new_pos_cons) == 0) and
@@ -666,13 +987,23 @@ class AutEmptinessChecker:
 
                         return False
 
-                    newtup = (t.q1,
+                    newtup = (q1,
                               frozenset(ids.union(tids)), targ or ttarg, troot,
                               frozenset(new_arrs),
                               frozenset(new_pos_cons), new_pvs, new_pd, new_pdstar)
 
-                    if newtup not in donelist:
-                        worklist.add(newtup)
+                    antichain = antichains[q1]
+                    if any(_subsumes(tup, newtup) for tup in antichain):
+                        buildprofile.count("subsumed_tuples")
+                        continue
+                    for tup in [ tup for tup in antichain
+                                 if _subsumes(newtup, tup) ]:
+                        antichain.remove(tup)
+                        if tup in worklist:
+                            worklist.remove(tup)
+                            buildprofile.count("subsumed_tuples")
+                    antichain.append(newtup)
+                    worklist.add(newtup)
 
         # we abort early if we find q0 (which would show non-emp)
         return True
@@ -734,30 +1065,172 @@ class AutEmptinessChecker:
             variable position is allowed.
         :returns:
             True iff pos_cons can be satisfied
-        """
-        global _emp_z3
 
+        Note: is memoized, see reset_positions_memo
+        """
         if len(pos_cons) == 0:
             return True
 
-        _emp_z3.push()
+        key = self.__pos_cons_key(pos_cons, pvs, pd, pdstar, fixed_pos)
+        if key is not None:
+            res = _positions_memo.get(key)
+            if res is not None:
+                return res
+
+        res = self.__decide_pos_cons(pos_cons, pvs, pd, pdstar, fixed_pos)
+        if key is not None:
+            _positions_memo.put(key, res)
+        return res
+
+    def __pos_cons_key(self, pos_cons, pvs, pd, pdstar, fixed_pos):
+        """A key for a __pos_cons_satisfiable query that is the same for
+        queries that are the same up to renaming of PositionVariables (for
+        checkers with the same namespaces and elements if of-type
+        constraints are used).  Queries that are the same but for the order
+        in which equally shaped constraints are renamed may get different
+        keys.
+
+        :param pos_cons:
+            As for __pos_cons_satisfiable
+        :param pvs:
+            As for __pos_cons_satisfiable
+        :param pd:
+            As for __pos_cons_satisfiable
+        :param pdstar:
+            As for __pos_cons_satisfiable
+        :param fixed_pos:
+            As for __pos_cons_satisfiable
+        :returns:
+            A hashable key, or None if some constraint has no form
+        """
+        forms = []
+        for c in pos_cons:
+            if c.form is None:
+                return None
+            forms.append(c.form)
+        forms.sort(key = _form_shape)
+
+        # map from PositionVariables to their number in order of first use
+        names = dict() if pvs is None else { pvs : 0 }
+        renamed = []
+        for form in forms:
+            renamed.append(tuple(names.setdefault(x, len(names))
+                                 if isinstance(x, PositionVariables)
+                                 else x
+                                 for x in form))
+
+        types = ((tuple(self.nss), tuple(self.eles),
+                  self.last, self.last_of_type)
+                 if self.of_type or self.last_of_type
+                 else None)
+        return (types,
+                frozenset(renamed),
+                pvs is None, pd, pdstar, fixed_pos)
+
+    def __decide_pos_cons(self, pos_cons, pvs, pd, pdstar, fixed_pos):
+        """Decides __pos_cons_satisfiable natively if possible, else with Z3
 
-        (pos_pvs, new_cons) = self.__create_new_pvs(fixed_pos)
+        :param pos_cons:
+            As for __pos_cons_satisfiable
+        :param pvs:
+            As for __pos_cons_satisfiable
+        :param pd:
+            As for __pos_cons_satisfiable
+        :param pdstar:
+            As for __pos_cons_satisfiable
+        :param fixed_pos:
+            As for __pos_cons_satisfiable
+        :returns:
+            True iff pos_cons can be satisfied
+        """
+        global _emp_z3
 
-        for c in chain(pos_cons,
-                       new_cons):
+        if not (self.of_type or self.last_of_type):
+            with buildprofile.timer("positions"):
+                res = self.__native_pos_cons_satisfiable(pos_cons,
+                                                         pvs,
+                                                         pd,
+                                                         pdstar,
+                                                         fixed_pos)
+            if res is not None:
+                buildprofile.count("native_pos_checks")
+                return res
+
+        with buildprofile.timer("z3"):
+            buildprofile.count("z3_checks")
+
+            if incremental_z3:
+                # the current node is made once for each fixed_pos, so its
+                # constraints are the same for each query of this checker
+                if fixed_pos not in self.__query_pvs:
+                    self.__query_pvs[fixed_pos] = \
+                        self.__create_new_pvs(fixed_pos)
+                (pos_pvs, new_cons) = self.__query_pvs[fixed_pos]
+                c = self.__get_pos_constraint(pos_pvs, pvs, pd, pdstar)
+                return _incremental_z3_check(chain(pos_cons,
+                                                   new_cons,
+                                                   [c])) == sat
+
+            _emp_z3.push()
+
+            (pos_pvs, new_cons) = self.__create_new_pvs(fixed_pos)
+
+            for c in chain(pos_cons,
+                           new_cons):
+                _emp_z3.add(c.z3)
+
+            c = self.__get_pos_constraint(pos_pvs, pvs, pd, pdstar)
             _emp_z3.add(c.z3)
+            buildprofile.count("z3_assertions",
+                               len(pos_cons) + len(new_cons) + 1)
 
-        c = self.__get_pos_constraint(pos_pvs, pvs, pd, pdstar)
-        _emp_z3.add(c.z3)
-
-        res = _emp_z3.check()
+            res = _emp_z3.check()
 
-        _emp_z3.pop()
+            _emp_z3.pop()
 
         return res == sat
 
 
+    def __native_pos_cons_satisfiable(self, pos_cons, pvs, pd, pdstar, fixed_pos):
+        """Decides __pos_cons_satisfiable with poscons.satisfiable if the
+        constraints are all of the kinds it understands (so there are no
+        of-type constraints)
+
+        :param pos_cons:
+            As for __pos_cons_satisfiable
+        :param pvs:
+            As for __pos_cons_satisfiable
+        :param pd:
+            As for __pos_cons_satisfiable
+        :param pdstar:
+            As for __pos_cons_satisfiable
+        :param fixed_pos:
+            As for __pos_cons_satisfiable
+        :returns:
+            The result of __pos_cons_satisfiable, or None if it could not be
+            decided this way
+        """
+        nths = []
+        links = []
+        for c in pos_cons:
+            if c.form is None:
+                return None
+            elif c.form[0] == "nth":
+                nths.append(c.form[1:])
+            elif c.form[0] == "link":
+                (_, p1, p2, d, at_least) = c.form
+                links.append((p1, p2, d, at_least))
+            elif c.form[0] != "true":
+                return None
+
+        # the current node, as __create_new_pvs would make it
+        pos_pvs = PositionVariables()
+        if fixed_pos is not None:
+            nths.append((pos_pvs, False, 0, fixed_pos, False))
+        if pvs is not None:
+            links.append((pos_pvs, pvs, pd, pdstar))
+        return poscons.satisfiable(nths, links)
+
     def __get_pos_constraint(self, pvs, next_pvs, pd, pdstar):
         """
         :param pvs:
@@ -776,7 +1249,7 @@ class AutEmptinessChecker:
 
         if next_pvs is None:
             # always satisfiable!
-            return HashableZ3(And())
+            return HashableZ3(And(), ("true",))
 
         cons = []
         evars = []
@@ -807,10 +1280,11 @@ class AutEmptinessChecker:
             if of_type:
                 cons.append(pd == Sum(self.__tdelta.values()))
 
+        form = ("link", pvs, next_pvs, pd, pdstar)
         if len(evars) > 0:
-            return HashableZ3(Exists(evars, And(cons)))
+            return HashableZ3(Exists(evars, And(cons)), form)
         else:
-            return HashableZ3(And(cons))
+            return HashableZ3(And(cons), form)
 
 
     def __get_sel_info(self, sel):
@@ -859,23 +1333,27 @@ class AutEmptinessChecker:
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(pvs.pv > 1))
+                        pos_cons.add(HashableZ3(pvs.pv > 1,
+                                                ("nth", pvs, False, 0, 1, True)))
                     elif s.subselector.ident == "last-child":
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(pvs.nlast - pvs.pv > 0))
+                        pos_cons.add(HashableZ3(pvs.nlast - pvs.pv > 0,
+                                                ("nth", pvs, True, 0, 1, True)))
                     elif s.subselector.ident == "only-child":
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
                         pos_cons.add(HashableZ3(Or(pvs.pv > 1,
-                                                   pvs.nlast - pvs.pv == 0)))
+                                                   pvs.nlast - pvs.pv == 0),
+                                                ("not_only_child", pvs)))
                     elif s.subselector.ident == "first-of-type":
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(self.__not_nth_of_type(pvs, 0, 1)))
+                        pos_cons.add(HashableZ3(self.__not_nth_of_type(pvs, 0, 1),
+                                                ("nth_of_type", pvs, False, 0, 1, True)))
                     elif s.subselector.ident == "only-of-type":
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
@@ -886,7 +1364,8 @@ class AutEmptinessChecker:
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(self.__not_nth_last_of_type(pvs, 0, 1)))
+                        pos_cons.add(HashableZ3(self.__not_nth_last_of_type(pvs, 0, 1),
+                                                ("nth_of_type", pvs, True, 0, 1, True)))
                     else:
                         neg_ps.add(s.subselector.ident)
                 elif subtype == "Function":
@@ -895,58 +1374,70 @@ class AutEmptinessChecker:
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(self.__not_nth(pvs.pv, a, b)))
+                        pos_cons.add(HashableZ3(self.__not_nth(pvs.pv, a, b),
+                                                ("nth", pvs, False, a, b, True)))
                     elif s.subselector.name == "nth-last-child":
                         a, b = cssfile.get_fun_sel_coefs(s.subselector)
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(self.__not_nth(pvs.nlast - pvs.pv + 1, a, b)))
+                        pos_cons.add(HashableZ3(self.__not_nth(pvs.nlast - pvs.pv + 1, a, b),
+                                                ("nth", pvs, True, a, b, True)))
                     elif s.subselector.name == "nth-of-type":
                         a, b = cssfile.get_fun_sel_coefs(s.subselector)
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(self.__not_nth_of_type(pvs, a, b)))
+                        pos_cons.add(HashableZ3(self.__not_nth_of_type(pvs, a, b),
+                                                ("nth_of_type", pvs, False, a, b, True)))
                     elif s.subselector.name == "nth-last-of-type":
                         a, b = cssfile.get_fun_sel_coefs(s.subselector)
                         if pvs is None:
                             (pvs, new_cons) = self.__create_new_pvs()
                             pos_cons |= new_cons
-                        pos_cons.add(HashableZ3(self.__not_nth_last_of_type(pvs, a, b)))
+                        pos_cons.add(HashableZ3(self.__not_nth_last_of_type(pvs, a, b),
+                                                ("nth_of_type", pvs, True, a, b, True)))
             elif stype == "Pseudo":
                 if s.ident == "first-child":
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(pvs.pv == 1))
+                    pos_cons.add(HashableZ3(pvs.pv == 1,
+                                            ("nth", pvs, False, 0, 1, False)))
                 elif s.ident == "last-child":
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(pvs.nlast - pvs.pv == 0))
+                    pos_cons.add(HashableZ3(pvs.nlast - pvs.pv == 0,
+                                            ("nth", pvs, True, 0, 1, False)))
                 elif s.ident == "only-child":
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(pvs.pv == 1))
-                    pos_cons.add(HashableZ3(pvs.nlast - pvs.pv == 0))
+                    pos_cons.add(HashableZ3(pvs.pv == 1,
+                                            ("nth", pvs, False, 0, 1, False)))
+                    pos_cons.add(HashableZ3(pvs.nlast - pvs.pv == 0,
+                                            ("nth", pvs, True, 0, 1, False)))
                 elif s.ident == "first-of-type":
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth_of_type(pvs, 0, 1)))
+                    pos_cons.add(HashableZ3(self.__nth_of_type(pvs, 0, 1),
+                                            ("nth_of_type", pvs, False, 0, 1, False)))
                 elif s.ident == "only-of-type":
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth_of_type(pvs, 0, 1)))
-                    pos_cons.add(HashableZ3(self.__nth_last_of_type(pvs, 0, 1)))
+                    pos_cons.add(HashableZ3(self.__nth_of_type(pvs, 0, 1),
+                                            ("nth_of_type", pvs, False, 0, 1, False)))
+                    pos_cons.add(HashableZ3(self.__nth_last_of_type(pvs, 0, 1),
+                                            ("nth_of_type", pvs, True, 0, 1, False)))
                 elif s.ident == "last-of-type":
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth_last_of_type(pvs, 0, 1)))
+                    pos_cons.add(HashableZ3(self.__nth_last_of_type(pvs, 0, 1),
+                                            ("nth_of_type", pvs, True, 0, 1, False)))
                 else:
                     ps.add(s.ident)
             elif stype == "Hash":
@@ -957,25 +1448,29 @@ class AutEmptinessChecker:
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth(pvs.pv, a, b)))
+                    pos_cons.add(HashableZ3(self.__nth(pvs.pv, a, b),
+                                            ("nth", pvs, False, a, b, False)))
                 elif s.name == "nth-last-child":
                     a, b = cssfile.get_fun_sel_coefs(s)
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth(pvs.nlast - pvs.pv + 1, a, b)))
+                    pos_cons.add(HashableZ3(self.__nth(pvs.nlast - pvs.pv + 1, a, b),
+                                            ("nth", pvs, True, a, b, False)))
                 elif s.name == "nth-of-type":
                     a, b = cssfile.get_fun_sel_coefs(s)
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth_of_type(pvs, a, b)))
+                    pos_cons.add(HashableZ3(self.__nth_of_type(pvs, a, b),
+                                            ("nth_of_type", pvs, False, a, b, False)))
                 elif s.name == "nth-last-of-type":
                     a, b = cssfile.get_fun_sel_coefs(s)
                     if pvs is None:
                         (pvs, new_cons) = self.__create_new_pvs()
                         pos_cons |= new_cons
-                    pos_cons.add(HashableZ3(self.__nth_last_of_type(pvs, a, b)))
+                    pos_cons.add(HashableZ3(self.__nth_last_of_type(pvs, a, b),
+                                            ("nth_of_type", pvs, True, a, b, False)))
             s = s.selector
 
         sat = (not ((s.namespace, s.element) in neg_nsele or
@@ -984,21 +1479,25 @@ class AutEmptinessChecker:
 
         if (self.of_type or self.last_of_type) and pvs is not None:
             if s.element is not None:
-                pos_cons.add(HashableZ3(pvs.ele == self.evals[s.element]))
+                pos_cons.add(HashableZ3(pvs.ele == self.evals[s.element],
+                                        ("element", pvs, s.element)))
             if s.namespace is not None:
-                pos_cons.add(HashableZ3(pvs.ns == self.nsvals[s.namespace]))
+                pos_cons.add(HashableZ3(pvs.ns == self.nsvals[s.namespace],
+                                        ("namespace", pvs, s.namespace)))
 
             for (ns, e) in neg_nsele:
+                form = ("not_type", pvs, ns, e)
                 if ns is not None and e is not None:
                     pos_cons.add(HashableZ3(Or(pvs.ns != self.nsvals[ns],
-                                                pvs.ele != self.evals[e])))
+                                                pvs.ele != self.evals[e]),
+                                            form))
                 elif ns is None and e is not None:
-                    pos_cons.add(HashableZ3(pvs.ele != self.evals[e]))
+                    pos_cons.add(HashableZ3(pvs.ele != self.evals[e], form))
                 elif ns is not None and e is None:
-                    pos_cons.add(HashableZ3(pvs.ns != self.nsvals[ns]))
+                    pos_cons.add(HashableZ3(pvs.ns != self.nsvals[ns], form))
                 elif ns is None and e is None:
                     # not(*|*) is False
-                    pos_cons.add(HashableZ3(Or()))
+                    pos_cons.add(HashableZ3(Or(), form))
 
         return (sat,
                 ids, "target" in ps, "root" in ps, "empty" in ps,
@@ -1021,18 +1520,20 @@ class AutEmptinessChecker:
         cons = set()
 
         pvs.pv = self.__new_pos_var() if fixed_pos is None else fixed_pos
-        cons.add(HashableZ3(pvs.pv >= 1))
+        cons.add(HashableZ3(pvs.pv >= 1, ("true",)))
 
         if self.last:
             pvs.nlast = self.__nlast
-            cons.add(HashableZ3(pvs.nlast - pvs.pv >= 0))
+            cons.add(HashableZ3(pvs.nlast - pvs.pv >= 0, ("true",)))
 
         if self.of_type or self.last_of_type:
             pvs.tsumpv = { (ns,e) : self.__new_sumpv_var(ns, e)
                            for (ns, e) in product(self.nss, self.eles) }
-            cons |= { HashableZ3(pvs.tsumpv[(ns,e)] >=  0)
+            cons |= { HashableZ3(pvs.tsumpv[(ns,e)] >=  0,
+                                 ("sum_before", pvs, ns, e))
                       for (ns, e) in product(self.nss, self.eles) }
-            cons.add(HashableZ3(pvs.pv == Sum(pvs.tsumpv.values())))
+            cons.add(HashableZ3(pvs.pv == Sum(pvs.tsumpv.values()),
+                                ("sums_before", pvs)))
             pvs.ns = self.__new_ns_var()
             pvs.ele = self.__new_ele_var()
 
@@ -1044,10 +1545,11 @@ class AutEmptinessChecker:
                         And(Implies(pvs.tsum[(ns,e)] == 0,
                                     pvs.tsumpv[(ns,e)] == 0),
                             Implies(pvs.tsum[(ns,e)] > 0,
-                                    pvs.tsum[(ns,e)] > pvs.tsumpv[(ns,e)]))
-                      )
+                                    pvs.tsum[(ns,e)] > pvs.tsumpv[(ns,e)])),
+                        ("sum", pvs, ns, e))
                       for (ns, e) in product(self.nss, self.eles) }
-            cons.add(HashableZ3(pvs.nlast == Sum(pvs.tsum.values())))
+            cons.add(HashableZ3(pvs.nlast == Sum(pvs.tsum.values()),
+                                ("sums", pvs)))
 
         return (pvs, cons)
 
@@ -0,0 +1,247 @@
+"""Timings and counts collected while building a simpleCSS.
+
+Code being profiled charges its time to a named phase with
+
+    with buildprofile.timer("z3"):
+        ...
+
+and counts events with buildprofile.count(name).  Both go to the current
+profile, set with profiling().  Timed phases may nest: time is charged to the
+innermost phase only, so the phase timings add up to the total time profiled.
+Profiles recorded in worker processes are merged into the parent's, so with
+several processes the timings add up to more than the time taken.
+"""
+
+import json
+from contextlib import contextmanager
+from collections import defaultdict
+from timeit import default_timer
+
+class BuildProfile:
+    """The timings, counts and cache statistics of a build"""
+
+    def __init__(self):
+        # map from phase name to seconds spent in it
+        self.timings = defaultdict(float)
+        # map from event name to number of times it occurred
+        self.counts = defaultdict(int)
+        # map from cache name to dict of "hits", "misses" and "evictions"
+        self.caches = defaultdict(lambda : defaultdict(int))
+        # map from shortcut tier name to dict of "hits" (pairs decided) and
+        # "misses" (pairs passed on)
+        self.tiers = defaultdict(lambda : defaultdict(int))
+        # stack of [phase, time phase was last entered or resumed]
+        self.__running = []
+
+    def start(self, phase):
+        """Starts charging time to phase, pausing the running phase if any
+
+        :param phase:
+            The name of the phase as a string
+        """
+        now = default_timer()
+        if len(self.__running) > 0:
+            self.__charge(now)
+        self.__running.append([phase, now])
+
+    def stop(self):
+        """Stops the phase started last and resumes the phase before it"""
+        now = default_timer()
+        self.__charge(now)
+        self.__running.pop()
+        if len(self.__running) > 0:
+            self.__running[-1][1] = now
+
+    def add_time(self, phase, seconds):
+        """Charges time measured elsewhere to a phase
+
+        :param phase:
+            The name of the phase as a string
+        :param seconds:
+            The time to add
+        """
+        self.timings[phase] += seconds
+
+    def count(self, name, n = 1):
+        """
+        :param name:
+            The name of the event as a string
+        :param n:
+            The number of occurrences to add
+        """
+        self.counts[name] += n
+
+    def cache_lookup(self, name, hit):
+        """Counts a lookup in a cache
+
+        :param name:
+            The name of the cache as a string
+        :param hit:
+            True iff the lookup found a value
+        """
+        self.caches[name]["hits" if hit else "misses"] += 1
+
+    def tier_result(self, name, decided, n = 1):
+        """Counts pairs tried by a shortcut tier
+
+        :param name:
+            The name of the tier as a string
+        :param decided:
+            True iff the tier decided the overlap of the pairs
+        :param n:
+            The number of pairs
+        """
+        self.tiers[name]["hits" if decided else "misses"] += n
+
+    def cache_stats(self, name, stats):
+        """Sets the statistics of a cache that keeps its own counters
+
+        :param name:
+            The name of the cache as a string
+        :param stats:
+            A dict with some of the keys "hits", "misses" and "evictions"
+        """
+        for key in ["hits", "misses", "evictions"]:
+            self.caches[name][key] = stats.get(key, 0)
+
+    def merge(self, other):
+        """Adds the timings, counts and cache and tier counters of another
+        profile to this one, e.g. one recorded in a worker process
+
+        :param other:
+            The BuildProfile to add, with no phase running
+        """
+        for (phase, seconds) in other.timings.iteritems():
+            self.timings[phase] += seconds
+        for (name, n) in other.counts.iteritems():
+            self.counts[name] += n
+        for (mine, theirs) in [(self.caches, other.caches),
+                               (self.tiers, other.tiers)]:
+            for (name, stats) in theirs.iteritems():
+                for (key, n) in stats.iteritems():
+                    mine[name][key] += n
+
+    def __getstate__(self):
+        # the defaultdicts cannot be pickled, so profiles are sent between
+        # processes as plain dicts
+        return { "timings" : dict(self.timings),
+                 "counts" : dict(self.counts),
+                 "caches" : dict((name, dict(stats))
+                                 for (name, stats) in self.caches.iteritems()),
+                 "tiers" : dict((name, dict(stats))
+                                for (name, stats) in self.tiers.iteritems()) }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.timings.update(state["timings"])
+        self.counts.update(state["counts"])
+        for (name, stats) in state["caches"].iteritems():
+            self.caches[name].update(stats)
+        for (name, stats) in state["tiers"].iteritems():
+            self.tiers[name].update(stats)
+
+    def to_dict(self):
+        """
+        :returns:
+            The profile as a dict of plain values (suitable for json), with
+            the hit rate of each cache and tier added
+        """
+        return { "timings" : dict(self.timings),
+                 "total_time" : sum(self.timings.itervalues()),
+                 "counts" : dict(self.counts),
+                 "caches" : _with_hit_rates(self.caches),
+                 "tiers" : _with_hit_rates(self.tiers) }
+
+    def to_json(self):
+        """:returns: the profile as a JSON string"""
+        return json.dumps(self.to_dict(), indent = 2, sort_keys = True)
+
+    def __charge(self, now):
+        top = self.__running[-1]
+        self.timings[top[0]] += now - top[1]
+
+def _with_hit_rates(table):
+    """
+    :param table:
+        A map from names to dicts with keys "hits" and "misses" (or others)
+    :returns:
+        A copy of table with "hit_rate" added to each dict (None if there
+        were no lookups)
+    """
+    rates = dict()
+    for (name, stats) in table.iteritems():
+        stats = dict(stats)
+        stats.setdefault("hits", 0)
+        stats.setdefault("misses", 0)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (float(stats["hits"]) / lookups
+                             if lookups > 0
+                             else None)
+        rates[name] = stats
+    return rates
+
+
+# the profile that timer and count record to
+current = BuildProfile()
+
+@contextmanager
+def profiling(profile):
+    """Makes profile the current profile for the duration of a with block
+
+    :param profile:
+        The BuildProfile to record to
+    """
+    global current
+    previous = current
+    current = profile
+    try:
+        yield profile
+    finally:
+        current = previous
+
+@contextmanager
+def timer(phase):
+    """Charges the time spent in a with block to a phase of the current
+    profile
+
+    :param phase:
+        The name of the phase as a string
+    """
+    profile = current
+    profile.start(phase)
+    try:
+        yield
+    finally:
+        profile.stop()
+
+def count(name, n = 1):
+    """Counts an event in the current profile
+
+    :param name:
+        The name of the event as a string
+    :param n:
+        The number of occurrences to add
+    """
+    current.count(name, n)
+
+def cache_lookup(name, hit):
+    """Counts a lookup in a cache in the current profile
+
+    :param name:
+        The name of the cache as a string
+    :param hit:
+        True iff the lookup found a value
+    """
+    current.cache_lookup(name, hit)
+
+def tier_result(name, decided, n = 1):
+    """Counts pairs tried by a shortcut tier in the current profile
+
+    :param name:
+        The name of the tier as a string
+    :param decided:
+        True iff the tier decided the overlap of the pairs
+    :param n:
+        The number of pairs
+    """
+    current.tier_result(name, decided, n)
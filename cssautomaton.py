@@ -4,6 +4,7 @@
 import re
 import copy
 from enum import Enum
+from itertools import izip
 from collections import defaultdict
 
 import cssselect_parser
@@ -11,9 +12,10 @@ from cssselect_parser import Element
 from lxml import etree
 # yeah -- using two cssselector libraries, but one has the AST the other does
 # matching...
-from lxml.cssselect import CSSSelector
+from lxml.cssselect import LxmlTranslator
 
 import cssfile
+import memocache
 
 # * selector for convenience
 _isany = cssselect_parser.parse("*").pop().parsed_tree
@@ -25,6 +27,17 @@ _arrgrp = 2
 _nsgrp = 3
 _q2grp = 4
 
+# regular expression for parsing state names
+_stateRE = re.compile("q(\d+)$")
+
+# number of compiled node selector matchers kept by _node_matcher
+matcher_memo_budget = 10000
+
+# map from (selector string, namespaces, prefix) to compiled XPath
+_node_matchers = memocache.MemoCache(matcher_memo_budget)
+
+_translator = LxmlTranslator()
+
 
 class CSSAutConstructionException(Exception):
     pass
@@ -55,11 +68,47 @@ def fromselector(css, namespaces = {}):
     aut = CSSAutomaton(namespaces)
     aut.qinit = aut._new_state()
     aut.qfinal = aut._new_state()
-    aut.add_tran(Tran(aut.qinit, Arrow.child, _isany, aut.qinit))
-    aut.add_tran(Tran(aut.qinit, Arrow.sibling, _isany, aut.qinit))
+    isany = aut.selector_id(_isany)
+    aut.add_indexed_tran(aut.qinit, Arrow.child, isany, aut.qinit)
+    aut.add_indexed_tran(aut.qinit, Arrow.sibling, isany, aut.qinit)
     __build_aut_from_selector(aut, css, aut.qinit, aut.qfinal, Combinator.noop)
     return aut
 
+def _previous_element(node):
+    """
+    :param node:
+        An Element from etree in lxml
+    :returns:
+        The closest preceding sibling of node that is an element (not a
+        comment or processing instruction), or None
+    """
+    for sibling in node.itersiblings(tag = etree.Element, preceding = True):
+        return sibling
+    return None
+
+def _node_matcher(sel, namespaces, prefix):
+    """Compiles a node selector to XPath, memoised in _node_matchers
+
+    :param sel:
+        A node selector (no combinators) as cssselect parsed_tree
+    :param namespaces:
+        A dict of 'namespace' : 'uri' pairs to use for selector evaluation
+    :param prefix:
+        The XPath axis the selector applies to, "self::" to test the context
+        node or "descendant-or-self::" to find all matching nodes under it
+    :returns:
+        An etree.XPath giving the list of nodes matched from a context node
+    """
+    key = (cssfile.selector_str(sel),
+           tuple(sorted(namespaces.iteritems())),
+           prefix)
+    matcher = _node_matchers.get(key)
+    if matcher is None:
+        matcher = etree.XPath(_translator.css_to_xpath(key[0], prefix = prefix),
+                              namespaces = namespaces)
+        _node_matchers.put(key, matcher)
+    return matcher
+
 def fromlist(slist):
     """Takes a list where the first two items are strings giving the name of
     qinit and qfinal respectively, and the remaining items are string
@@ -67,16 +116,17 @@ def fromlist(slist):
 
         q1 -- {c, n, s, 0}, <selector> --> q2
 
-    where c is child, n neighbour, s sibling, and 0 noop.
-    Adds the transitions to the automaton.
+    where c is child, n neighbour, s sibling, and 0 noop, and states are
+    named q<n> for the state n.  Adds the transitions to the automaton.
 
     :param trans:
         list of strings, where the first two are the init and final states
         and the rest represent transitions
     """
     aut = CSSAutomaton()
-    aut.qinit = State(slist[0])
-    aut.qfinal = State(slist[1])
+    aut.qinit = _parse_state(slist[0])
+    aut.qfinal = _parse_state(slist[1])
+    aut.ensure_states(max(aut.qinit, aut.qfinal) + 1)
     for t in slist[2:]:
         m = _tranRE.match(t)
         if m is None:
@@ -88,12 +138,89 @@ def fromlist(slist):
             "s" : Arrow.sibling,
             "0" : Arrow.noop
         }[m.group(_arrgrp)]
-        aut.add_tran(Tran(State(m.group(_q1grp)),
+        aut.add_tran(Tran(_parse_state(m.group(_q1grp)),
                           arr,
                           css,
-                          State(m.group(_q2grp))))
+                          _parse_state(m.group(_q2grp))))
+    return aut
+
+def _parse_state(name):
+    """
+    :param name:
+        The name of a state as a string q<n>
+    :returns:
+        The state n
+    """
+    m = _stateRE.match(name)
+    if m is None:
+        raise CSSAutConstructionException("Unparsable state " + name)
+    return int(m.group(1))
+
+def fromselectors(selectors, namespaces = {}):
+    """Build a CSSAutomaton accepting the nodes matched by any of some
+    cssselect selectors (parsed trees).  The automaton is a trie of the
+    selectors keyed from the right: selectors with the same right-hand part
+    share the states and transitions for it, so checks on the automaton
+    explore a shared suffix once and only branch where the selectors differ.
+
+    :param selectors:
+        A non-empty iterable of cssselect selectors
+    :param namespaces:
+        A dict of 'namespace' : 'uri' pairs to use for selector evaluation
+    :returns:
+        A CSSAutomaton for the union of the selectors
+    """
+    aut = CSSAutomaton(namespaces)
+    aut.qinit = aut._new_state()
+    aut.qfinal = aut._new_state()
+    isany = aut.selector_id(_isany)
+    aut.add_indexed_tran(aut.qinit, Arrow.child, isany, aut.qinit)
+    aut.add_indexed_tran(aut.qinit, Arrow.sibling, isany, aut.qinit)
+    # map from (qout, node selector index, combinator) to the state before
+    # the node selector, for the selectors whose right-hand part reaches qout
+    # then has the node selector and combinator
+    states = dict()
+    # set of (qstart, node selector index, combinator, qout) already added
+    added = set()
+    for css in selectors:
+        parts = _selector_parts(css)
+        qout = aut.qfinal
+        for k in xrange(len(parts) - 1, -1, -1):
+            (node_selector, combinator) = parts[k]
+            sel = aut.selector_id(node_selector)
+            key = (qout, sel, combinator)
+            if k == 0:
+                qstart = aut.qinit
+            else:
+                qstart = states.get(key)
+                if qstart is None:
+                    qstart = aut._new_state()
+                    states[key] = qstart
+            if (qstart,) + key not in added:
+                added.add((qstart,) + key)
+                __add_node_selector_trans(aut, qstart, sel, qout, combinator)
+            qout = qstart
     return aut
 
+def _selector_parts(css):
+    """
+    :param css:
+        A cssselect selector (parsed tree)
+    :returns:
+        The list of (node_selector, combinator) of css from left to right,
+        where combinator is the Combinator to the right of the node selector
+        (Combinator.noop for the rightmost)
+    """
+    parts = []
+    combinator = Combinator.noop
+    while type(css).__name__ == "CombinedSelector":
+        parts.append((css.subselector, combinator))
+        combinator = _combinators[css.combinator]
+        css = css.selector
+    parts.append((css, combinator))
+    parts.reverse()
+    return parts
+
 def intersect(aut1, aut2):
     """Forms the intersection of two CSSAutomaton objects.
     Throws exception if namespaces of both automata are not the same.
@@ -108,41 +235,218 @@ def intersect(aut1, aut2):
     if (aut1.namespaces != aut2.namespaces):
         raise CSSAutConstructionException("Can only intersect automata with matching namespaces.")
     aut = CSSAutomaton(aut1.namespaces)
-    aut.qinit = _product_states(aut1.qinit, aut2.qinit)
-    aut.qfinal = _product_states(aut1.qfinal, aut2.qfinal)
-    for t1 in aut1:
-        for t2 in aut2:
-            t = _product_trans(t1, t2)
-            if t is not None:
-                aut.add_tran(t)
+    # map from q1 * n2 + q2 to the state of aut for q1xq2, states are only
+    # made when they get a transition
+    n2 = aut2.num_states()
+    states = dict()
+    def product_state(q1, q2):
+        key = q1 * n2 + q2
+        q = states.get(key)
+        if q is None:
+            q = aut._new_state()
+            states[key] = q
+        return q
+
+    aut.qinit = product_state(aut1.qinit, aut2.qinit)
+    aut.qfinal = product_state(aut1.qfinal, aut2.qfinal)
+
+    # map from i1 * m2 + i2 to the index in aut of the product of selectors
+    # i1 of aut1 and i2 of aut2, or None if they are incompatible
+    m2 = len(aut2.selectors)
+    selectors = dict()
+
+    for qa in xrange(aut1.num_states()):
+        srcs1 = aut1.srcs[qa]
+        if len(srcs1) == 0:
+            continue
+        arrows1 = aut1.arrows[qa]
+        sels1 = aut1.sels[qa]
+        for qb in xrange(n2):
+            srcs2 = aut2.srcs[qb]
+            arrows2 = aut2.arrows[qb]
+            sels2 = aut2.sels[qb]
+            for k1 in xrange(len(srcs1)):
+                for k2 in xrange(len(srcs2)):
+                    arrow = _product_arrows(arrows1[k1], arrows2[k2])
+                    if arrow is None:
+                        continue
+                    key = sels1[k1] * m2 + sels2[k2]
+                    if key in selectors:
+                        i = selectors[key]
+                    else:
+                        sel = _product_selectors(aut1.selectors[sels1[k1]],
+                                                 aut2.selectors[sels2[k2]])
+                        i = None if sel is None else aut.selector_id(sel)
+                        selectors[key] = i
+                    if i is not None:
+                        aut.add_indexed_tran(product_state(srcs1[k1], srcs2[k2]),
+                                             arrow,
+                                             i,
+                                             product_state(qa, qb))
     return aut
 
 
-class State:
-    """A state of a CSS automaton"""
-    def __init__(self, name):
-        """:param name:
-                the name of the state as a string
-        """
-        self.name = name
+def simplify(aut):
+    """Builds a smaller automaton accepting the same nodes as aut.  Until
+    nothing changes:
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.name == other.name
-        else:
-            return False
+        transitions subsumed by another with the same states and arrow are
+        removed,
+        states not on a path from qinit to qfinal are removed,
+        states with the same transitions out of them are merged.
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    :param aut:
+        The CSSAutomaton to simplify
+    :returns:
+        A new CSSAutomaton, sharing no state with aut
+    """
+    # set of (q1, arrow, i, q2) for i an index into aut.selectors
+    trans = set()
+    for (q2, srcs) in enumerate(aut.srcs):
+        for (q1, arrow, i) in izip(srcs, aut.arrows[q2], aut.sels[q2]):
+            trans.add((q1, arrow, i, q2))
+    (qinit, qfinal) = (aut.qinit, aut.qfinal)
+    while True:
+        size = len(trans)
+        trans = _drop_subsumed_trans(trans, aut.selectors)
+        trans = _trim_trans(trans, qinit, qfinal)
+        (trans, qinit, qfinal) = _merge_equivalent_states(trans, qinit, qfinal)
+        if len(trans) == size:
+            break
+
+    # number the states left in order
+    states = dict()
+    for q in sorted(set([qinit, qfinal]).union(*[(q1, q2)
+                                                   for (q1, _, _, q2)
+                                                   in trans])):
+        states[q] = len(states)
+
+    saut = CSSAutomaton(aut.namespaces)
+    saut.ensure_states(len(states))
+    saut.qinit = states[qinit]
+    saut.qfinal = states[qfinal]
+    for (q1, arrow, i, q2) in sorted(trans,
+                                     key = lambda (q1, arrow, i, q2) :
+                                         (q1, arrow.value, i, q2)):
+        saut.add_indexed_tran(states[q1],
+                              arrow,
+                              saut.selector_id(aut.selectors[i]),
+                              states[q2])
+    return saut
+
+def _drop_subsumed_trans(trans, selectors):
+    """
+    :param trans:
+        A set of transitions (q1, arrow, i, q2) for i an index into selectors
+    :param selectors:
+        A list of node selectors
+    :returns:
+        trans without the transitions whose node selector is subsumed by
+        that of another transition with the same q1, arrow and q2
+    """
+    groups = defaultdict(list)
+    for (q1, arrow, i, q2) in trans:
+        groups[(q1, arrow, q2)].append(i)
+
+    kept = set()
+    for ((q1, arrow, q2), ids) in groups.iteritems():
+        for i in ids:
+            if not any(j != i and
+                       _selector_subsumes(selectors[j], selectors[i])
+                       for j in ids):
+                kept.add((q1, arrow, i, q2))
+    return kept
+
+def _selector_subsumes(sel1, sel2):
+    """Conservative check that sel1 matches every node sel2 does
 
-    def __str__(self):
-        return self.name
+    :param sel1:
+        A node selector as cssselect parsed_tree
+    :param sel2:
+        A node selector as cssselect parsed_tree
+    :returns:
+        True if sel1 is an element selector (with no conditions) matching
+        the element of sel2, False if it is not known whether sel1 matches
+        every node of sel2
+    """
+    if type(sel1).__name__ != "Element":
+        return False
+    ele = sel2
+    while type(ele).__name__ != "Element":
+        ele = ele.selector
+    return ((sel1.namespace is None or sel1.namespace == ele.namespace) and
+            (sel1.element is None or sel1.element == ele.element))
 
-    def __repr__(self):
-        return str(self) + "<" + repr(id(self)) + ">"
+def _trim_trans(trans, qinit, qfinal):
+    """
+    :param trans:
+        A set of transitions (q1, arrow, i, q2)
+    :param qinit:
+        The initial state
+    :param qfinal:
+        The final state
+    :returns:
+        The transitions of trans on a path from qinit to qfinal
+    """
+    fwd = defaultdict(set)
+    bwd = defaultdict(set)
+    for (q1, _, _, q2) in trans:
+        fwd[q1].add(q2)
+        bwd[q2].add(q1)
+    reachable = _reachable_states(fwd, qinit)
+    coreachable = _reachable_states(bwd, qfinal)
+    return set(t for t in trans
+               if t[0] in reachable and t[3] in coreachable)
+
+def _reachable_states(succs, q):
+    """
+    :param succs:
+        A map from states to sets of successor states
+    :param q:
+        The state to start from
+    :returns:
+        The set of states reachable from q (including q)
+    """
+    reached = set([q])
+    worklist = [q]
+    while len(worklist) > 0:
+        for next_q in succs[worklist.pop()]:
+            if next_q not in reached:
+                reached.add(next_q)
+                worklist.append(next_q)
+    return reached
+
+def _merge_equivalent_states(trans, qinit, qfinal):
+    """Merges states other than qfinal that have the same transitions out of
+    them (with self loops counting as the same), keeping the least state of
+    each group
 
-    def __hash__(self):
-        return hash(self.name)
+    :param trans:
+        A set of transitions (q1, arrow, i, q2)
+    :param qinit:
+        The initial state
+    :param qfinal:
+        The final state
+    :returns:
+        (trans, qinit, qfinal) after merging
+    """
+    outs = defaultdict(set)
+    for (q1, arrow, i, q2) in trans:
+        outs[q1].add((arrow, i, None if q2 == q1 else q2))
+
+    # map from set of transitions out to the least state with them
+    reps = dict()
+    for q in sorted(outs):
+        if q != qfinal:
+            reps.setdefault(frozenset(outs[q]), q)
+    merged = { q : reps[frozenset(ts)]
+               for (q, ts) in outs.iteritems()
+               if q != qfinal }
+    merged[qfinal] = qfinal
+
+    trans = set((merged.get(q1, q1), arrow, i, merged.get(q2, q2))
+                for (q1, arrow, i, q2) in trans)
+    return (trans, merged.get(qinit, qinit), qfinal)
 
 
 class Arrow(Enum):
@@ -180,17 +484,23 @@ class Combinator(Enum):
         elif (self == Combinator.noop):
             return "."
 
+# map from cssselect combinator to Combinator
+_combinators = { ">" : Combinator.child,
+                 " " : Combinator.descendant,
+                 "+" : Combinator.neighbour,
+                 "~" : Combinator.sibling }
+
 class Tran:
     """A generic CSS automaton transition"""
     def __init__(self, q1, arrow, node_selector, q2):
         """:param q1:
-                The source state (as State)
+                The source state (as int)
            :param arrow:
                 The type of arrow labelling the transition (as Arrow)
            :param node_selector:
                 A cssselect selector with no sibling or descendant combinators
            :param q2:
-                The target state (as State)
+                The target state (as int)
         """
         self.q1 = q1
         self.arrow = arrow
@@ -199,11 +509,9 @@ class Tran:
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            # the use of str is a bit of a hack, but if the cssselect library
-            # didn't implement __eq__...
             return (self.q1 == other.q1 and
                     self.arrow == other.arrow and
-                    str(self.node_selector) == str(other.node_selector) and
+                    self.node_selector == other.node_selector and
                     self.q2 == other.q2)
         else:
             return False
@@ -219,19 +527,23 @@ class Tran:
                 hash(self.q2))
 
     def __str__(self):
-        return (str(self.q1) +
+        return (_state_str(self.q1) +
                 "-- " +
                 str(self.arrow) +
                 ", " +
                 str(self.node_selector) +
                 " --> " +
-                str(self.q2))
+                _state_str(self.q2))
+
+def _state_str(q):
+    """:returns: the name q<n> of the state q"""
+    return "q" + str(q)
 
 class CSSComponents:
     """A class to hold information about a CSSAutomaton:
 
         num_trans -- the number of transitions in the automaton
-        states -- the set of states as State
+        states -- the set of states as int
         namespaces -- the set of namespaces as Strings appearing in the
                       selectors
         elements -- the set of elements as Strings appearing in the
@@ -245,51 +557,123 @@ class CSSComponents:
         self.ids = set([])
 
 class CSSAutomaton:
-    _nextstate = 0
 
     def __init__(self, namespaces = {}):
         """An empty CSS automaton
 
+        States are the ints 0 to num_states() - 1.  The transitions into a
+        state q are given by the parallel lists srcs[q], arrows[q] and sels[q]
+        of their source states, Arrows and node selectors, where node
+        selectors are indexes into the selectors table.
+
         :param namespaces:
             A dict of 'namespace' : 'uri' pairs to use in selector evaluation
         """
-        # map from q to trans to q
-        self.trans = defaultdict(set)
-        # map from q to trans from q
-        self.trans_fwd = defaultdict(set)
+        # lists indexed by target state of lists of transition parts
+        self.srcs = []
+        self.arrows = []
+        self.sels = []
+        # table of the (interned) node selectors of transitions and map from
+        # node selector to its index in the table
+        self.selectors = []
+        self.selector_ids = dict()
         self.namespaces = namespaces
         self.qinit = None
         self.qfinal = None
 
+    def num_states(self):
+        """:returns: the number of states of the automaton"""
+        return len(self.srcs)
+
+    def num_trans(self):
+        """:returns: the number of transitions of the automaton"""
+        return sum(len(srcs) for srcs in self.srcs)
+
+    def ensure_states(self, n):
+        """Makes sure the automaton has (at least) the states 0 to n - 1
+
+        :param n:
+            The number of states needed
+        """
+        while len(self.srcs) < n:
+            self.srcs.append([])
+            self.arrows.append([])
+            self.sels.append([])
+
+    def selector_id(self, node_selector):
+        """
+        :param node_selector:
+            A cssselect selector with no sibling or descendant combinators
+        :returns:
+            The index of (the interned version of) node_selector in the
+            selectors table, adding it if needed
+        """
+        node_selector = cssselect_parser.intern_selector(node_selector)
+        i = self.selector_ids.get(node_selector)
+        if i is None:
+            i = len(self.selectors)
+            self.selectors.append(node_selector)
+            self.selector_ids[node_selector] = i
+        return i
+
     def add_tran(self, tran):
         """Add a new transition to the automaton
 
         :param tran:
             The new transition as a Tran
         """
-        self.trans[tran.q2].add(tran)
-        self.trans_fwd[tran.q1].add(tran)
+        self.add_indexed_tran(tran.q1,
+                              tran.arrow,
+                              self.selector_id(tran.node_selector),
+                              tran.q2)
+
+    def add_indexed_tran(self, q1, arrow, i, q2):
+        """Add a new transition to the automaton unless it already has it
+
+        :param q1:
+            The source state
+        :param arrow:
+            The Arrow of the transition
+        :param i:
+            The index of the node selector in the selectors table
+        :param q2:
+            The target state
+        """
+        self.ensure_states(max(q1, q2) + 1)
+        srcs = self.srcs[q2]
+        arrows = self.arrows[q2]
+        sels = self.sels[q2]
+        for k in xrange(len(srcs)):
+            if srcs[k] == q1 and sels[k] == i and arrows[k] == arrow:
+                return
+        srcs.append(q1)
+        arrows.append(arrow)
+        sels.append(i)
 
     def trans_from(self, q):
-        """Returns the set of transitions from a given state.
+        """Returns the set of transitions from a given state.  Transitions
+        are stored by target state, so this looks through all of them.
 
         :param q:
-            The State to get the transitions from.
+            The state to get the transitions from.
         :returns:
             The set of transitions (as Tran) from q
         """
-        return self.trans_fwd[q]
+        return set(t for t in self if t.q1 == q)
 
     def accepts(self, node):
         """Detects if the node of an XML document is accepted by the automaton.
-        The CSS matching in this method is quite inefficient, so probably only
-        really good for testing purposes (but that's all we need it for anyway).
+        Each node selector is compiled once (see _node_matcher) and tested on
+        single nodes, but for many nodes of one document accepts_all is
+        faster.
 
         :param node:
             The node to test, as a Element from etree in lxml
         :returns:
             True iff the node is accepted
         """
+        matchers = [ _node_matcher(sel, self.namespaces, "self::")
+                     for sel in self.selectors ]
         # worklist of (node, state) pairs, repeat until empty or we find
         # (root, init)
         worklist = set([(node, self.qfinal)])
@@ -297,24 +681,25 @@ class CSSAutomaton:
         while len(worklist) > 0:
             (n, q) = worklist.pop()
             donelist.add((n, q))
-            for t in self.trans[q]:
+            if q >= len(self.srcs):
+                continue
+            for (q1, arrow, i) in izip(self.srcs[q],
+                                       self.arrows[q],
+                                       self.sels[q]):
                 next_n = None
-                next_q = t.q1
+                next_q = q1
 
-                if t.arrow == Arrow.child:
+                if arrow == Arrow.child:
                     next_n = n.getparent()
-                elif t.arrow == Arrow.neighbour:
-                    next_n = n.getprevious()
-                elif t.arrow == Arrow.sibling:
-                    next_n = n.getprevious()
-                    next_q = t.q2
-                elif t.arrow == Arrow.noop:
+                elif arrow == Arrow.neighbour:
+                    next_n = _previous_element(n)
+                elif arrow == Arrow.sibling:
+                    next_n = _previous_element(n)
+                    next_q = q
+                elif arrow == Arrow.noop:
                     next_n = n
 
-                # this seems quite inefficient... (esp getroottree...)
-                matcher = CSSSelector(cssfile.selector_str(t.node_selector),
-                                      namespaces=self.namespaces)
-                if next_n is not None and next_n in matcher(next_n.getroottree()):
+                if next_n is not None and len(matchers[i](next_n)) > 0:
                     if (next_n.getparent() is None and
                         next_q == self.qinit):
                         return True
@@ -322,6 +707,75 @@ class CSSAutomaton:
                         worklist.add((next_n, next_q))
         return False
 
+    def accepts_all(self, document):
+        """Finds all nodes of an XML document accepted by the automaton in
+        one pass over the document.  Each node selector is matched against the
+        whole document once.
+
+        The pass computes, in document order, the set of states each element
+        can be in on a path from (root, qinit).  An element gets states from
+        its parent (child arrows), its previous sibling element (neighbour and
+        sibling arrows) and itself (noop arrows).  It is accepted iff it can
+        be in qfinal.
+
+        :param document:
+            An ElementTree from etree in lxml, or an Element of one (the
+            whole tree is searched)
+        :returns:
+            The list of accepted nodes as Element, in document order
+        """
+        if not hasattr(document, "getroot"):
+            document = document.getroottree()
+        root = document.getroot()
+
+        # list over selector indexes of the set of nodes matched
+        matched = [ set(_node_matcher(sel,
+                                      self.namespaces,
+                                      "descendant-or-self::")(root))
+                    for sel in self.selectors ]
+
+        # lists over target states of (q1, arrow, i) of transitions by arrow
+        by_arrow = { arrow : [ [] for q in xrange(len(self.srcs)) ]
+                     for arrow in Arrow }
+        for (q2, srcs) in enumerate(self.srcs):
+            for (q1, arrow, i) in izip(srcs, self.arrows[q2], self.sels[q2]):
+                by_arrow[arrow][q2].append((q1, i))
+
+        # map from node to the bitmask of states the node can be in
+        states = dict()
+        accepted = []
+        for n in root.iter(tag = etree.Element):
+            mask = (1 << self.qinit) if n is root else 0
+            parent = n.getparent()
+            prev = _previous_element(n)
+            for q2 in xrange(len(self.srcs)):
+                if parent is not None:
+                    for (q1, i) in by_arrow[Arrow.child][q2]:
+                        if (states[parent] >> q1) & 1 and parent in matched[i]:
+                            mask |= 1 << q2
+                if prev is not None:
+                    for (q1, i) in by_arrow[Arrow.neighbour][q2]:
+                        if (states[prev] >> q1) & 1 and prev in matched[i]:
+                            mask |= 1 << q2
+                    for (q1, i) in by_arrow[Arrow.sibling][q2]:
+                        if (states[prev] >> q2) & 1 and prev in matched[i]:
+                            mask |= 1 << q2
+            # noop transitions stay on the node, so close under them
+            changed = True
+            while changed:
+                changed = False
+                for q2 in xrange(len(self.srcs)):
+                    if not (mask >> q2) & 1:
+                        for (q1, i) in by_arrow[Arrow.noop][q2]:
+                            if (mask >> q1) & 1 and n in matched[i]:
+                                mask |= 1 << q2
+                                changed = True
+                                break
+            states[n] = mask
+            if (mask >> self.qfinal) & 1:
+                accepted.append(n)
+        return accepted
+
     def components(self):
         """This method computes the sets of components on each call.
 
@@ -329,13 +783,14 @@ class CSSAutomaton:
             A completed CSSAutomatonComponents object for the aut
         """
         comps = CSSComponents()
-        comps.num_trans = sum([len(ts) for ts in self.trans.values()])
+        comps.num_trans = self.num_trans()
         comps.states.add(self.qinit)
         comps.states.add(self.qfinal)
-        for t in self:
-            comps.states.add(t.q1)
-            comps.states.add(t.q2)
-            sel = t.node_selector
+        for (q, srcs) in enumerate(self.srcs):
+            if len(srcs) > 0:
+                comps.states.add(q)
+                comps.states.update(srcs)
+        for sel in self.selectors:
             while True:
                 s = (sel if type(sel).__name__ != "Negation"
                          else sel.subselector)
@@ -359,8 +814,8 @@ class CSSAutomaton:
     # only weakly protected so test.py can use it
     def _new_state(self):
         """Returns a fresh state, for use in automaton construction"""
-        state = State("q" + str(self._nextstate))
-        self._nextstate += 1
+        state = len(self.srcs)
+        self.ensure_states(state + 1)
         return state
 
     def __eq__(self, other):
@@ -368,7 +823,7 @@ class CSSAutomaton:
             return (self.qinit == other.qinit and
                     self.qfinal == other.qfinal and
                     self.namespaces == other.namespaces and
-                    self.trans == other.trans)
+                    set(self) == set(other))
         else:
             return False
 
@@ -376,8 +831,8 @@ class CSSAutomaton:
         return not self.__eq__(other)
 
     def __str__(self):
-        lines = ["Init: " + str(self.qinit),
-                 "Final: " + str(self.qfinal),
+        lines = ["Init: " + _state_str(self.qinit),
+                 "Final: " + _state_str(self.qfinal),
                  "Namespaces: " + str(self.namespaces),
                  ""]
         for t in self:
@@ -389,9 +844,9 @@ class CSSAutomaton:
 
     def __iter__(self):
         """iterates over Tran-s of automaton"""
-        for _, ts in self.trans.items():
-            for t in ts:
-                yield t
+        for (q2, srcs) in enumerate(self.srcs):
+            for (q1, arrow, i) in izip(srcs, self.arrows[q2], self.sels[q2]):
+                yield Tran(q1, arrow, self.selectors[i], q2)
 
 def __build_aut_from_selector(aut, selector, qin, qout, combinator):
     """Fills in the aut object with transitions to represent selector, recursive.
@@ -413,12 +868,7 @@ def __build_aut_from_selector(aut, selector, qin, qout, combinator):
     stype = type(selector).__name__
     if stype == "CombinedSelector":
         qmid = aut._new_state()
-        new_combinator = {
-            ">" : Combinator.child,
-            " " : Combinator.descendant,
-            "+" : Combinator.neighbour,
-            "~" : Combinator.sibling
-            }[selector.combinator]
+        new_combinator = _combinators[selector.combinator]
         __build_aut_from_selector(aut,
                                   selector.selector,
                                   qin,
@@ -430,70 +880,73 @@ def __build_aut_from_selector(aut, selector, qin, qout, combinator):
         qstart = qin
         node_selector = selector
 
+    __add_node_selector_trans(aut,
+                              qstart,
+                              aut.selector_id(node_selector),
+                              qout,
+                              combinator)
+
+def __add_node_selector_trans(aut, qstart, sel, qout, combinator):
+    """Adds the transitions for a node selector followed by a combinator
+
+    :param aut:
+        A CSSAutomaton to add the transitions to
+    :param qstart:
+        The State before the node selector
+    :param sel:
+        The index of the node selector in the selectors table of aut
+    :param qout:
+        The State after the combinator
+    :param combinator:
+        The Combinator to the right of the node selector
+    """
+    isany = aut.selector_id(_isany)
+
     if combinator == Combinator.child:
-        aut.add_tran(Tran(qstart, Arrow.child, node_selector, qout))
+        aut.add_indexed_tran(qstart, Arrow.child, sel, qout)
         qloop = aut._new_state()
-        aut.add_tran(Tran(qstart, Arrow.child, node_selector, qloop))
-        aut.add_tran(Tran(qloop, Arrow.sibling, _isany, qloop))
-        aut.add_tran(Tran(qloop, Arrow.neighbour, _isany, qout))
+        aut.add_indexed_tran(qstart, Arrow.child, sel, qloop)
+        aut.add_indexed_tran(qloop, Arrow.sibling, isany, qloop)
+        aut.add_indexed_tran(qloop, Arrow.neighbour, isany, qout)
     elif combinator == Combinator.descendant:
-        aut.add_tran(Tran(qstart, Arrow.child, node_selector, qout))
+        aut.add_indexed_tran(qstart, Arrow.child, sel, qout)
         qloop = aut._new_state()
-        aut.add_tran(Tran(qstart, Arrow.child, node_selector, qloop))
-        aut.add_tran(Tran(qloop, Arrow.sibling, _isany, qloop))
-        aut.add_tran(Tran(qloop, Arrow.child, _isany, qloop))
-        aut.add_tran(Tran(qloop, Arrow.neighbour, _isany, qout))
-        aut.add_tran(Tran(qloop, Arrow.child, _isany, qout))
+        aut.add_indexed_tran(qstart, Arrow.child, sel, qloop)
+        aut.add_indexed_tran(qloop, Arrow.sibling, isany, qloop)
+        aut.add_indexed_tran(qloop, Arrow.child, isany, qloop)
+        aut.add_indexed_tran(qloop, Arrow.neighbour, isany, qout)
+        aut.add_indexed_tran(qloop, Arrow.child, isany, qout)
     elif combinator == Combinator.neighbour:
-        aut.add_tran(Tran(qstart, Arrow.neighbour, node_selector, qout))
+        aut.add_indexed_tran(qstart, Arrow.neighbour, sel, qout)
     elif combinator == Combinator.sibling:
-        aut.add_tran(Tran(qstart, Arrow.neighbour, node_selector, qout))
+        aut.add_indexed_tran(qstart, Arrow.neighbour, sel, qout)
         qloop = aut._new_state()
-        aut.add_tran(Tran(qstart, Arrow.neighbour, node_selector, qloop))
-        aut.add_tran(Tran(qloop, Arrow.sibling, _isany, qloop))
-        aut.add_tran(Tran(qloop, Arrow.neighbour, _isany, qout))
+        aut.add_indexed_tran(qstart, Arrow.neighbour, sel, qloop)
+        aut.add_indexed_tran(qloop, Arrow.sibling, isany, qloop)
+        aut.add_indexed_tran(qloop, Arrow.neighbour, isany, qout)
     elif combinator == Combinator.noop:
-        aut.add_tran(Tran(qstart, Arrow.noop, node_selector, qout))
+        aut.add_indexed_tran(qstart, Arrow.noop, sel, qout)
     else:
         raise CSSAutConstructionException("Unrecognised combinator '" +
                                           combinator +
                                           "'")
-def _product_states(q1, q2):
-    """Form the product of q1 and q2
+def _product_arrows(arrow1, arrow2):
+    """Form the product of two transition arrows
 
-    :param q1:
-        The first State
-    :param q2:
-        The second State
+    :param arrow1:
+        The first Arrow
+    :param arrow2:
+        The second Arrow
     :returns:
-        A State for q1xq2
+        The Arrow of the intersection of transitions labelled by arrow1 and
+        arrow2, or None if they aren't compatible
     """
-    return State("(" + q1.name + "," + q2.name + ")")
-
-def _product_trans(t1, t2):
-    """Form the product of t1 and t2
-
-    :param t1:
-        The first Tran
-    :param t2:
-        The second Tran
-    :returns:
-        A new Tran that is the intersection of t1 and t2 or None if
-        the transitions aren't compatible
-    """
-    q1 = _product_states(t1.q1, t2.q1)
-    q2 = _product_states(t1.q2, t2.q2)
-    node_selector = _product_selectors(t1.node_selector,
-                                       t2.node_selector)
-    if node_selector is None:
-        return None
-
-    if t1.arrow == t2.arrow:
-        return Tran(q1, t1.arrow, node_selector, q2)
-    elif t1.arrow == Arrow.neighbour and t2.arrow == Arrow.sibling:
-        return Tran(q1, Arrow.neighbour, node_selector, q2)
-    elif t1.arrow == Arrow.sibling and t2.arrow == Arrow.neighbour:
-        return Tran(q1, Arrow.neighbour, node_selector, q2)
+    if arrow1 == arrow2:
+        return arrow1
+    elif arrow1 == Arrow.neighbour and arrow2 == Arrow.sibling:
+        return Arrow.neighbour
+    elif arrow1 == Arrow.sibling and arrow2 == Arrow.neighbour:
+        return Arrow.neighbour
     else:
         return None
 
@@ -199,18 +199,38 @@ def get_fun_sel_coefs(sel):
 class CSSRule:
     """Representation of a CSS rule"""
 
-    def __init__(self, selectors, declarations):
-        self.__selectors = frozenset(selectors)
+    def __init__(self, selectors, declarations, important = None):
+        """
+        :param selectors:
+            The cssselect Selectors of the rule in the order they appear
+        :param declarations:
+            A list of pairs (p, v) of strings property and value
+        :param important:
+            A list of booleans, True at the index of each declaration that
+            is !important, or None if none of them are
+        """
+        self.__selectors = tuple(selectors)
         self.__declarations = declarations
+        self.__important = (important
+                            if important is not None
+                            else [False] * len(declarations))
 
     def get_selectors(self):
-        """:returns: set of cssselect parsed_tree selectors"""
+        """:returns: tuple of cssselect Selectors in the order of the rule"""
         return self.__selectors
 
     def get_declarations(self):
         """:returns: set of pairs (p, v) for as strings for propert and value"""
         return self.__declarations
 
+    def get_important(self):
+        """
+        :returns:
+            list of booleans, True at the index in get_declarations() of each
+            !important declaration
+        """
+        return self.__important
+
     def __str__(self):
         return (",".join([selector_str(s.parsed_tree) for s in self.__selectors]) +
                 "{" +
@@ -224,7 +244,7 @@ class CSSRule:
                 set(self.__declarations) == set(other.__declarations))
 
     def __hash__(self):
-        return hash(self.__selectors) + hash(self.__declarations)
+        return hash(frozenset(self.__selectors)) + hash(self.__declarations)
 
 
 class CSSFile:
@@ -261,7 +281,9 @@ class CSSFile:
         else:
             self.first_rule_idx = first_rule_idx
             self.last_rule_idx = last_rule_idx
-        (self.props, self.rules) = self.__build_data_structures(multiprop)
+        (self.props,
+         self.rules,
+         self.line_rules) = self.__build_data_structures(multiprop)
         self.multiprop = multiprop
 
     def is_multiprop():
@@ -338,6 +360,29 @@ class CSSFile:
         """:returns: set of CSSRules"""
         return self.rules
 
+    def get_rule_index(self, line_no):
+        """
+        :param line_no:
+            A line number as returned by get_info
+        :returns:
+            The index in get_rules() of the rule the line belongs to
+        """
+        return self.line_rules[line_no - 1]
+
+    def get_rule_keys(self):
+        """
+        :returns:
+            A list of hashable keys, one for each rule in get_rules() and in
+            the same order, such that two keys are equal iff the rules have
+            the same selectors and declarations (including !important)
+        """
+        return [ (rule.selector.as_css(),
+                  tuple((decl.name, decl.value.as_css(), decl.priority)
+                        for decl in rule.declarations))
+                 for rule in islice(self.stylesheet.rules,
+                                    self.first_rule_idx,
+                                    self.last_rule_idx) ]
+
     def split_css(self, size):
         """
         :param size:
@@ -403,7 +448,7 @@ class CSSFile:
         :param multiprop:
             As in __init__
         :returns:
-            (props, rules)
+            (props, rules, line_rules)
 
             props is dict from
                 prop_name (string) ->
@@ -416,17 +461,20 @@ class CSSFile:
                                          and is last occurrence of sel, v in file)
                                 boolean -- True if rule appears only once in file
 
-            rules is set of pairs (S, P) where S is set of cssselect parsed_tree
-            selectors and props is a set of pairs (p, v) of strings property and
-            value
+            rules is a list of CSSRule, with their selectors in order and
+            declarations as pairs (p, v) of strings property and value
+
+            line_rules is a list giving at line_no - 1 the index in rules of
+            the rule the line_no belongs to
         """
         props = defaultdict(lambda : defaultdict(dict))
         rules = list()
+        line_rules = list()
         line_no = 1
         for rule in islice(self.stylesheet.rules,
                            self.first_rule_idx,
                            self.last_rule_idx):
-            sels = set()
+            sels = list()
             declarations = None
             if not multiprop:
                 declarations = rule.declarations
@@ -450,9 +498,12 @@ class CSSFile:
             decls = [ (decl.name,
                        self.__normalise_css_value(decl.value.as_css()))
                       for decl in rule.declarations ]
+            important = [ decl.priority is not None
+                          for decl in rule.declarations ]
 
             for sel in self.__parse_selector(rule.selector):
-                sels.add(sel)
+                if sel not in sels:
+                    sels.append(sel)
                 for decl in declarations:
                     v = self.__normalise_css_value(decl.value.as_css())
                     specificity = (decl.priority is not None,
@@ -460,11 +511,12 @@ class CSSFile:
                     tup = (sel.parsed_tree, v)
                     m = props[decl.name][specificity]
                     m[tup] = (line_no, not tup in m)
+                    line_rules.append(len(rules))
                     line_no += 1
 
-            rules.append(CSSRule(sels, decls))
+            rules.append(CSSRule(sels, decls, important))
 
-        return (props, rules)
+        return (props, rules, line_rules)
 
     def __normalise_css_value(self, value):
         """At the moment this does nothing but remove unicode, but should really
@@ -21,6 +21,7 @@
 import sys
 import re
 import operator
+import weakref
 
 if sys.version_info[0] < 3:
     _unicode = unicode
@@ -109,10 +110,109 @@ class Selector(object):
         return a, b, c
 
 
-class Class(object):
+class SelectorNode(object):
+    """
+    Base class of the nodes of a parsed selector tree.
+
+    Equality and hashing are structural over the attributes named in
+    ``_fields``.  Trees returned by :func:`parse` are interned by
+    :func:`intern_selector`: structurally equal trees are the same immutable
+    object, with a precomputed hash and specificity, so comparing two
+    interned trees is an identity check.  ``copy.copy`` of an interned node
+    gives an ordinary mutable node.
+    """
+    _fields = ()
+
+    def _key(self):
+        return (self.__class__.__name__,) + tuple(
+            _freeze(getattr(self, f)) for f in self._fields)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, self.__class__):
+            return False
+        if (self.__dict__.get('_interned', False) and
+                other.__dict__.get('_interned', False)):
+            return False
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        h = self.__dict__.get('_hash')
+        if h is None:
+            h = hash(self._key())
+        return h
+
+    def specificity(self):
+        spec = self.__dict__.get('_specificity')
+        if spec is None:
+            spec = self._compute_specificity()
+        return spec
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_interned', False):
+            raise AttributeError('Interned selectors are immutable')
+        object.__setattr__(self, name, value)
+
+    def __copy__(self):
+        cpy = self.__class__.__new__(self.__class__)
+        for f in self._fields:
+            object.__setattr__(cpy, f, getattr(self, f))
+        return cpy
+
+
+def _freeze(value):
+    """Hashable form of a node attribute: argument token lists become tuples
+    of (type, value) pairs."""
+    if isinstance(value, (list, tuple)):
+        return tuple((token.type, token.value) for token in value)
+    return value
+
+
+# map from node keys to the interned node
+_interned_nodes = weakref.WeakValueDictionary()
+
+def intern_selector(tree):
+    """
+    Returns the interned version of a parsed selector tree.
+
+    :param tree:
+        A parsed tree (e.g. ``Selector.parsed_tree``)
+    :returns:
+        The unique immutable tree structurally equal to ``tree``
+    """
+    if tree.__dict__.get('_interned', False):
+        return tree
+    values = []
+    for f in tree._fields:
+        value = getattr(tree, f)
+        if isinstance(value, SelectorNode):
+            value = intern_selector(value)
+        elif isinstance(value, list):
+            value = tuple(value)
+        values.append(value)
+    key = (tree.__class__.__name__,) + tuple(_freeze(v) for v in values)
+    node = _interned_nodes.get(key)
+    if node is None:
+        node = tree.__class__.__new__(tree.__class__)
+        for (f, value) in zip(tree._fields, values):
+            object.__setattr__(node, f, value)
+        object.__setattr__(node, '_hash', hash(key))
+        object.__setattr__(node, '_specificity', node._compute_specificity())
+        object.__setattr__(node, '_interned', True)
+        _interned_nodes[key] = node
+    return node
+
+
+class Class(SelectorNode):
     """
     Represents selector.class_name
     """
+    _fields = ('selector', 'class_name')
+
     def __init__(self, selector, class_name):
         self.selector = selector
         self.class_name = class_name
@@ -121,21 +221,11 @@ class Class(object):
         return '%s[%r.%s]' % (
             self.__class__.__name__, self.selector, self.class_name)
 
-    def specificity(self):
+    def _compute_specificity(self):
         a, b, c = self.selector.specificity()
         b += 1
         return a, b, c
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.class_name == other.class_name)
-        else:
-            return False
-
-    def __hash__(self):
-        return hash(self.selector) + hash(self.class_name)
-
 
 class FunctionalPseudoElement(object):
     """
@@ -183,10 +273,12 @@ class FunctionalPseudoElement(object):
 
 
 
-class Function(object):
+class Function(SelectorNode):
     """
     Represents selector:name(expr)
     """
+    _fields = ('selector', 'name', 'arguments')
+
     def __init__(self, selector, name, arguments):
         self.selector = selector
         self.name = ascii_lower(name)
@@ -200,28 +292,19 @@ class Function(object):
     def argument_types(self):
         return [token.type for token in self.arguments]
 
-    def specificity(self):
+    def _compute_specificity(self):
         a, b, c = self.selector.specificity()
         b += 1
         return a, b, c
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.name == other.name and
-                    self.arguments == other.arguments)
-        else:
-            return False
-
-    def __hash__(self):
-        return hash(self.selector) + hash(self.name) + len(self.arguments)
 
 
-
-class Pseudo(object):
+class Pseudo(SelectorNode):
     """
     Represents selector:ident
     """
+    _fields = ('selector', 'ident')
+
     def __init__(self, selector, ident):
         self.selector = selector
         self.ident = ascii_lower(ident)
@@ -230,26 +313,18 @@ class Pseudo(object):
         return '%s[%r:%s]' % (
             self.__class__.__name__, self.selector, self.ident)
 
-    def specificity(self):
+    def _compute_specificity(self):
         a, b, c = self.selector.specificity()
         b += 1
         return a, b, c
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.ident == other.ident)
-        else:
-            return False
-
-    def __hash__(self):
-        return hash(self.selector) + hash(self.ident)
-
 
-class Negation(object):
+class Negation(SelectorNode):
     """
     Represents selector:not(subselector)
     """
+    _fields = ('selector', 'subselector')
+
     def __init__(self, selector, subselector):
         self.selector = selector
         self.subselector = subselector
@@ -258,27 +333,19 @@ class Negation(object):
         return '%s[%r:not(%r)]' % (
             self.__class__.__name__, self.selector, self.subselector)
 
-    def specificity(self):
+    def _compute_specificity(self):
         a1, b1, c1 = self.selector.specificity()
         a2, b2, c2 = self.subselector.specificity()
         return a1 + a2, b1 + b2, c1 + c2
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.subselector == other.subselector)
-        else:
-            return False
-
-    def __hash__(self):
-        return hash(self.selector) + hash(self.subselector)
-
 
 
-class Attrib(object):
+class Attrib(SelectorNode):
     """
     Represents selector[namespace|attrib operator value]
     """
+    _fields = ('selector', 'namespace', 'attrib', 'operator', 'value')
+
     def __init__(self, selector, namespace, attrib, operator, value):
         self.selector = selector
         self.namespace = namespace
@@ -299,37 +366,22 @@ class Attrib(object):
                 self.__class__.__name__, self.selector, attrib,
                 self.operator, self.value)
 
-    def specificity(self):
+    def _compute_specificity(self):
         a, b, c = self.selector.specificity()
         b += 1
         return a, b, c
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.namespace == other.namespace and
-                    self.attrib == other.attrib and
-                    self.operator == other.operator and
-                    self.value == other.value)
-        else:
-            return False
-
-    def __hash__(self):
-        return (hash(self.selector) +
-                hash(self.namespace) +
-                hash(self.attrib) +
-                hash(self.operator) +
-                hash(self.value))
-
 
 
-class Element(object):
+class Element(SelectorNode):
     """
     Represents namespace|element
 
     `None` is for the universal selector '*'
 
     """
+    _fields = ('namespace', 'element')
+
     def __init__(self, namespace=None, element=None):
         self.namespace = namespace
         self.element = element
@@ -340,26 +392,18 @@ class Element(object):
             element = '%s|%s' % (self.namespace, element)
         return '%s[%s]' % (self.__class__.__name__, element)
 
-    def specificity(self):
+    def _compute_specificity(self):
         if self.element:
             return 0, 0, 1
         else:
             return 0, 0, 0
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.namespace == other.namespace and
-                    self.element == other.element)
-        else:
-            return False
-
-    def __hash__(self):
-        return (hash(self.namespace) + hash(self.element))
-
-class Hash(object):
+class Hash(SelectorNode):
     """
     Represents selector#id
     """
+    _fields = ('selector', 'id')
+
     def __init__(self, selector, id):
         self.selector = selector
         self.id = id
@@ -368,24 +412,16 @@ class Hash(object):
         return '%s[%r#%s]' % (
             self.__class__.__name__, self.selector, self.id)
 
-    def specificity(self):
+    def _compute_specificity(self):
         a, b, c = self.selector.specificity()
         a += 1
         return a, b, c
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.id == other.id)
-        else:
-            return False
-
-    def __hash__(self):
-        return (hash(self.selector) + hash(self.id))
 
 
+class CombinedSelector(SelectorNode):
+    _fields = ('selector', 'combinator', 'subselector')
 
-class CombinedSelector(object):
     def __init__(self, selector, combinator, subselector):
         assert selector is not None
         self.selector = selector
@@ -400,24 +436,11 @@ class CombinedSelector(object):
         return '%s[%r %s %r]' % (
             self.__class__.__name__, self.selector, comb, self.subselector)
 
-    def specificity(self):
+    def _compute_specificity(self):
         a1, b1, c1 = self.selector.specificity()
         a2, b2, c2 = self.subselector.specificity()
         return a1 + a2, b1 + b2, c1 + c2
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (self.selector == other.selector and
-                    self.combinator == other.combinator and
-                    self.subselector == other.subselector)
-        else:
-            return False
-
-    def __hash__(self):
-        return (hash(self.selector) +
-                hash(self.combinator) +
-                hash(self.subselector))
-
 #### Parser
 
 # foo
@@ -449,19 +472,22 @@ def parse(css):
     # Fast path for simple cases
     match = _el_re.match(css)
     if match:
-        return [Selector(Element(element=match.group(1)))]
+        return [Selector(intern_selector(Element(element=match.group(1))))]
     match = _id_re.match(css)
     if match is not None:
-        return [Selector(Hash(Element(element=match.group(1) or None),
-                              match.group(2)))]
+        return [Selector(intern_selector(
+                    Hash(Element(element=match.group(1) or None),
+                         match.group(2))))]
     match = _class_re.match(css)
     if match is not None:
-        return [Selector(Class(Element(element=match.group(1) or None),
-                               match.group(2)))]
+        return [Selector(intern_selector(
+                    Class(Element(element=match.group(1) or None),
+                          match.group(2))))]
 
     stream = TokenStream(tokenize(css))
     stream.source = css
-    return list(parse_selector_group(stream))
+    return [ Selector(intern_selector(sel.parsed_tree), sel.pseudo_element)
+             for sel in parse_selector_group(stream) ]
 #    except SelectorSyntaxError:
 #        e = sys.exc_info()[1]
 #        message = "%s at %s -> %r" % (
@@ -4,13 +4,20 @@
    If no file is provided, selectors are read from STDIN in pairs, and E output if the intersection is empty (else N).  In this mode send "." to flush the buffers.
 
 Usage:
-  main.py [-ps] [<file>]
+  main.py [-ps] [-j <n>] [-c <cache>] [--memo=<n>] [--automata-memo=<n>] [--incremental-z3] [--stream] [<file>]
   main.py (-h | --help)
   main.py --version
 
 Options:
   -p --multi-props          Combines multiply defined properties into a single value (e.g. { background: red; background: white } becomes { background: red;white }
-  -s --stats                Output stats about simpleCSS construction
+  -s --stats                Output stats about simpleCSS construction as JSON
+  -j <n> --jobs=<n>         Number of processes for selector overlap checks [default: 1]
+  -c <cache> --cache=<cache>
+                            Keep selector overlap results in the given file across runs
+  --memo=<n>                Number of selector pair results to keep in memory [default: 1000000]
+  --automata-memo=<n>       Number of selector automaton transitions to keep in memory [default: 200000]
+  --incremental-z3          Decide position constraints with one Z3 solver using guard literals rather than pushing and popping per query
+  --stream                  Write the abstraction as it is built rather than building it in memory first (order is not transitively closed, ignores -j, stats go to STDERR)
   --version                 Show the version.
 """
 
@@ -21,6 +28,8 @@ from timeit import default_timer
 
 import simplecssbuilder
 import cssfile
+import buildprofile
+import autemptiness
 
 def emptiness_mode():
     """Runs in a loop, reading two selectors from stdin (on two lines), and
@@ -32,6 +41,7 @@ def emptiness_mode():
             if sel1 == "":
                 break
             if sel1.strip() == ".":
+                simplecssbuilder.flush_overlap_cache()
                 sys.stdout.flush()
                 continue
             sel2 = sys.stdin.readline()
@@ -53,14 +63,20 @@ def build_mode(output_stats):
                            arguments['--multi-props'])
     mid_time = default_timer()
 
-    simple_css = simplecssbuilder.fromcssfile(css)
-
-    end_time = default_timer()
-
+    if arguments['--stream']:
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            simplecssbuilder.write_stream(css, sys.stdout)
+        if output_stats:
+            profile.add_time("parse", mid_time - start_time)
+            sys.stderr.write(profile.to_json() + "\n")
+        return
+
+    simple_css = simplecssbuilder.fromcssfile(css,
+                                              int(arguments['--jobs']))
     if output_stats:
-        print "CSS read in", (mid_time - start_time), "s."
-        print "Simple CSS built in", (end_time - mid_time), "s."
-        print "Number of dependencies is", len(simple_css.getEdgeSet())
+        simple_css.profile.add_time("parse", mid_time - start_time)
+        print simple_css.profile.to_json()
     else:
         print str(simple_css)
 
@@ -70,8 +86,16 @@ if __name__ == "__main__":
     sys.setdefaultencoding("utf-8")
     arguments = docopt(__doc__, version='v0.1')
 
+    simplecssbuilder.use_overlap_cache(arguments['--cache'])
+    simplecssbuilder.overlap_memo_budget = int(arguments['--memo'])
+    simplecssbuilder.automata_memo_budget = int(arguments['--automata-memo'])
+    autemptiness.incremental_z3 = arguments['--incremental-z3']
+    simplecssbuilder.reset_selectors_overlap_memo()
+
     if arguments['<file>'] is None:
         emptiness_mode()
     else:
         output_stats = arguments['--stats']
         build_mode(output_stats)
+
+    simplecssbuilder.use_overlap_cache(None)
@@ -0,0 +1,88 @@
+"""Bounded in-memory memo tables with least-recently-used eviction, so that
+long running processes do not grow without limit"""
+
+from collections import OrderedDict
+
+class MemoCache:
+    """A map with a budget on its total size.  Each entry has a size given by
+    a weight function (1 by default, so the budget is a number of entries).
+    When an insertion takes the total over the budget, the least recently used
+    entries are evicted until it fits again.
+
+    Counts hits, misses and evictions.
+    """
+
+    def __init__(self, budget = None, weight = None):
+        """
+        :param budget:
+            The maximum total size of the entries, or None for no limit
+        :param weight:
+            A function from a value to its (positive integer) size, or None to
+            count each entry as 1
+        """
+        self.budget = budget
+        self.weight = weight
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # map from key to (value, size), oldest use first
+        self.__entries = OrderedDict()
+
+    def get(self, key):
+        """
+        :param key:
+            The key to look up
+        :returns:
+            The value stored for key (marking it as recently used), or None if
+            there is none
+        """
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value):
+        """Stores a value, evicting old entries if over budget.  A value larger
+        than the whole budget is not stored.
+
+        :param key:
+            The key to store under
+        :param value:
+            The value to store, not None
+        """
+        size = 1 if self.weight is None else self.weight(value)
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if self.budget is not None and size > self.budget:
+            return
+        self.__entries[key] = (value, size)
+        self.size += size
+        if self.budget is not None:
+            while self.size > self.budget:
+                (_, (_, old_size)) = self.__entries.popitem(last = False)
+                self.size -= old_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        """Membership test, does not affect recency or counters"""
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        """
+        :returns:
+            A dict of the hits, misses, evictions, entries and size of the
+            cache
+        """
+        return { "hits" : self.hits,
+                 "misses" : self.misses,
+                 "evictions" : self.evictions,
+                 "entries" : len(self.__entries),
+                 "size" : self.size }
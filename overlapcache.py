@@ -0,0 +1,121 @@
+"""A persistent on-disk cache of selector overlap results, shared between runs
+and between build processes"""
+
+import sqlite3
+
+# Bump whenever the overlap decision procedure changes in a way that could
+# change results, so that stale answers are not reused
+version = 2
+
+# seconds to wait for another process holding a lock on the cache
+_timeout = 60.0
+
+class OverlapCacheException(Exception):
+    pass
+
+class OverlapCache:
+    """A cache from pairs of selectors (as strings from cssfile.selector_str)
+    to whether they overlap, stored in an sqlite database.
+
+    Writes are buffered until flush() (or close()) and written in a single
+    transaction.  Several processes may use the same file at once: sqlite
+    locking serialises the writes, and pairs already stored by another process
+    are ignored.
+    """
+
+    def __init__(self, filename):
+        """Opens (creating if needed) the cache in the given file
+
+        :param filename:
+            The name of the sqlite file to use as a string
+        :raises:
+            OverlapCacheException if the file cannot be used
+        """
+        self.filename = filename
+        self.__pending = dict()
+        try:
+            self.__conn = sqlite3.connect(filename, timeout = _timeout)
+            # WAL lets readers proceed while another process writes
+            self.__conn.execute("PRAGMA journal_mode=WAL")
+            with self.__conn:
+                self.__conn.execute("CREATE TABLE IF NOT EXISTS overlaps ("
+                                    "  version INTEGER NOT NULL,"
+                                    "  sel1 TEXT NOT NULL,"
+                                    "  sel2 TEXT NOT NULL,"
+                                    "  result INTEGER NOT NULL,"
+                                    "  PRIMARY KEY (version, sel1, sel2))")
+        except sqlite3.Error as e:
+            raise OverlapCacheException("Cannot use overlap cache " +
+                                        filename + ": " + str(e))
+
+    def lookup(self, sel1, sel2):
+        """
+        :param sel1:
+            A selector as a string
+        :param sel2:
+            A selector as a string
+        :returns:
+            True/False if the overlap of sel1 and sel2 is cached, else None
+        """
+        key = _make_key(sel1, sel2)
+        if key in self.__pending:
+            return self.__pending[key]
+        row = self.__conn.execute("SELECT result FROM overlaps "
+                                  "WHERE version = ? AND sel1 = ? AND sel2 = ?",
+                                  (version,) + key).fetchone()
+        if row is None:
+            return None
+        return bool(row[0])
+
+    def store(self, sel1, sel2, result):
+        """Adds a result to the cache (written on next flush)
+
+        :param sel1:
+            A selector as a string
+        :param sel2:
+            A selector as a string
+        :param result:
+            True iff sel1 and sel2 overlap
+        """
+        self.__pending[_make_key(sel1, sel2)] = result
+
+    def flush(self):
+        """Writes all stored results to disk"""
+        if len(self.__pending) == 0:
+            return
+        rows = [ (version, s1, s2, int(result))
+                 for ((s1, s2), result) in self.__pending.iteritems() ]
+        with self.__conn:
+            self.__conn.executemany("INSERT OR IGNORE INTO overlaps "
+                                    "VALUES (?, ?, ?, ?)",
+                                    rows)
+        self.__pending = dict()
+
+    def close(self):
+        """Flushes and closes the cache"""
+        self.flush()
+        self.__conn.close()
+
+def _make_key(sel1, sel2):
+    """
+    :param sel1:
+        A selector as a string
+    :param sel2:
+        A selector as a string
+    :returns:
+        The pair in a canonical order, since overlap is symmetric
+    """
+    sel1 = _as_unicode(sel1)
+    sel2 = _as_unicode(sel2)
+    return (sel1, sel2) if sel1 <= sel2 else (sel2, sel1)
+
+def _as_unicode(s):
+    """sqlite only accepts unicode text, but cssfile.selector_str may return
+    utf-8 encoded strings.
+
+    :param s:
+        A str or unicode
+    :returns:
+        s as unicode
+    """
+    return s.decode("utf-8") if isinstance(s, str) else s
@@ -0,0 +1,231 @@
+"""Functions for deciding the satisfiability of constraints on the positions of
+siblings, as produced by :nth-child(an+b), :nth-last-child(an+b),
+:first-child, :last-child and the combinators + and ~, without a SAT solver"""
+
+from fractions import gcd
+
+# the largest number of candidate solutions satisfiable will try before
+# giving up (returning None)
+search_budget = 100000
+
+def satisfiable(nths, links):
+    """Decides constraints on the positions (counting from 1) of some
+    siblings, all in the same row, with N the number of siblings:
+
+        nths is an iterable of (node, from_last, a, b, negated) meaning
+
+            (E)n >= 0 . x = an + b      (negated False)
+            not (E)n >= 0 . x = an + b  (negated True)
+
+        where x is the position of node if from_last is False, else
+        N - (position of node) + 1;
+
+        links is an iterable of (node1, node2, d, at_least) meaning the
+        position of node2 minus the position of node1 is d, or at least d if
+        at_least is True.
+
+    Nodes are any hashable objects, compared by equality.
+
+    The constraints are decided exactly when the links put the nodes into
+    one row (or several unrelated rows if no constraint is from_last),
+    else None is returned.  None is also returned if deciding would try
+    more than search_budget candidate solutions.
+
+    :param nths:
+        An iterable of (node, from_last, a, b, negated) as above
+    :param links:
+        An iterable of (node1, node2, d, at_least) as above
+    :returns:
+        True/False if the constraints are satisfiable or not, else None
+    """
+    nths = list(nths)
+    links = list(links)
+
+    # merge nodes at fixed distances into segments: map from node to
+    # (segment, offset from the segment start)
+    nodes = set(n for (n, _, _, _, _) in nths)
+    for (n1, n2, _, _) in links:
+        nodes.add(n1)
+        nodes.add(n2)
+    segs = _make_segments(nodes, [ (n1, n2, d)
+                                   for (n1, n2, d, at_least) in links
+                                   if not at_least ])
+    if segs is None:
+        return False
+
+    # minimum distances between the starts of segments, and the order they
+    # are in
+    gaps = dict()
+    for (n1, n2, d, at_least) in links:
+        if at_least:
+            (s1, off1) = segs[n1]
+            (s2, off2) = segs[n2]
+            gap = d + off1 - off2
+            if s1 == s2:
+                if gap > 0:
+                    return False
+            else:
+                gaps[(s1, s2)] = max(gap, gaps.get((s1, s2), gap))
+    rows = _make_rows(set(s for (s, _) in segs.itervalues()), gaps.keys())
+    if rows is None:
+        return None
+
+    from_last = any(fl for (_, fl, _, _, _) in nths)
+    if from_last and len(rows) > 1:
+        return None
+
+    # a solution with more than bound free space before a segment (or
+    # after the last) stays one with bound less, so only smaller ones are
+    # tried
+    period = reduce(_lcm, [ abs(a) for (_, _, a, _, _) in nths if a != 0 ], 1)
+    bound = max([ abs(b) for (_, _, _, b, _) in nths ] + [0]) + period + 1
+    tries = 1
+    for row in rows:
+        tries *= bound ** (len(row) + (1 if from_last else 0))
+    if tries > search_budget:
+        return None
+
+    # map from segment to [(offset, from_last, a, b, negated)]
+    seg_nths = dict()
+    for (n, fl, a, b, neg) in nths:
+        (s, off) = segs[n]
+        seg_nths.setdefault(s, []).append((off, fl, a, b, neg))
+    # map from segment to the largest offset in it (the least is 0)
+    largest = dict()
+    for (s, off) in segs.itervalues():
+        largest[s] = max(off, largest.get(s, off))
+
+    return all(_row_satisfiable(row, gaps, seg_nths, largest, bound)
+               for row in rows)
+
+def _make_segments(nodes, links):
+    """
+    :param nodes:
+        A set of nodes
+    :param links:
+        A list of (n1, n2, d), n2 is d positions after n1
+    :returns:
+        A map from each node to (segment, offset) where the segment is a node
+        and the offsets of nodes with the same segment are their distances
+        from the first of them, or None if the links are inconsistent
+    """
+    adj = dict((n, []) for n in nodes)
+    for (n1, n2, d) in links:
+        adj[n1].append((n2, d))
+        adj[n2].append((n1, -d))
+    segs = dict()
+    for n in nodes:
+        if n in segs:
+            continue
+        segs[n] = (n, 0)
+        todo = [n]
+        while len(todo) > 0:
+            n1 = todo.pop()
+            off1 = segs[n1][1]
+            for (n2, d) in adj[n1]:
+                if n2 in segs:
+                    if segs[n2][1] != off1 + d:
+                        return None
+                else:
+                    segs[n2] = (n, off1 + d)
+                    todo.append(n2)
+    # make offsets start from 0 in each segment
+    least = dict()
+    for (s, off) in segs.itervalues():
+        least[s] = min(off, least.get(s, off))
+    return dict((n, (s, off - least[s])) for (n, (s, off)) in segs.iteritems())
+
+def _make_rows(segs, edges):
+    """
+    :param segs:
+        A set of segments
+    :param edges:
+        A list of (s1, s2), s2 comes after s1
+    :returns:
+        A list of rows, each a list of segments in order, such that each edge
+        is between neighbours in a row, or None if there are no such rows
+    """
+    succ = dict()
+    pred = dict()
+    for (s1, s2) in edges:
+        if s1 in succ or s2 in pred:
+            return None
+        succ[s1] = s2
+        pred[s2] = s1
+    rows = []
+    for s in segs:
+        if s not in pred:
+            row = [s]
+            while row[-1] in succ:
+                row.append(succ[row[-1]])
+            rows.append(row)
+    if sum(len(row) for row in rows) != len(segs):
+        # a cycle
+        return None
+    return rows
+
+def _row_satisfiable(row, gaps, seg_nths, largest, bound):
+    """Searches for positions of the segments of a row satisfying the
+    constraints on them, with less than bound free space before each
+    segment, and after the last if needed for from_last constraints
+
+    :param row:
+        A list of segments in order
+    :param gaps:
+        A map from (s1, s2) to the least distance from the start of s1 to
+        the start of s2
+    :param seg_nths:
+        A map from segment to its constraints as (offset, from_last, a, b,
+        negated)
+    :param largest:
+        A map from segment to the largest offset in it
+    :param bound:
+        The limit on free space
+    :returns:
+        True iff positions were found
+    """
+    from_last = any(fl
+                    for s in row
+                    for (_, fl, _, _, _) in seg_nths.get(s, []))
+    # starts[k] is the position of offset 0 of row[k]
+    starts = [None] * len(row)
+
+    def search(k, lowest):
+        if k == len(row):
+            if not from_last:
+                return True
+            end = max(starts[j] + largest[s] for (j, s) in enumerate(row))
+            for n in xrange(end, end + bound):
+                if all(_nth(n - start - off + 1, a, b) != neg
+                       for (start, s) in zip(starts, row)
+                       for (off, fl, a, b, neg) in seg_nths.get(s, [])
+                       if fl):
+                    return True
+            return False
+        s = row[k]
+        lowest = max(lowest, 1)
+        for start in xrange(lowest, lowest + bound):
+            if all(_nth(start + off, a, b) != neg
+                   for (off, fl, a, b, neg) in seg_nths.get(s, [])
+                   if not fl):
+                starts[k] = start
+                nxt = (start + gaps[(s, row[k + 1])]
+                       if k + 1 < len(row)
+                       else None)
+                if search(k + 1, nxt):
+                    return True
+        return False
+
+    return search(0, 1)
+
+def _nth(x, a, b):
+    """
+    :returns:
+        True iff x = an + b for some n >= 0
+    """
+    if a == 0:
+        return x == b
+    return (x - b) % a == 0 and (x - b) / a >= 0
+
+def _lcm(a, b):
+    return a * b / gcd(a, b)
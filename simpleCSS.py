@@ -398,6 +398,7 @@ class simpleCSS(object):
         self.edgeOrder = set(edgeOrder)
 
         self.prop_names = prop_names
+        self.bloat = bloat
 
         if bloat:
             self.computeSelectors()
@@ -409,12 +410,34 @@ class simpleCSS(object):
             self.OptSet = set() # this is an optional set of edges: will be
                             # added by optimisation part
 
+        self.computeOrder()
+
+        if __DEBUG__:
+            Components = self.edgeOrderComponents()
+            print '********START: PRINTING edgeOrder INFORMATION*********'
+            ctr = 0
+            for edgeOrder1 in Components:
+                print '@@@@@@ Printing edgeOrder ' + str(ctr)
+                for (edge1,edge2) in edgeOrder1:
+                    print '==='
+                    edge1.print_rule()
+                    edge2.print_rule()
+                    print '==='
+                print '@@@@@@ End printing edgeOrder ' + str(ctr)
+                ctr += 1
+            print '********END: PRINTING edgeOrder INFORMATION*********'
+
+
+    def computeOrder(self):
+        """Compute the transitive closure and other representations of
+        edgeOrder. Precondition: edgeOrder is defined."""
+
         # Use the following if you need to optimise with compAxioms
         self._tr_cl_edgeOrder = frozenset(transitive_closure(self.edgeOrder))
 
         # compute edges in edgeOrder
         edgesTemp = []
-        for (e1,e2) in edgeOrder:
+        for (e1,e2) in self.edgeOrder:
             edgesTemp.append(e1)
             edgesTemp.append(e2)
 
@@ -428,21 +451,15 @@ class simpleCSS(object):
             self.order_map[e1.getTuple()].add(e2.getTuple())
             self.order_map[e2.getTuple()] # initialise
 
-        if __DEBUG__:
-            Components = self.edgeOrderComponents()
-            print '********START: PRINTING edgeOrder INFORMATION*********'
-            ctr = 0
-            for edgeOrder1 in Components:
-                print '@@@@@@ Printing edgeOrder ' + str(ctr)
-                for (edge1,edge2) in edgeOrder1:
-                    print '==='
-                    edge1.print_rule()
-                    edge2.print_rule()
-                    print '==='
-                print '@@@@@@ End printing edgeOrder ' + str(ctr)
-                ctr += 1
-            print '********END: PRINTING edgeOrder INFORMATION*********'
+    def computeDerived(self):
+        """Recompute everything derived from edgeList, edgeSet and edgeOrder.
+        Call after changing them in place."""
 
+        if self.bloat:
+            self.computeSelectors()
+            self.computeProperties()
+            self.computeAdjacencyList()
+        self.computeOrder()
 
     def getPropName(self, p):
         """
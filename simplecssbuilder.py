@@ -1,7 +1,13 @@
 """Functions for constructing from s CSSFile a simpleCSS object for minimisation
 purposes"""
 
-from itertools import combinations
+import copy
+import operator
+from itertools import izip, combinations
+from collections import defaultdict
+from multiprocessing import Pool
+from difflib import SequenceMatcher
+from timeit import default_timer
 
 import cssfile
 from cssfile import CSSFile
@@ -10,86 +16,597 @@ import cssautomaton
 import autemptiness
 from cliqueCSS import *
 import cssselect_parser
+import overlapcache
+import memocache
+import buildprofile
 
 __DEBUG__ = True
 
-numchecks = 0
-numpositive = 0
-numnontrivialchecks = 0
-numpositivenontrivial = 0
+# number of non-trivial overlap checks sent to a worker process at a time
+parallel_batch_size = 16
 
-def fromfile(filename):
+# budgets of the overlap memo (in selector pairs) and the automata memo (in
+# automaton transitions) used by reset_selectors_overlap_memo, None for no
+# limit
+overlap_memo_budget = 1000000
+automata_memo_budget = 200000
+
+def fromfile(filename, jobs = 1):
     """Constructs a simpleCSS object from a given CSS file
 
     :param filename:
         The name as a string of the CSS file
+    :param jobs:
+        As in fromcssfile
     :returns:
         a simpleCSS object representing the file
     """
+    start_time = default_timer()
     css = cssfile.fromfile(filename)
-    return fromcssfile(css)
+    parse_time = default_timer() - start_time
+    simple_css = fromcssfile(css, jobs)
+    simple_css.profile.add_time("parse", parse_time)
+    return simple_css
 
-def fromstring(css):
+def fromstring(css, jobs = 1):
     """Constructs a simpleCSS object from a given CSS string
 
     :param css:
         The string representation of the CSS file
+    :param jobs:
+        As in fromcssfile
     :returns:
         a simpleCSS object representing the file
     """
+    start_time = default_timer()
     css = cssfile.fromstring(css)
-    return fromcssfile(css)
+    parse_time = default_timer() - start_time
+    simple_css = fromcssfile(css, jobs)
+    simple_css.profile.add_time("parse", parse_time)
+    return simple_css
 
-def fromcssfile(css):
+def fromcssfile(css, jobs = 1):
     """Constructs a simpleCSS object from a given CSSFile
 
     :param css:
         The CSSFile
+    :param jobs:
+        The number of processes to use for non-trivial overlap checks.  The
+        result is the same as for a serial run (jobs = 1).
     :returns:
-        a simpleCSS object representing the file
+        a simpleCSS object representing the file, with the
+        buildprofile.BuildProfile of the build as its profile attribute
     """
-    # dict from (prop, selector, value) to simpleRule
-    rules = {}
-    prop_names = dict()
+    return IncrementalBuilder(css, jobs).get_simple_css()
+
+def iterfromcssfile(css):
+    """Generates the parts of the simpleCSS for a CSSFile as they are decided,
+    without keeping the rule table, order or transitive closure that
+    fromcssfile builds.  Overlaps are decided serially, one property group at
+    a time, so apart from css itself only the BlockingIndex and the (bounded)
+    overlap memo are kept.
+
+    The order edges are those of fromcssfile, but their transitive closure is
+    not computed.  An edge is generated once for each property group it is
+    decided in, so the same edge may be generated more than once.
+
+    Records to the current buildprofile profile.
 
+    :param css:
+        The CSSFile
+    :returns:
+        A generator of ("rule", simpleRule) for each simple rule, then
+        ("order", (e1, e2)) for each order edge, then ("complex", rule) for
+        each complex rule
+    """
     for p in css.get_props():
         for spec in css.get_specificities(p):
+            (important, sel_spec) = spec
+            # a selector and value may be both !important and not, only
+            # generate its rule from the !important group
+            other = css.props[p].get((True, sel_spec), {})
             for (s, v) in css.get_values(p, spec):
-                (l, unique) = css.get_info(p, spec, s, v)
-                rules[(p, s, v)] = _make_simple_rule(p,
+                if important or (s, v) not in other:
+                    (_, unique) = css.get_info(p, spec, s, v)
+                    yield ("rule", _make_simple_rule(p,
                                                      cssfile.selector_str(s),
                                                      v,
-                                                     unique)
-                prop_names[_make_prop(p, v)] = p
+                                                     unique))
 
     reset_selectors_overlap_memo()
-    order = set()
+    index = BlockingIndex(css)
 
     for p in css.get_props():
         for spec in css.get_specificities(p):
-            selvals = css.get_values(p, spec)
-            num = len(selvals)
-            for ((s1, v1),
-                 (s2, v2)) in combinations(selvals, 2):
-                if v1 != v2:
-                    e1 = rules[(p, s1, v1)]
+            with buildprofile.timer("shortcut"):
+                selval_pairs = index.group_pairs(css.get_values(p, spec))
+            overlaps = _decide_overlaps(set(_make_pair(s1, s2)
+                                            for ((s1, _), (s2, _))
+                                            in selval_pairs),
+                                        None)
+            for ((s1, v1), (s2, v2)) in selval_pairs:
+                if overlaps[_make_pair(s1, s2)]:
+                    buildprofile.count("order_edges")
+                    yield ("order",
+                           _make_order_edge(css, p, spec, s1, v1, s2, v2))
+
+    for r in css.get_rules():
+        yield ("complex", _make_rule(r))
+
+def write_stream(css, stream):
+    """Writes the simpleCSS for a CSSFile to a stream in the layout of
+    str(simpleCSS) as iterfromcssfile generates it
+
+    :param css:
+        The CSSFile
+    :param stream:
+        A file-like object to write to
+    """
+    sections = [ ("rule", "Edges:\n\n"),
+                 ("order", "\n\nOrder:\n\n"),
+                 ("complex", "\n\nComplex Rules:\n\n") ]
+    kinds = [ kind for (kind, _) in sections ]
+    # number of section headings written so far
+    started = 0
+    for (kind, item) in iterfromcssfile(css):
+        k = kinds.index(kind) + 1
+        if k > started:
+            # also head any empty sections skipped over
+            for (_, heading) in sections[started:k]:
+                stream.write(heading)
+            started = k
+        else:
+            stream.write("\n")
+        if kind == "order":
+            stream.write(str(item[0]) + " < " + str(item[1]))
+        else:
+            stream.write(str(item))
+    for (_, heading) in sections[started:]:
+        stream.write(heading)
+    stream.write("\n")
+
+class IncrementalBuilder:
+    """Builds a simpleCSS from a CSSFile and keeps what is needed to append
+    further rules to it.  Appending a rule only checks the overlap of its
+    selectors with existing selectors for the same property and specificity,
+    and updates the edgeList and edgeOrder of the simpleCSS in place.
+
+    Appended rules are treated as coming after all rules seen so far.
+
+    The profile attribute is a buildprofile.BuildProfile of the build and all
+    later additions, shared with the simpleCSS.
+    """
+
+    def __init__(self, css, jobs = 1):
+        """Builds the simpleCSS for css
+
+        :param css:
+            The CSSFile
+        :param jobs:
+            As in fromcssfile, also used for rules added later
+        """
+        self.jobs = jobs
+        self.profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(self.profile):
+            self.__build(css)
+            _record_memo_stats(self.profile)
+        self.simple_css.profile = self.profile
+
+    def __build(self, css):
+        """Builds the simpleCSS for css, see __init__"""
+        with buildprofile.timer("rule_table"):
+            # dict from (prop, selector, value) to simpleRule
+            self.rules = {}
+            # dict from prop -> spec -> (selector, value) -> line number
+            self.lines = defaultdict(lambda : defaultdict(dict))
+            self.next_line = 0
+            prop_names = dict()
+
+            for p in css.get_props():
+                for spec in css.get_specificities(p):
+                    for (s, v) in css.get_values(p, spec):
+                        (l, unique) = css.get_info(p, spec, s, v)
+                        self.rules[(p, s, v)] = _make_simple_rule(p,
+                                                                  cssfile.selector_str(s),
+                                                                  v,
+                                                                  unique)
+                        self.lines[p][spec][(s, v)] = l
+                        self.next_line = max(self.next_line, l + 1)
+                        prop_names[_make_prop(p, v)] = p
+
+            reset_selectors_overlap_memo()
+            self.index = BlockingIndex(css)
+
+        with buildprofile.timer("shortcut"):
+            # the same two selectors meet in every property group they share,
+            # so collect the distinct pairs first and decide each of them once
+            (pairs, group_pairs) = _selector_pairs(css, self.index)
+
+        # dict from pairs (as _make_pair) to True iff they overlap, pairs
+        # pruned by the index are not included
+        self.overlaps = _decide_overlaps(pairs, None, self.jobs)
+
+        with buildprofile.timer("rule_table"):
+            order = set()
+            for ((p, spec), selval_pairs) in group_pairs.iteritems():
+                for ((s1, v1), (s2, v2)) in selval_pairs:
+                    if self.overlaps[_make_pair(s1, s2)]:
+                        order.add(self.__make_order(p, spec, s1, v1, s2, v2))
+
+            complex_rules = [ _make_rule(r) for r in css.get_rules() ]
+
+        with buildprofile.timer("closure"):
+            self.simple_css = simpleCSS(list(self.rules.values()),
+                                        list(order),
+                                        complex_rules,
+                                        prop_names = prop_names)
+        buildprofile.count("edges", len(self.simple_css.getEdgeSet()))
+        buildprofile.count("order_edges", len(order))
+
+    def get_simple_css(self):
+        """:returns: the simpleCSS for all rules so far (updated in place)"""
+        return self.simple_css
+
+    def add_rules(self, rules):
+        """Appends rules to the end of the CSS and updates the simpleCSS.
+
+        :param rules:
+            An iteration over CSSRule
+        """
+        with buildprofile.profiling(self.profile):
+            self.__add_rules(rules)
+            _record_memo_stats(self.profile)
+
+    def __add_rules(self, rules):
+        """Appends rules, see add_rules"""
+        # set of (prop, spec, selector, value) whose line number changed
+        touched = set()
+        for r in rules:
+            # numbered as by cssfile, for each selector in order each
+            # declaration in order
+            for sel in r.get_selectors():
+                s = sel.parsed_tree
+                for ((p, v), important) in izip(r.get_declarations(),
+                                                r.get_important()):
+                    spec = (important, s.specificity())
+                    self.lines[p][spec][(s, v)] = self.next_line
+                    self.next_line += 1
+                    touched.add((p, spec, s, v))
+                    if (p, s, v) not in self.rules:
+                        e = _make_simple_rule(p, cssfile.selector_str(s), v)
+                        self.rules[(p, s, v)] = e
+                        self.simple_css.edgeList.append(e)
+                        self.simple_css.edgeSet.add(e)
+                        self.simple_css.prop_names[_make_prop(p, v)] = p
+                        buildprofile.count("edges")
+            self.simple_css.complexRules.append(_make_rule(r))
+
+        new_pairs = set()
+        for (p, spec, s, v) in touched:
+            for (s2, v2) in self.lines[p][spec]:
+                pair = _make_pair(s, s2)
+                if v != v2 and pair not in self.overlaps:
+                    new_pairs.add(pair)
+        self.overlaps.update(_decide_overlaps(new_pairs, self.index, self.jobs))
+
+        # touched rules are now last, so may change the direction of old edges
+        order = self.simple_css.edgeOrder
+        for (p, spec, s, v) in touched:
+            e = self.rules[(p, s, v)]
+            for (s2, v2) in self.lines[p][spec]:
+                if v != v2 and self.overlaps[_make_pair(s, s2)]:
+                    e2 = self.rules[(p, s2, v2)]
+                    order.discard((e, e2))
+                    order.discard((e2, e))
+                    order.add(self.__make_order(p, spec, s, v, s2, v2))
+
+        with buildprofile.timer("closure"):
+            self.simple_css.computeDerived()
+
+    def __make_order(self, p, spec, s1, v1, s2, v2):
+        """
+        :param p:
+            The property
+        :param spec:
+            The specificity of both selectors
+        :param s1, v1:
+            The first selector and value
+        :param s2, v2:
+            The second selector and value
+        :returns:
+            The order edge (e1, e2) or (e2, e1) between the simpleRules of
+            p: v1 and p: v2 such that the later rule is second
+        """
+        e1 = self.rules[(p, s1, v1)]
+        e2 = self.rules[(p, s2, v2)]
+        l1 = self.lines[p][spec][(s1, v1)]
+        l2 = self.lines[p][spec][(s2, v2)]
+        return (e1, e2) if l1 <= l2 else (e2, e1)
+
+def rebuild(old_css, old_simple_css, new_css, jobs = 1):
+    """Constructs a simpleCSS object for new_css reusing the order edges of a
+    simpleCSS built (by fromcssfile) for a previous version of the file.
+
+    The rules of the two files are diffed.  A (selector, value) pair of a
+    property is stable if its last occurrence is in the same unchanged rule
+    in both files.  Edges between stable pairs are kept as they were, since
+    neither their overlap nor their relative order can have changed.  Only
+    pairs involving an unstable (selector, value), i.e. one from a changed
+    or moved rule, are checked and ordered again.
+
+    :param old_css:
+        The CSSFile of the previous version
+    :param old_simple_css:
+        The simpleCSS built from old_css
+    :param new_css:
+        The CSSFile of the new version
+    :param jobs:
+        As in fromcssfile
+    :returns:
+        a simpleCSS object representing new_css, with the
+        buildprofile.BuildProfile of the rebuild as its profile attribute
+    """
+    profile = buildprofile.BuildProfile()
+    with buildprofile.profiling(profile):
+        simple_css = _rebuild(old_css, old_simple_css, new_css, jobs)
+        _record_memo_stats(profile)
+    simple_css.profile = profile
+    return simple_css
+
+def _rebuild(old_css, old_simple_css, new_css, jobs):
+    """Does the work of rebuild in the current profile"""
+    with buildprofile.timer("rule_table"):
+        (rules,
+         prop_names,
+         order,
+         unstable) = _stable_rule_table(old_css, old_simple_css, new_css)
+        buildprofile.count("kept_order_edges", len(order))
+        buildprofile.count("unstable_rules", len(unstable))
+
+        index = BlockingIndex(new_css)
+
+        pairs = set()
+        for (p, spec, s, v) in unstable:
+            for (s2, v2) in new_css.get_values(p, spec):
+                if v != v2:
+                    pairs.add(_make_pair(s, s2))
+
+    overlaps = _decide_overlaps(pairs, index, jobs)
+
+    with buildprofile.timer("rule_table"):
+        for (p, spec, s1, v1) in unstable:
+            e1 = rules[(p, s1, v1)]
+            (l1, _) = new_css.get_info(p, spec, s1, v1)
+            for (s2, v2) in new_css.get_values(p, spec):
+                if v1 != v2 and overlaps[_make_pair(s1, s2)]:
                     e2 = rules[(p, s2, v2)]
-                    if selectors_overlap(s1, s2):
-                        (l1, _) = css.get_info(p, spec, s1, v1)
-                        (l2, _) = css.get_info(p, spec, s2, v2)
-                        enew = (e1, e2)
-                        if l2 < l1:
-                            enew = (e2, e1)
-                        order.add(enew)
+                    (l2, _) = new_css.get_info(p, spec, s2, v2)
+                    order.add((e1, e2) if l1 <= l2 else (e2, e1))
+
+        complex_rules = [ _make_rule(r) for r in new_css.get_rules() ]
+
+    with buildprofile.timer("closure"):
+        simple_css = simpleCSS(list(rules.values()),
+                               list(order),
+                               complex_rules,
+                               prop_names = prop_names)
+    buildprofile.count("edges", len(simple_css.getEdgeSet()))
+    buildprofile.count("order_edges", len(order))
+    return simple_css
+
+def _stable_rule_table(old_css, old_simple_css, new_css):
+    """
+    :param old_css, old_simple_css, new_css:
+        As in rebuild
+    :returns:
+        (rules, prop_names, order, unstable) where rules is a dict from
+        (prop, selector, value) to simpleRule for new_css, prop_names is as
+        for simpleCSS, order is the set of old order edges between stable
+        rules, and unstable is a list of (prop, spec, selector, value) that
+        are not stable
+    """
+    # map from old rule index to new rule index for unchanged rules
+    old_to_new = dict()
+    matcher = SequenceMatcher(None,
+                              old_css.get_rule_keys(),
+                              new_css.get_rule_keys(),
+                              autojunk = False)
+    for (i, j, n) in matcher.get_matching_blocks():
+        for k in xrange(n):
+            old_to_new[i + k] = j + k
+
+    # dict from (prop, selector, value) to simpleRule
+    rules = {}
+    prop_names = dict()
+    # list of (prop, spec, selector, value) that are not stable
+    unstable = []
+    stable_rules = set()
+
+    for p in new_css.get_props():
+        for spec in new_css.get_specificities(p):
+            old_selvals = (old_css.props[p][spec]
+                           if (p in old_css.props and
+                               spec in old_css.props[p])
+                           else dict())
+            for (s, v) in new_css.get_values(p, spec):
+                (l, unique) = new_css.get_info(p, spec, s, v)
+                e = _make_simple_rule(p, cssfile.selector_str(s), v, unique)
+                rules[(p, s, v)] = e
+                prop_names[_make_prop(p, v)] = p
+
+                is_stable = False
+                if (s, v) in old_selvals:
+                    (old_l, _) = old_selvals[(s, v)]
+                    old_idx = old_css.get_rule_index(old_l)
+                    is_stable = (old_to_new.get(old_idx) ==
+                                 new_css.get_rule_index(l))
+
+                if is_stable:
+                    stable_rules.add(e)
+                else:
+                    unstable.append((p, spec, s, v))
+
+    order = set((e1, e2)
+                for (e1, e2) in old_simple_css.getEdgeOrder()
+                if e1 in stable_rules and e2 in stable_rules)
+
+    return (rules, prop_names, order, unstable)
+
+def _make_pair(css1, css2):
+    """
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        A hashable representation of the unordered pair {css1, css2}
+    """
+    return frozenset([css1, css2])
+
+def _pair_selectors(pair):
+    """
+    :param pair:
+        An unordered pair as returned by _make_pair
+    :returns:
+        (css1, css2) the two selectors of the pair (equal if the pair was
+        made from a single selector)
+    """
+    sels = tuple(pair)
+    return sels if len(sels) == 2 else (sels[0], sels[0])
+
+def _selector_pairs(css, index):
+    """
+    :param css:
+        The CSSFile
+    :param index:
+        The BlockingIndex of css
+    :returns:
+        (pairs, group_pairs) where pairs is the set of distinct unordered
+        pairs (as _make_pair) of compatible selectors that appear with
+        different values for some property and specificity, and group_pairs
+        is a dict from (prop, spec) to the list of such ((s1, v1), (s2, v2))
+        as BlockingIndex.group_pairs
+    """
+    pairs = set()
+    group_pairs = dict()
+    for p in css.get_props():
+        for spec in css.get_specificities(p):
+            selval_pairs = index.group_pairs(css.get_values(p, spec))
+            group_pairs[(p, spec)] = selval_pairs
+            for ((s1, _), (s2, _)) in selval_pairs:
+                pairs.add(_make_pair(s1, s2))
+    return (pairs, group_pairs)
+
+def _decide_overlaps(pairs, index, jobs = 1):
+    """Decides overlap once for each pair
+
+    :param pairs:
+        An iterable of unordered selector pairs as returned by _make_pair
+    :param index:
+        The BlockingIndex for the selectors in the pairs, or None if the pairs
+        have already been checked against it
+    :param jobs:
+        The number of processes to use for the non-trivial checks
+    :returns:
+        A dict from each pair to True iff its selectors may match the same node
+    """
+    overlaps = dict()
+    nontrivial = []
+    # the blocking, memo and shortcut checks are charged to "shortcut", the
+    # non-trivial checks time their own phases
+    with buildprofile.timer("shortcut"):
+        for pair in pairs:
+            buildprofile.count("pairs")
+            (s1, s2) = _pair_selectors(pair)
+            if index is not None and not index.compatible(s1, s2):
+                overlaps[pair] = False
+                continue
+            result = _trivial_selectors_overlap(s1, s2)
+            if result is not None:
+                overlaps[pair] = result
+            elif jobs > 1:
+                nontrivial.append(pair)
+            else:
+                result = _nontrivial_selectors_overlap(s1, s2)
+                _record_nontrivial_overlap(s1, s2, result)
+                overlaps[pair] = result
 
-    complex_rules = [ _make_rule(r) for r in css.get_rules() ]
+    if len(nontrivial) > 0:
+        checks = [ _pair_selectors(pair) for pair in nontrivial ]
+        with buildprofile.timer("parallel"):
+            results = _parallel_selectors_overlap(checks, jobs)
+        for (pair, (s1, s2), result) in zip(nontrivial, checks, results):
+            _record_nontrivial_overlap(s1, s2, result)
+            overlaps[pair] = result
 
-    return simpleCSS(list(rules.values()),
-                     list(order),
-                     complex_rules,
-                     prop_names = prop_names)
+    flush_overlap_cache()
 
+    return overlaps
 
+# the pairs being checked by _parallel_selectors_overlap, inherited by the
+# worker processes when they are forked
+_parallel_checks = []
+
+def _parallel_selectors_overlap(checks, jobs):
+    """Runs _nontrivial_selectors_overlap on each pair using a pool of
+    processes.
+
+    Neither the selectors nor the automata and Z3 objects built from them are
+    sent to the workers: the workers are forked with a copy of the pairs
+    and are only sent ranges of indices into the list, returning booleans and
+    the profile of each range, which is merged into the current profile.
+
+    The persistent overlap cache, if any, is closed while the workers are
+    forked, since an sqlite connection cannot be shared with a child process.
+    The workers do not need it: lookups and stores are made by the caller.
+
+    :param checks:
+        A list of pairs (css1, css2) of cssselect parsed_tree selectors
+    :param jobs:
+        The number of worker processes
+    :returns:
+        A list of booleans, True at i iff the ith pair of selectors may
+        match the same node
+    """
+    global _parallel_checks
+    _parallel_checks = checks
+    batches = [ (i, min(i + parallel_batch_size, len(checks)))
+                for i in xrange(0, len(checks), parallel_batch_size) ]
+    cache_filename = (_overlap_cache.filename
+                      if _overlap_cache is not None
+                      else None)
+    use_overlap_cache(None)
+    try:
+        pool = Pool(jobs)
+    finally:
+        use_overlap_cache(cache_filename)
+    try:
+        results = []
+        for (batch_results, profile) in pool.map(_parallel_worker, batches, 1):
+            results.extend(batch_results)
+            buildprofile.current.merge(profile)
+        return results
+    finally:
+        pool.close()
+        pool.join()
+        _parallel_checks = []
+
+def _parallel_worker(batch):
+    """Entry point of worker processes of _parallel_selectors_overlap
+
+    :param batch:
+        A pair (start, end) of indices of pairs in _parallel_checks to check
+    :returns:
+        A pair (results, profile) where results is a list of booleans, True
+        iff the selectors of the corresponding pair may match the same node,
+        and profile is the buildprofile.BuildProfile of the checks
+    """
+    (start, end) = batch
+    profile = buildprofile.BuildProfile()
+    with buildprofile.profiling(profile):
+        results = [ _nontrivial_selectors_overlap(*_parallel_checks[i])
+                    for i in xrange(start, end) ]
+    return (results, profile)
 
 def _make_rule(r):
     """
@@ -102,6 +619,28 @@ def _make_rule(r):
     sels = { cssfile.selector_str(s.parsed_tree) for s in r.get_selectors() }
     return rule(sels, decls)
 
+def _make_order_edge(css, p, spec, s1, v1, s2, v2):
+    """
+    :param css:
+        The CSSFile
+    :param p:
+        The property
+    :param spec:
+        The specificity of both selectors
+    :param s1, v1:
+        The first selector and value
+    :param s2, v2:
+        The second selector and value
+    :returns:
+        The order edge between the simpleRules of p: v1 and p: v2 such that
+        the rule appearing later in css is second
+    """
+    (l1, u1) = css.get_info(p, spec, s1, v1)
+    (l2, u2) = css.get_info(p, spec, s2, v2)
+    e1 = _make_simple_rule(p, cssfile.selector_str(s1), v1, u1)
+    e2 = _make_simple_rule(p, cssfile.selector_str(s2), v2, u2)
+    return (e1, e2) if l1 <= l2 else (e2, e1)
+
 def _make_simple_rule(prop, sel, value, unique = True):
     """
     :param prop:
@@ -121,18 +660,491 @@ def _make_simple_rule(prop, sel, value, unique = True):
 def _make_prop(prop, value):
     return prop + ":" + value
 
-_selectors_overlap_memo = dict()
-_selectors_automata = dict()
+class BlockingIndex:
+    """A cheap signature of the rightmost compound of each selector in a
+    CSSFile.  Two selectors can only overlap if their rightmost compounds can
+    hold on the same node, so pairs with incompatible signatures can be pruned
+    before calling selectors_overlap.
+
+    A signature is a tuple (ns, ele, ids, ps, neg_ps) where
+
+        ns -- the required namespace or None
+        ele -- the required element or None
+        ids -- frozenset of ids required by #i
+        ps -- frozenset of locally checkable pseudo classes required
+        neg_ps -- frozenset of locally checkable pseudo classes in :not()
+
+    For whole property groups, each signature is also encoded as a feature
+    row (ns, ele, id, ps, neg_ps) of small integers: interned codes (0 for
+    none) of the namespace, element and id (-1 if several ids are required)
+    and bitmasks of the required and forbidden pseudo classes.  group_pairs
+    uses these to find the compatible partners of a selector in a group with
+    a few operations on bitsets (Python integers with a bit per selector of
+    the group) instead of a check per pair.
+
+    The number of pairs pruned by each blocking key ("namespace", "element",
+    "id", "pseudo") is counted in the current buildprofile as
+    "pruned_by_<key>".
+    """
+
+    def __init__(self, css):
+        """Builds the index for all selectors of a CSSFile
+
+        :param css:
+            The CSSFile
+        """
+        self.signatures = dict()
+        self.features = dict()
+        # map from namespace, element, id and pseudo class names to codes
+        self.__codes = dict()
+        self.__ps_bits = dict()
+        for p in css.get_props():
+            for spec in css.get_specificities(p):
+                for (s, _) in css.get_values(p, spec):
+                    if s not in self.signatures:
+                        self.signatures[s] = _selector_signature(s)
+                        self.features[s] = self.__encode(self.signatures[s])
+
+        # list of pairs of pseudo class bitmasks that conflict
+        self.__conflict_bits = [ (self.__ps_bit(p1), self.__ps_bit(p2))
+                                 for (p1, p2)
+                                 in autemptiness.get_local_conflict_ps() ]
+
+    def signature(self, css):
+        """
+        :param css:
+            css selector as cssselect parsed_tree
+        :returns:
+            The signature of css as described in the class doc
+        """
+        if css not in self.signatures:
+            self.signatures[css] = _selector_signature(css)
+        return self.signatures[css]
+
+    def compatible(self, css1, css2):
+        """Counts the pair as pruned in the current buildprofile if it is not
+        compatible
+
+        :param css1:
+            css selector as cssselect parsed_tree
+        :param css2:
+            css selector as cssselect parsed_tree
+        :returns:
+            False if the rightmost compounds of css1 and css2 cannot match the
+            same node, True if the selectors may overlap
+        """
+        key = _signatures_conflict(self.signature(css1),
+                                   self.signature(css2))
+        buildprofile.tier_result("blocking", key is not None)
+        if key is not None:
+            buildprofile.count("pruned_by_" + key)
+            return False
+        return True
+
+    def group_pairs(self, selvals):
+        """The pairs of a property group whose values differ and whose
+        selectors are compatible.  Counts the pruned pairs in the current
+        buildprofile.
+
+        :param selvals:
+            A list of (selector, value) pairs, as CSSFile.get_values, of
+            selectors in the index
+        :returns:
+            A list of ((s1, v1), (s2, v2)) for each pair of elements of
+            selvals (in order) with v1 != v2 and s1 compatible with s2
+        """
+        n = len(selvals)
+        rows = [ self.features[s] for (s, _) in selvals ]
+
+        # bitsets of the members of the group by feature
+        by_value = defaultdict(int)
+        by_ns = defaultdict(int)
+        by_ele = defaultdict(int)
+        by_id = defaultdict(int)
+        by_ps = defaultdict(int)
+        by_neg_ps = defaultdict(int)
+        for (i, ((_, v), (ns, ele, ident, ps, neg_ps))) in enumerate(izip(selvals,
+                                                                          rows)):
+            bit = 1 << i
+            by_value[v] |= bit
+            by_ns[ns] |= bit
+            by_ele[ele] |= bit
+            by_id[ident] |= bit
+            for b in _bits(ps):
+                by_ps[b] |= bit
+            for b in _bits(neg_ps):
+                by_neg_ps[b] |= bit
+
+        pairs = []
+        pruned = defaultdict(int)
+        for (i, ((s1, v1), (ns, ele, ident, ps, neg_ps))) in enumerate(izip(selvals,
+                                                                            rows)):
+            # only later members with a different value
+            later = ((1 << n) - 1) & ~((1 << (i + 1)) - 1) & ~by_value[v1]
+            if later == 0:
+                continue
+
+            compat = later
+            if ns != 0:
+                compat &= by_ns[ns] | by_ns[0]
+            pruned["namespace"] += _popcount(later & ~compat)
+
+            after = compat
+            if ele != 0:
+                compat &= by_ele[ele] | by_ele[0]
+            pruned["element"] += _popcount(after & ~compat)
+
+            after = compat
+            if ident == -1:
+                compat = 0
+            elif ident != 0:
+                compat &= by_id[ident] | by_id[0]
+            compat &= ~by_id[-1]
+            pruned["id"] += _popcount(after & ~compat)
+
+            after = compat
+            if (ps & neg_ps) != 0:
+                compat = 0
+            conflicting = 0
+            for b in _bits(ps):
+                conflicting |= by_neg_ps[b]
+            for b in _bits(neg_ps):
+                conflicting |= by_ps[b]
+            for (b1, b2) in self.__conflict_bits:
+                if ps & b1:
+                    conflicting |= by_ps[b2]
+                if ps & b2:
+                    conflicting |= by_ps[b1]
+                if (ps & b1) and (ps & b2):
+                    compat = 0
+            compat &= ~conflicting
+            pruned["pseudo"] += _popcount(after & ~compat)
+
+            while compat != 0:
+                low = compat & -compat
+                pairs.append(((s1, v1), selvals[low.bit_length() - 1]))
+                compat ^= low
+
+        num_pruned = 0
+        for (key, num) in pruned.iteritems():
+            if num > 0:
+                buildprofile.count("pruned_by_" + key, num)
+                num_pruned += num
+        buildprofile.tier_result("blocking", True, num_pruned)
+        buildprofile.tier_result("blocking", False, len(pairs))
+
+        return pairs
+
+    def __encode(self, sig):
+        """
+        :param sig:
+            A signature
+        :returns:
+            The feature row of the signature, as in the class doc
+        """
+        (ns, ele, ids, ps, neg_ps) = sig
+        if len(ids) > 1:
+            ident = -1
+        elif len(ids) == 1:
+            ident = self.__code(("id", iter(ids).next()))
+        else:
+            ident = 0
+        return (self.__code(("ns", ns)) if ns is not None else 0,
+                self.__code(("ele", ele)) if ele is not None else 0,
+                ident,
+                reduce(operator.or_, (self.__ps_bit(p) for p in ps), 0),
+                reduce(operator.or_, (self.__ps_bit(p) for p in neg_ps), 0))
+
+    def __code(self, key):
+        """:returns: the code (> 0) of a tagged name, allocating if new"""
+        if key not in self.__codes:
+            self.__codes[key] = len(self.__codes) + 1
+        return self.__codes[key]
+
+    def __ps_bit(self, p):
+        """:returns: the bitmask of a pseudo class, allocating if new"""
+        if p not in self.__ps_bits:
+            self.__ps_bits[p] = 1 << len(self.__ps_bits)
+        return self.__ps_bits[p]
+
+def _bits(mask):
+    """
+    :param mask:
+        A non-negative integer
+    :returns:
+        An iterator over the set bits of mask, each as an integer
+    """
+    while mask != 0:
+        low = mask & -mask
+        yield low
+        mask ^= low
+
+def _popcount(mask):
+    """
+    :param mask:
+        A non-negative integer
+    :returns:
+        The number of set bits in mask
+    """
+    return bin(mask).count("1")
+
+def _selector_signature(css):
+    """
+    :param css:
+        css selector as cssselect parsed_tree
+    :returns:
+        The signature (ns, ele, ids, ps, neg_ps) of the rightmost compound of
+        css as described in BlockingIndex
+    """
+    if type(css).__name__ == "CombinedSelector":
+        css = css.subselector
+
+    ids = set()
+    ps = set()
+    neg_ps = set()
+    local_ps = autemptiness.get_locally_checkable_ps()
+
+    s = css
+    while type(s).__name__ != "Element":
+        stype = type(s).__name__
+        if stype == "Hash":
+            ids.add(s.id)
+        elif stype == "Pseudo" and s.ident in local_ps:
+            ps.add(s.ident)
+        elif (stype == "Negation" and
+              type(s.subselector).__name__ == "Pseudo" and
+              s.subselector.ident in local_ps):
+            neg_ps.add(s.subselector.ident)
+        s = s.selector
+
+    return (s.namespace, s.element,
+            frozenset(ids), frozenset(ps), frozenset(neg_ps))
+
+def _signatures_conflict(sig1, sig2):
+    """
+    :param sig1:
+        A selector signature as in BlockingIndex
+    :param sig2:
+        A selector signature as in BlockingIndex
+    :returns:
+        None if the signatures are compatible, else the blocking key that
+        rules out the pair ("namespace", "element", "id", or "pseudo")
+    """
+    (ns1, ele1, ids1, ps1, neg_ps1) = sig1
+    (ns2, ele2, ids2, ps2, neg_ps2) = sig2
+
+    if ns1 is not None and ns2 is not None and ns1 != ns2:
+        return "namespace"
+    if ele1 is not None and ele2 is not None and ele1 != ele2:
+        return "element"
+    if len(ids1 | ids2) > 1:
+        return "id"
+
+    ps = ps1 | ps2
+    if not ps.isdisjoint(neg_ps1 | neg_ps2):
+        return "pseudo"
+    for (p1, p2) in autemptiness.get_local_conflict_ps():
+        if p1 in ps and p2 in ps:
+            return "pseudo"
+
+    return None
+
+class SelectorTrie:
+    """A set of selectors stored as a trie keyed by their compounds from the
+    right, i.e. starting from the node being styled, so that selectors
+    sharing a right-hand part share a path.
+
+    candidates(css) compares each compound of css with the trie nodes at the
+    same position once for all the selectors below them.  The rightmost
+    compounds always apply to the same node.  Further compounds do while
+    both selectors have the same > or + combinators to their right, so
+    subtrees whose compound cannot be merged with the aligned compound of
+    css are skipped.
+
+    overlaps_any and overlapping_subset decide the remaining selectors with
+    the automaton of cssautomaton.fromselectors, built with the same sharing
+    of right-hand parts.
+    """
+
+    def __init__(self, selectors = []):
+        """
+        :param selectors:
+            An iterable of css selectors as cssselect parsed trees
+        """
+        # trie nodes are [children, selectors, count] where children is a
+        # map from (compound, combinator to its right) to trie nodes,
+        # selectors a list of the selectors ending at the node and count the
+        # number of selectors ending at or below it
+        self.root = [dict(), [], 0]
+        # the automaton of the selectors, made by automaton() when needed
+        self.__automaton = None
+        for css in selectors:
+            self.add(css)
+
+    def add(self, css):
+        """
+        :param css:
+            css selector as cssselect parsed tree
+        """
+        node = self.root
+        node[2] += 1
+        for key in reversed(_selector_compounds(css)):
+            child = node[0].get(key)
+            if child is None:
+                child = [dict(), [], 0]
+                node[0][key] = child
+            node = child
+            node[2] += 1
+        node[1].append(css)
+        self.__automaton = None
+
+    def __len__(self):
+        return self.root[2]
+
+    def selectors(self):
+        """
+        :returns:
+            A generator of the selectors of the trie
+        """
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            for css in node[1]:
+                yield css
+            stack.extend(node[0].itervalues())
+
+    def automaton(self):
+        """
+        :returns:
+            The simplified automaton of cssautomaton.fromselectors for the
+            selectors of the (non-empty) trie, which shares the states for
+            their common right-hand parts as the trie does, made once
+        """
+        if self.__automaton is None:
+            with buildprofile.timer("automata"):
+                self.__automaton = cssautomaton.simplify(
+                    cssautomaton.fromselectors(self.selectors()))
+        return self.__automaton
+
+    def candidates(self, css):
+        """The number of selectors skipped is counted as trie_pruned.
+
+        :param css:
+            css selector as cssselect parsed tree
+        :returns:
+            A generator of the selectors of the trie that are not known to
+            be disjoint from css
+        """
+        query = list(reversed(_selector_compounds(css)))
+        # stack of (trie node, depth, True iff the compounds of the node's
+        # children apply to the same node as query[depth])
+        stack = [(self.root, 0, True)]
+        while len(stack) > 0:
+            (node, depth, aligned) = stack.pop()
+            for css2 in node[1]:
+                yield css2
+            for ((compound, comb), child) in node[0].iteritems():
+                child_aligned = (aligned and
+                                 depth < len(query) and
+                                 (depth == 0 or
+                                  (comb in _aligned_combinators and
+                                   comb == query[depth][1])))
+                if (child_aligned and
+                    not _compounds_compatible(query[depth][0], compound)):
+                    buildprofile.count("trie_pruned", child[2])
+                    continue
+                stack.append((child, depth + 1, child_aligned))
+
+# combinators that relate a node to exactly one other node
+_aligned_combinators = set([">", "+"])
+
+def _compounds_compatible(compound1, compound2):
+    """
+    :param compound1:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :param compound2:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :returns:
+        False if no node can match both compounds, True if one might
+    """
+    merged = _merge_compounds(compound1, compound2)
+    return merged is not None and _compound_satisfiable(merged) is not False
+
+def _automaton_size(aut):
+    """
+    :param aut:
+        A CSSAutomaton
+    :returns:
+        The size of aut for the automata memo budget, its number of
+        transitions
+    """
+    return max(1, aut.num_trans())
+
+_selectors_overlap_memo = memocache.MemoCache(overlap_memo_budget)
+_selectors_automata = memocache.MemoCache(automata_memo_budget,
+                                          _automaton_size)
+# optional overlapcache.OverlapCache persisting non-trivial results across runs
+_overlap_cache = None
+
+def use_overlap_cache(filename):
+    """Makes selectors_overlap consult and update a persistent cache of
+    results.  Unlike the memo, it is not reset by reset_selectors_overlap_memo.
+
+    :param filename:
+        The name of the cache file, or None to stop using a cache
+    :raises:
+        overlapcache.OverlapCacheException if the file cannot be used
+    """
+    global _overlap_cache
+    if _overlap_cache is not None:
+        _overlap_cache.close()
+    _overlap_cache = (overlapcache.OverlapCache(filename)
+                      if filename is not None
+                      else None)
+
+def flush_overlap_cache():
+    """Writes any new results to the persistent cache, if one is used"""
+    if _overlap_cache is not None:
+        with buildprofile.timer("overlap_cache"):
+            _overlap_cache.flush()
 
 def reset_selectors_overlap_memo():
     """
     _selectors_overlap and _make_selector_automata are memoized to speed it up.
-    Call this to reset.
+    Call this to reset.  The new memos use the budgets in overlap_memo_budget
+    and automata_memo_budget.  Also resets the normalisation and positions
+    memos and the incremental Z3 solver of autemptiness.
     """
     global _selectors_overlap_memo
     global _selectors_automata
-    _selectors_overlap_memo = dict()
-    _selectors_automata = dict()
+    _selectors_overlap_memo = memocache.MemoCache(overlap_memo_budget)
+    _selectors_automata = memocache.MemoCache(automata_memo_budget,
+                                              _automaton_size)
+    autemptiness.reset_normalisation_memo()
+    autemptiness.reset_positions_memo()
+    autemptiness.reset_z3_solver()
+
+def _record_memo_stats(profile):
+    """Copies the counters of the memos in memo_stats to a profile
+
+    :param profile:
+        The buildprofile.BuildProfile
+    """
+    for (name, stats) in memo_stats().iteritems():
+        profile.cache_stats(name + "_memo", stats)
+
+def memo_stats():
+    """
+    :returns:
+        A dict from "overlaps", "automata", "normalisation" and "positions"
+        to the stats (as memocache.MemoCache.stats) of the overlap and
+        automata memos and of the normalisation and positions memos of
+        autemptiness
+    """
+    return { "overlaps" : _selectors_overlap_memo.stats(),
+             "automata" : _selectors_automata.stats(),
+             "normalisation" : autemptiness.normalisation_memo_stats(),
+             "positions" : autemptiness.positions_memo_stats() }
 
 def selectors_overlap_str(css1, css2):
     """
@@ -160,35 +1172,278 @@ def selectors_overlap(css1, css2):
     :returns:
         True iff the two selectors may match the same node
     """
-    global numchecks
-    global numpositive
-    global numnontrivialchecks
-    global numpositivenontrivial
-
-    if _selectors_overlap_memo.has_key((css1, css2)):
-        return _selectors_overlap_memo[(css1, css2)]
-    elif _selectors_overlap_memo.has_key((css2, css1)):
-        return _selectors_overlap_memo[(css2, css1)]
-    else:
-        numchecks += 1
-        fast_res = _shortcut_selectors_overlap(css1, css2)
-        if fast_res is not None:
-            if fast_res:
-                numpositive += 1
-            return fast_res
-        numnontrivialchecks += 1
-        aut1 = _make_selector_automata(css1)
-        aut2 = _make_selector_automata(css2)
-        aut = cssautomaton.intersect(aut1, aut2)
-        result = not autemptiness.isempty(aut, (cssfile.selector_str(css1), cssfile.selector_str(css2)))
-        _selectors_overlap_memo[(css1, css2)] = result
+    result = _trivial_selectors_overlap(css1, css2)
+    if result is None:
+        result = _nontrivial_selectors_overlap(css1, css2)
+        _record_nontrivial_overlap(css1, css2, result)
+    return result
+
+def selectors_jointly_overlap(selectors):
+    """Whether some node can be matched by all of the selectors at once.
+
+    Every pair must overlap first (checked with selectors_overlap).  Then the
+    product of the automata for all but the last selector (in the order of
+    cssfile.selector_str) is built by _make_joint_automaton, which memoizes
+    it for queries sharing those selectors, and its intersection with the
+    last automaton is checked lazily by autemptiness.isempty_intersection.
+
+    Note: is memoized with selectors_overlap, call
+    reset_selectors_overlap_memo before using.
+
+    :param selectors:
+        A non-empty iterable of css selectors as cssselect parsed trees
+    :returns:
+        True iff the selectors may all match the same node
+    """
+    sels = sorted(set(selectors), key = cssfile.selector_str)
+    if len(sels) <= 2:
+        return selectors_overlap(sels[0], sels[-1])
+    key = frozenset(sels)
+    result = _selectors_overlap_memo.get(key)
+    if result is None:
+        result = all(selectors_overlap(css1, css2)
+                     for (css1, css2) in combinations(sels, 2))
         if result:
-            numpositive += 1
-            numpositivenontrivial += 1
-        return result
+            buildprofile.count("joint_checks")
+            aut1 = _make_joint_automaton(tuple(sels[:-1]))
+            aut2 = _make_selector_automata(sels[-1])
+            data = tuple(map(cssfile.selector_str, sels))
+            result = (aut1.num_trans() > 0 and
+                      not autemptiness.isempty_intersection(aut1, aut2, data))
+        _selectors_overlap_memo.put(key, result)
+    return result
+
+def _make_joint_automaton(sels):
+    """
+    Note: is memoized with _make_selector_automata, call
+    reset_selectors_overlap_memo before using
+
+    :param sels:
+        A non-empty tuple of css selectors as cssselect parsed trees
+    :returns:
+        A simplified automaton for the intersection of the selectors, built
+        from the (memoized) automaton of sels[:-1]
+    """
+    if len(sels) == 1:
+        return _make_selector_automata(sels[0])
+    aut = _selectors_automata.get(sels)
+    if aut is None:
+        prefix = _make_joint_automaton(sels[:-1])
+        last = _make_selector_automata(sels[-1])
+        with buildprofile.timer("intersection"):
+            aut = cssautomaton.simplify(cssautomaton.intersect(prefix, last))
+        _selectors_automata.put(sels, aut)
+    return aut
+
+def overlaps_any(css, candidates):
+    """The candidates that survive SelectorTrie.candidates are decided with
+    the shortcut checks of selectors_overlap.  If none is found to overlap,
+    the rest are decided together with one emptiness check on
+    SelectorTrie.automaton, which explores the common right-hand parts of
+    the candidates once.  Only if that finds an overlap, which may be an
+    over-approximation, are they decided one by one.
+
+    Note: is memoized, call reset_selectors_overlap_memo before using.
+
+    :param css:
+        css selector as cssselect parsed tree
+    :param candidates:
+        A SelectorTrie, or an iterable of css selectors as cssselect parsed
+        trees
+    :returns:
+        True iff css may match the same node as some candidate
+    """
+    trie = _as_selector_trie(candidates)
+    undecided = []
+    for css2 in trie.candidates(css):
+        result = _trivial_selectors_overlap(css, css2)
+        if result:
+            return True
+        elif result is None:
+            undecided.append(css2)
+    if len(undecided) > 1 and not _trie_overlaps(css, trie, undecided):
+        return False
+    return any(selectors_overlap(css, css2) for css2 in undecided)
+
+def overlapping_subset(css, candidates):
+    """As overlaps_any, but deciding all of the candidates.  The emptiness
+    check on SelectorTrie.automaton is only made if the shortcut checks
+    find no overlap.
+
+    Note: is memoized, call reset_selectors_overlap_memo before using.
+
+    :param css:
+        css selector as cssselect parsed tree
+    :param candidates:
+        A SelectorTrie, or an iterable of css selectors as cssselect parsed
+        trees
+    :returns:
+        The set of candidates that may match the same node as css
+    """
+    trie = _as_selector_trie(candidates)
+    found = set()
+    undecided = []
+    for css2 in trie.candidates(css):
+        result = _trivial_selectors_overlap(css, css2)
+        if result:
+            found.add(css2)
+        elif result is None:
+            undecided.append(css2)
+    if (len(found) == 0 and
+        len(undecided) > 1 and
+        not _trie_overlaps(css, trie, undecided)):
+        return found
+    found.update(css2 for css2 in undecided if selectors_overlap(css, css2))
+    return found
+
+def _trie_overlaps(css, trie, undecided):
+    """Decides with one emptiness check whether css may match the same node
+    as some selector of a trie.  If not, the pairs of css with the
+    undecided selectors are memoized as not overlapping.
+
+    :param css:
+        css selector as cssselect parsed tree
+    :param trie:
+        A SelectorTrie
+    :param undecided:
+        A list of selectors of the trie not yet decided
+    :returns:
+        False if css overlaps no selector of the trie, True if the automata
+        say it may overlap some
+    """
+    buildprofile.count("trie_checks")
+    result = not autemptiness.isempty_intersection(
+                     _make_selector_automata(css),
+                     trie.automaton(),
+                     (cssfile.selector_str(css), len(trie)))
+    if not result:
+        buildprofile.count("trie_disjoint", len(undecided))
+        for css2 in undecided:
+            _selectors_overlap_memo.put(_make_pair(css, css2), False)
+    return result
+
+def _as_selector_trie(candidates):
+    """
+    :param candidates:
+        A SelectorTrie or an iterable of css selectors
+    :returns:
+        candidates as a SelectorTrie
+    """
+    if isinstance(candidates, SelectorTrie):
+        return candidates
+    return SelectorTrie(candidates)
+
+def _trivial_selectors_overlap(css1, css2):
+    """Decides overlap from the memo, the shortcut tiers or the persistent
+    cache, counting the check if decided
+
+    :param css1:
+        css selector as cssselect parsed tree
+    :param css2:
+        css selector as cssselect parsed tree
+    :returns:
+        True/False if one of these decides the overlap of css1 and css2,
+        else None
+    """
+    memo_res = _lookup_selectors_overlap_memo(css1, css2)
+    if memo_res is not None:
+        return memo_res
+    fast_res = _shortcut_selectors_overlap(css1, css2)
+    if fast_res is not None:
+        buildprofile.count("checks")
+        buildprofile.count("shortcut_checks")
+        if fast_res:
+            buildprofile.count("positive")
+        return fast_res
+    cached_res = _lookup_overlap_cache(css1, css2)
+    if cached_res is not None:
+        buildprofile.count("checks")
+        if cached_res:
+            buildprofile.count("positive")
+        _selectors_overlap_memo.put(_make_pair(css1, css2), cached_res)
+        return cached_res
+    return None
+
+def _lookup_overlap_cache(css1, css2):
+    """
+    :param css1:
+        css selector as cssselect parsed tree
+    :param css2:
+        css selector as cssselect parsed tree
+    :returns:
+        The result of selectors_overlap(css1, css2) stored in the persistent
+        cache, or None if there is no cache or no stored result
+    """
+    if _overlap_cache is None:
+        return None
+    with buildprofile.timer("overlap_cache"):
+        res = _overlap_cache.lookup(cssfile.selector_str(css1),
+                                    cssfile.selector_str(css2))
+    buildprofile.cache_lookup("overlap_cache", res is not None)
+    return res
+
+def _lookup_selectors_overlap_memo(css1, css2):
+    """
+    :param css1:
+        css selector as cssselect parsed tree
+    :param css2:
+        css selector as cssselect parsed tree
+    :returns:
+        The memoized result of selectors_overlap(css1, css2) or None if
+        there is none
+    """
+    return _selectors_overlap_memo.get(_make_pair(css1, css2))
+
+def _record_nontrivial_overlap(css1, css2, result):
+    """Memoizes the result of a non-trivial overlap check and counts it
+
+    :param css1:
+        css selector as cssselect parsed tree
+    :param css2:
+        css selector as cssselect parsed tree
+    :param result:
+        The result of _nontrivial_selectors_overlap(css1, css2)
+    """
+    buildprofile.count("checks")
+    buildprofile.count("nontrivial_checks")
+    _selectors_overlap_memo.put(_make_pair(css1, css2), result)
+    if _overlap_cache is not None:
+        _overlap_cache.store(cssfile.selector_str(css1),
+                             cssfile.selector_str(css2),
+                             result)
+    if result:
+        buildprofile.count("positive")
+        buildprofile.count("positive_nontrivial")
+
+def _nontrivial_selectors_overlap(css1, css2):
+    """Decides overlap with _chain_selectors_overlap if the selectors are in
+    its fragment, else with automata, no memoization of the result
+
+    :param css1:
+        css selector as cssselect parsed tree
+    :param css2:
+        css selector as cssselect parsed tree
+    :returns:
+        True iff the two selectors may match the same node
+    """
+    with buildprofile.timer("chain"):
+        res = _chain_selectors_overlap(css1, css2)
+    if res is not None:
+        buildprofile.count("chain_checks")
+        return res
+
+    aut1 = _make_selector_automata(css1)
+    aut2 = _make_selector_automata(css2)
+    return not autemptiness.isempty_intersection(aut1,
+                                                 aut2,
+                                                 (cssfile.selector_str(css1),
+                                                  cssfile.selector_str(css2)))
 
 def _shortcut_selectors_overlap(css1, css2):
-    """Implements some fast checks for selector overlap
+    """Implements some fast checks for selector overlap, trying each of
+    _shortcut_tiers in turn.  Whether each tier decided is recorded in the
+    current buildprofile.
+
     :param css1:
         css selector as cssselect parsed_tree
     :param css2:
@@ -197,47 +1452,366 @@ def _shortcut_selectors_overlap(css1, css2):
         True/False if a quick diagnosis of overlap between selectors could be made
         else None
     """
+    for (name, tier) in _shortcut_tiers:
+        res = tier(css1, css2)
+        buildprofile.tier_result(name, res is not None)
+        if res is not None:
+            return res
+    return None
+
+def _compound_tier(css1, css2):
+    """Rejects pairs whose rightmost compounds conflict on namespace, element,
+    id or local pseudo classes (as BlockingIndex).
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        False if the rightmost compounds cannot match the same node, else None
+    """
+    if _signatures_conflict(_selector_signature(css1),
+                            _selector_signature(css2)) is not None:
+        return False
+    return None
+
+def _root_tier(css1, css2):
+    """Rejects pairs that put :root below a node or next to a sibling, or
+    that need the subject at incompatible depths.
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        False if no node can match both, else None
+    """
+    (min1, exact1, notroot1) = _selector_depth(css1)
+    (min2, exact2, notroot2) = _selector_depth(css2)
+    if min1 is None or min2 is None:
+        return False
+    if exact1 is not None and (min2 > exact1 or
+                               (exact1 == 0 and notroot2)):
+        return False
+    if exact2 is not None and (min1 > exact2 or
+                               (exact2 == 0 and notroot1)):
+        return False
+    return None
+
+def _empty_tier(css1, css2):
+    """Rejects pairs where :empty is required of an ancestor, or of the
+    subject together with :not(:empty).
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        False if no node can match both, else None
+    """
+    compounds1 = _selector_compounds(css1)
+    compounds2 = _selector_compounds(css2)
+    for compounds in [compounds1, compounds2]:
+        for (compound, comb) in compounds:
+            if comb in [" ", ">"] and "empty" in _compound_pseudos(compound)[0]:
+                return False
+    (ps1, neg_ps1) = _compound_pseudos(compounds1[-1][0])
+    (ps2, neg_ps2) = _compound_pseudos(compounds2[-1][0])
+    if (("empty" in ps1 and "empty" in neg_ps2) or
+        ("empty" in ps2 and "empty" in neg_ps1)):
+        return False
+    return None
+
+def _simple_compound_tier(css1, css2):
+    """Accepts pairs of compound selectors built only from elements, ids,
+    classes and local pseudo classes whose signatures do not conflict (any
+    number of classes can be given to a node)
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        True if the selectors are such compounds and overlap, else None
+    """
+    if not (_is_simple_compound(css1) and _is_simple_compound(css2)):
+        return None
+    if _signatures_conflict(_selector_signature(css1),
+                            _selector_signature(css2)) is not None:
+        return False
+    return True
+
+def _compound_merge_tier(css1, css2):
+    """Decides pairs of selectors without combinators by merging them into a
+    single compound, normalising it as autemptiness does and checking the
+    remaining element, namespace and pseudo class constraints of one node
+    directly.  Compounds with position constraints (:first-child, nth-child
+    &c.) or other functions are passed on.
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        True/False if both selectors are compounds that can be decided this
+        way, else None
+    """
+    if (type(css1).__name__ == "CombinedSelector" or
+        type(css2).__name__ == "CombinedSelector"):
+        return None
+
+    merged = _merge_compounds(css1, css2)
+    if merged is None:
+        return False
+
+    return _compound_satisfiable(merged)
+
+def _compound_satisfiable(compound):
+    """Normalises the compound as autemptiness does and checks the remaining
+    element, namespace and pseudo class constraints of one node directly
+
+    :param compound:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :returns:
+        True/False if some node can (cannot) match the compound, None if it
+        has position constraints or functions
+    """
+    norm = autemptiness._normalise_selector(compound)
+    if norm is None:
+        return False
+
+    # after normalisation only the element, a fixed #id, pseudo classes and
+    # negated elements and pseudo classes remain
+    neg_nsele = []
+    ps = set()
+    neg_ps = set()
+    s = norm
+    while type(s).__name__ != "Element":
+        stype = type(s).__name__
+        if stype == "Negation":
+            subtype = type(s.subselector).__name__
+            if subtype == "Element":
+                neg_nsele.append((s.subselector.namespace,
+                                  s.subselector.element))
+            elif (subtype == "Pseudo" and
+                  s.subselector.ident not in _positional_ps):
+                neg_ps.add(s.subselector.ident)
+            else:
+                return None
+        elif stype == "Pseudo" and s.ident not in _positional_ps:
+            ps.add(s.ident)
+        elif stype != "Hash":
+            return None
+        s = s.selector
+
+    if not ps.isdisjoint(neg_ps):
+        return False
+
+    # unconstrained namespaces and elements can be given a fresh name, which
+    # only a * in a negation matches
+    for (ns, ele) in neg_nsele:
+        if ((ns is None or ns == s.namespace) and
+            (ele is None or ele == s.element)):
+            return False
+
+    return True
+
+def _chain_selectors_overlap(css1, css2):
+    """Decides overlap for selectors whose combinators are all descendant or
+    child and that have no position constraints or :root, by aligning the
+    compounds of both along a single path from the root to the node.
+
+    The path is built from the top down.  Each new node takes the next
+    compound of css1, of css2 or of both (merged).  A child combinator forces
+    the next compound onto the next node, and the last node takes the last
+    compounds of both.  Nodes without a compound are never needed.  A node
+    with a child cannot be :empty, and :target or an id kept by normalisation
+    (as in AutEmptinessChecker) can only be on one node, so compounds sharing
+    one must share a node.  The search is over
+    (compounds placed from css1, compounds placed from css2, whether the last
+    of each is on the current node), so polynomial in the selector lengths.
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        True/False if both selectors are in the fragment, else None
+    """
+    chain1 = _selector_compounds(css1)
+    chain2 = _selector_compounds(css2)
+    for (compound, comb) in chain1 + chain2:
+        if comb not in [None, " ", ">"]:
+            return None
+        (ps, neg_ps) = _compound_pseudos(compound)
+        if "root" in ps or not ps.isdisjoint(_positional_ps):
+            return None
+
+    infos1 = [ _chain_compound_info(c) for (c, _) in chain1 ]
+    infos2 = [ _chain_compound_info(c) for (c, _) in chain2 ]
+    for (sat, _, _) in infos1 + infos2:
+        if sat is not True:
+            return sat
+
+    for infos in [infos1, infos2]:
+        # an id or :target on two nodes, or :empty above the node
+        keys = set()
+        for (_, ks, _) in infos:
+            if not keys.isdisjoint(ks):
+                return False
+            keys |= ks
+        for (_, _, empty) in infos[:-1]:
+            if empty:
+                return False
+
+    n1 = len(chain1)
+    n2 = len(chain2)
+
+    # partners[i] is the set of j such that compound i of css1 and compound
+    # j of css2 share an id or :target, so must be on the same node
+    partners1 = [ set(j for j in xrange(n2)
+                      if not infos1[i][1].isdisjoint(infos2[j][1]))
+                  for i in xrange(n1) ]
+    partners2 = [ set(i for i in xrange(n1) if j in partners1[i])
+                  for j in xrange(n2) ]
+
+    merged_sat = dict()
+    def can_merge(i, j):
+        """:returns: True iff compound i of css1 and j of css2 may share a
+        node (which is the last node iff i and j are the last compounds)"""
+        if (i, j) not in merged_sat:
+            last = (i == n1 - 1 and j == n2 - 1)
+            res = False
+            if (partners1[i] <= set([j]) and partners2[j] <= set([i]) and
+                (last or not (infos1[i][2] or infos2[j][2]))):
+                merged = _merge_compounds(chain1[i][0], chain2[j][0])
+                if merged is not None:
+                    res = _compound_satisfiable(merged)
+            merged_sat[(i, j)] = res
+        return merged_sat[(i, j)]
+
+    # states (i, j, on1, on2): i compounds of css1 and j of css2 placed, on1
+    # (on2) iff compound i - 1 of css1 (j - 1 of css2) is on the last node
+    worklist = [(0, 0, False, False)]
+    done = set(worklist)
+    while len(worklist) > 0:
+        (i, j, on1, on2) = worklist.pop()
+        # whether the next compound must go on the next node
+        forced1 = on1 and chain1[i - 1][1] == ">"
+        forced2 = on2 and chain2[j - 1][1] == ">"
+        # a child combinator whose parent is no longer on the last node
+        if ((i > 0 and not on1 and chain1[i - 1][1] == ">") or
+            (j > 0 and not on2 and chain2[j - 1][1] == ">")):
+            continue
+
+        nexts = []
+        if i < n1 - 1 and not forced2 and len(partners1[i]) == 0:
+            nexts.append((i + 1, j, True, False))
+        if j < n2 - 1 and not forced1 and len(partners2[j]) == 0:
+            nexts.append((i, j + 1, False, True))
+        if (i < n1 and j < n2 and
+            (i == n1 - 1) == (j == n2 - 1) and
+            can_merge(i, j)):
+            if i == n1 - 1:
+                return True
+            nexts.append((i + 1, j + 1, True, True))
+
+        for state in nexts:
+            if state not in done:
+                done.add(state)
+                worklist.append(state)
+
+    return False
+
+def _chain_compound_info(compound):
+    """
+    :param compound:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :returns:
+        (sat, keys, empty) where sat is as _compound_satisfiable, keys is the
+        set of ids and :target that the compound puts on its node and empty
+        is True iff the compound requires :empty
+    """
+    sat = _compound_satisfiable(compound)
+    if sat is not True:
+        return (sat, frozenset(), False)
+    norm = autemptiness._normalise_selector(compound)
+    keys = set()
+    (ps, _) = _compound_pseudos(norm)
+    if "target" in ps:
+        keys.add(":target")
+    s = norm
+    while type(s).__name__ != "Element":
+        if type(s).__name__ == "Hash":
+            keys.add("#" + s.id)
+        s = s.selector
+    return (sat, frozenset(keys), "empty" in ps)
+
+def _merge_compounds(css1, css2):
+    """
+    :param css1:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :param css2:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :returns:
+        A compound selector with the simple selectors of both, or None if
+        their element or namespace conflict
+    """
+    def parts(css):
+        """:returns: (element, list of the other simple selectors)"""
+        ps = []
+        while type(css).__name__ != "Element":
+            ps.append(css)
+            css = css.selector
+        return (css, ps)
+
+    (ele1, parts1) = parts(css1)
+    (ele2, parts2) = parts(css2)
+
+    if (ele1.namespace is not None and ele2.namespace is not None and
+        ele1.namespace != ele2.namespace):
+        return None
+    if (ele1.element is not None and ele2.element is not None and
+        ele1.element != ele2.element):
+        return None
+
+    merged = cssselect_parser.Element(
+        ele1.namespace if ele1.namespace is not None else ele2.namespace,
+        ele1.element if ele1.element is not None else ele2.element
+    )
+    for part in reversed(parts1 + parts2):
+        cpy = copy.copy(part)
+        cpy.selector = merged
+        merged = cpy
+    return merged
+
+# pseudo classes that constrain the position of a node among its siblings
+_positional_ps = set(["first-child", "last-child", "only-child",
+                      "first-of-type", "last-of-type", "only-of-type"])
+
+def _class_chain_tier(css1, css2):
+    """Decides pairs of selectors built only from .c atoms and combinators,
+    possibly ending with a local pseudo class.
+
+    :param css1:
+        css selector as cssselect parsed_tree
+    :param css2:
+        css selector as cssselect parsed_tree
+    :returns:
+        True/False if both selectors have this shape, else None
+    """
 
     def is_star(css):
         """
         :param css:
             css selector as parsed tree
         :returns:
-            True iff css is .c for some c
+            True iff css is *
         """
         return (type(css).__name__ == "Element" and
                 css.namespace == None and
                 css.element == None)
 
-    def is_class(css):
-        """
-        :param css:
-            css selector as parsed tree
-        :returns:
-            True iff css is .c for some c
-        """
-        return (type(css).__name__ == "Class" and
-                is_star(css.selector))
-
-    def is_hash(css):
-        """
-        :param css:
-            css selector as parsed tree
-        :returns:
-            True iff css is #i for some i
-        """
-        return (type(css).__name__== "Hash" and
-                is_star(css.selector))
-
-    def is_element(css):
-        """
-        :param css:
-            css selector as parsed tree
-        :returns:
-            True iff css is n|e for some n|e
-        """
-        return type(css).__name__== "Element"
-
     def all_classes_pseudo(css):
         """
         :param css:
@@ -263,13 +1837,6 @@ def _shortcut_selectors_overlap(css1, css2):
         else:
             return False
 
-    if is_class(css1) and is_class(css2):
-        return True
-    elif is_hash(css1) and is_hash(css2):
-        return css1.id == css2.id
-    elif is_element(css1) and is_element(css2):
-        return css1 == css2
-
     p1 = all_classes_pseudo(css1)
     p2 = all_classes_pseudo(css2)
     if not(p1 is False or p2 is False):
@@ -281,6 +1848,112 @@ def _shortcut_selectors_overlap(css1, css2):
 
     return None
 
+# list of (name, tier) tried in order by _shortcut_selectors_overlap, where
+# tier is a function from two parsed_tree selectors to True/False if it can
+# decide their overlap exactly, else None.  Cheap exact rejections come first.
+_shortcut_tiers = [ ("compound", _compound_tier),
+                    ("root", _root_tier),
+                    ("empty", _empty_tier),
+                    ("simple_compound", _simple_compound_tier),
+                    ("compound_merge", _compound_merge_tier),
+                    ("class_chain", _class_chain_tier) ]
+
+def _selector_compounds(css):
+    """
+    :param css:
+        css selector as cssselect parsed_tree
+    :returns:
+        The list of (compound, comb) of css from left to right, where comb is
+        the combinator to the right of the compound (None for the rightmost)
+    """
+    compounds = []
+    comb = None
+    while type(css).__name__ == "CombinedSelector":
+        compounds.append((css.subselector, comb))
+        comb = css.combinator
+        css = css.selector
+    compounds.append((css, comb))
+    compounds.reverse()
+    return compounds
+
+def _compound_pseudos(compound):
+    """
+    :param compound:
+        A compound selector (no combinators) as cssselect parsed_tree
+    :returns:
+        (ps, neg_ps) the sets of pseudo class names required and negated by
+        the compound
+    """
+    ps = set()
+    neg_ps = set()
+    s = compound
+    while type(s).__name__ != "Element":
+        stype = type(s).__name__
+        if stype == "Pseudo":
+            ps.add(s.ident)
+        elif (stype == "Negation" and
+              type(s.subselector).__name__ == "Pseudo"):
+            neg_ps.add(s.subselector.ident)
+        s = s.selector
+    return (ps, neg_ps)
+
+def _selector_depth(css):
+    """
+    :param css:
+        css selector as cssselect parsed_tree
+    :returns:
+        (min_depth, exact_depth, not_root) where min_depth is a lower bound on
+        the depth of a node matched by css (the root has depth 0) or None if
+        css puts :root where it cannot be, exact_depth is the depth of every
+        matched node or None if not fixed by :root, and not_root is True iff
+        css has :not(:root) on its rightmost compound
+    """
+    compounds = _selector_compounds(css)
+
+    # walk from the subject leftwards, level is the number of ancestor steps
+    # taken so far
+    min_depth = 0
+    level = 0
+    exact = True
+    exact_depth = None
+    for (i, (compound, comb)) in reversed(list(enumerate(compounds))):
+        if comb in ["+", "~"]:
+            # the compound has a following sibling so it has a parent
+            min_depth = max(min_depth, level + 1)
+        elif comb in [" ", ">"]:
+            level += 1
+            min_depth = max(min_depth, level)
+            if comb == " ":
+                exact = False
+        if "root" in _compound_pseudos(compound)[0]:
+            if i > 0:
+                # something is to the left of the root
+                return (None, None, False)
+            if comb in ["+", "~"]:
+                return (None, None, False)
+            if exact:
+                exact_depth = level
+    (_, neg_ps) = _compound_pseudos(compounds[-1][0])
+    return (min_depth, exact_depth, "root" in neg_ps)
+
+def _is_simple_compound(css):
+    """
+    :param css:
+        css selector as cssselect parsed_tree
+    :returns:
+        True iff css has no combinators and only element, id, class and
+        local pseudo class parts
+    """
+    local_ps = autemptiness.get_locally_checkable_ps()
+    s = css
+    while type(s).__name__ != "Element":
+        stype = type(s).__name__
+        if not (stype in ["Class", "Hash"] or
+                (stype == "Pseudo" and s.ident in local_ps)):
+            return False
+        s = s.selector
+    return True
+
 def _make_selector_automata(css):
     """
     Note: is memoized, call reset_selectors_overlap_memo before using
@@ -290,10 +1963,15 @@ def _make_selector_automata(css):
     :returns:
         An automaton representation of the selector
     """
-    if _selectors_automata.has_key(css):
-        return _selectors_automata[css]
-    else:
-        aut = cssautomaton.fromselector(css)
-        _selectors_automata[css] = aut
-        return aut
+    aut = _selectors_automata.get(css)
+    if aut is None:
+        with buildprofile.timer("automata"):
+            built = cssautomaton.fromselector(css)
+            aut = cssautomaton.simplify(built)
+        buildprofile.count("simplified_states",
+                           built.num_states() - aut.num_states())
+        buildprofile.count("simplified_trans",
+                           built.num_trans() - aut.num_trans())
+        _selectors_automata.put(css, aut)
+    return aut
 
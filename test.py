@@ -2,17 +2,30 @@
 import abc
 import unittest
 import re
+import os
+import shutil
+import tempfile
+import json
+import pickle
+from collections import defaultdict
+from StringIO import StringIO
 
 import cssselect_parser
 from lxml import etree
+from lxml.cssselect import CSSSelector
 
 import cssautomaton
 from cssautomaton import *
 
 import autemptiness
 from autemptiness import *
+import poscons
 
+import cssfile
 import simplecssbuilder
+import overlapcache
+import memocache
+import buildprofile
 
 from simpleCSS import *
 
@@ -25,6 +38,43 @@ def _parse_selector(selector):
 _isany = _parse_selector("*")
 
 
+class TestInterning(unittest.TestCase):
+
+    def test_equal_identical(self):
+        sel1 = _parse_selector("a.c > b:nth-child(2n+1)")
+        sel2 = _parse_selector("a.c > b:nth-child(2n+1)")
+        self.assertIs(sel1, sel2)
+
+    def test_fast_path_identical(self):
+        self.assertIs(_parse_selector("#i"), _parse_selector("*#i"))
+        self.assertIs(_parse_selector(".c"), _parse_selector("*.c"))
+
+    def test_not_equal(self):
+        self.assertNotEqual(_parse_selector("a > b"), _parse_selector("b > a"))
+        self.assertNotEqual(_parse_selector(":nth-child(2n)"),
+                            _parse_selector(":nth-child(2n+1)"))
+
+    def test_specificity(self):
+        sel = _parse_selector("#i a.c:hover > b:not(.d)")
+        self.assertEqual(sel.specificity(), (1, 3, 2))
+
+    def test_immutable(self):
+        sel = _parse_selector("a.c")
+        self.assertRaises(AttributeError, setattr, sel, "class_name", "d")
+
+    def test_copy(self):
+        import copy
+        sel = _parse_selector("a.c")
+        cpy = copy.copy(sel)
+        self.assertEqual(cpy, sel)
+        self.assertEqual(hash(cpy), hash(sel))
+        cpy.class_name = "d"
+        self.assertEqual(cpy, _parse_selector("a.d"))
+        self.assertEqual(hash(cpy), hash(_parse_selector("a.d")))
+        self.assertEqual(sel.class_name, "c")
+        self.assertIs(cssselect_parser.intern_selector(cpy),
+                      _parse_selector("a.d"))
+
 class TestAutomatonConstruction(unittest.TestCase):
 
     # These can possibly be rewritten to use aut.parse_tran_list
@@ -200,6 +250,34 @@ class TestAutomatonConstruction(unittest.TestCase):
 
         self.assertEqual(aut, aut_built)
 
+    def test_selector_table(self):
+        aut = cssautomaton.fromstring("a > * > a")
+        # *, a and the loops' * share entries of the table
+        self.assertEqual(len(aut.selectors), 2)
+        self.assertEqual(aut.num_states(), 6)
+        self.assertEqual(aut.num_trans(), 11)
+
+    def test_duplicate_tran(self):
+        aut = CSSAutomaton()
+        aut.qinit = aut._new_state()
+        aut.qfinal = aut._new_state()
+        for i in xrange(2):
+            aut.add_tran(Tran(aut.qinit,
+                              Arrow.noop,
+                              _parse_selector("a"),
+                              aut.qfinal))
+        self.assertEqual(aut.num_trans(), 1)
+
+    def test_intersect_states(self):
+        aut1 = cssautomaton.fromstring("a")
+        aut2 = cssautomaton.fromstring("b")
+        aut = cssautomaton.intersect(aut1, aut2)
+        # only the loops on init are left, and only states with transitions
+        # (or init and final) are made
+        self.assertEqual(aut.num_states(), 2)
+        self.assertEqual(aut.num_trans(), 2)
+        self.assertEqual((aut.qinit, aut.qfinal), (0, 1))
+
 
 class TestAccepts(unittest.TestCase):
 
@@ -402,6 +480,147 @@ class TestIntersection(unittest.TestCase):
                           </e1>""",
                        False)
 
+class TestAcceptsAll(unittest.TestCase):
+
+    _document = """<html>
+                     <body class='c'>
+                       <div id='a'><p/><p class='c'/><span/><p/></div>
+                       <ul><li><a/></li><li class='c'><a/><a/></li></ul>
+                       <!-- comment -->
+                       <p/>
+                     </body>
+                   </html>"""
+
+    def _do_test(self, css):
+        """Tests that accepts_all and accepts agree with lxml on _document
+
+        :param css:
+            String, CSS selector
+        """
+        tree = etree.fromstring(self._document)
+        aut = cssautomaton.fromstring(css)
+        expected = CSSSelector(css)(tree)
+        self.assertEqual(aut.accepts_all(tree), expected)
+        self.assertEqual([ n for n in tree.iter(tag = etree.Element)
+                           if aut.accepts(n) ],
+                         expected)
+
+    def test_element(self):
+        self._do_test("p")
+
+    def test_child(self):
+        self._do_test(".c > a")
+
+    def test_descendant(self):
+        self._do_test("body li a")
+
+    def test_neighbour(self):
+        self._do_test("p + p")
+
+    def test_sibling(self):
+        self._do_test("#a > p ~ p")
+
+    def test_root(self):
+        self._do_test("html > body")
+
+class TestFromSelectors(unittest.TestCase):
+
+    def _do_test(self, csss, num_states):
+        """Tests that the automaton for some selectors accepts the nodes of
+        TestAcceptsAll._document matched by any of them
+
+        :param csss:
+            List of strings, CSS selectors
+        :param num_states:
+            The number of states the automaton should have
+        """
+        tree = etree.fromstring(TestAcceptsAll._document)
+        aut = cssautomaton.fromselectors(map(_parse_selector, csss))
+        expected = CSSSelector(", ".join(csss))(tree)
+        self.assertEqual(aut.accepts_all(tree), expected)
+        self.assertEqual(aut.num_states(), num_states)
+
+    def test_single(self):
+        self._do_test([".c > a"],
+                      cssautomaton.fromstring(".c > a").num_states())
+
+    def test_shared_suffix(self):
+        # the states for li > a are shared
+        self._do_test(["ul > li > a", ".c > li > a", "body li > a"], 8)
+
+    def test_different(self):
+        # nothing is shared but the initial and final states
+        csss = ["#a > p ~ span", "p + p", "li a", "html > body"]
+        self._do_test(csss,
+                      sum(cssautomaton.fromstring(css).num_states() - 2
+                          for css in csss) + 2)
+
+
+class TestSimplify(unittest.TestCase):
+
+    def _do_test(self, aut, saut):
+        """Tests whether aut simplifies to saut.
+
+        :param aut:
+            String list representation of aut
+        :param saut:
+            String list representation of simplified aut
+        """
+        a = cssautomaton.fromlist(aut)
+        sa = cssautomaton.fromlist(saut)
+        self.assertEqual(cssautomaton.simplify(a), sa)
+
+    def test_selector_unchanged(self):
+        for css in ["a", ".c > img", "a b c", "e1 > e2 ~ e3 + e4"]:
+            aut = cssautomaton.fromstring(css)
+            self.assertEqual(cssautomaton.simplify(aut), aut)
+
+    def test_dead_states(self):
+        self._do_test(["q0", "q1",
+                       "q0 -- c, * --> q0",
+                       "q0 -- 0, a --> q1",
+                       "q0 -- c, b --> q2",
+                       "q3 -- c, b --> q1"],
+                      ["q0", "q1",
+                       "q0 -- c, * --> q0",
+                       "q0 -- 0, a --> q1"])
+
+    def test_subsumed(self):
+        self._do_test(["q0", "q1",
+                       "q0 -- c, * --> q0",
+                       "q0 -- c, a.c --> q2",
+                       "q0 -- c, a --> q2",
+                       "q0 -- c, b --> q2",
+                       "q2 -- 0, a --> q1"],
+                      ["q0", "q1",
+                       "q0 -- c, * --> q0",
+                       "q0 -- c, a --> q2",
+                       "q0 -- c, b --> q2",
+                       "q2 -- 0, a --> q1"])
+
+    def test_merge_loops(self):
+        self._do_test(["q0", "q1",
+                       "q0 -- c, a --> q2",
+                       "q0 -- c, a --> q3",
+                       "q2 -- s, * --> q2",
+                       "q2 -- n, * --> q4",
+                       "q3 -- s, * --> q3",
+                       "q3 -- n, * --> q4",
+                       "q4 -- 0, b --> q1"],
+                      ["q0", "q1",
+                       "q0 -- c, a --> q2",
+                       "q2 -- s, * --> q2",
+                       "q2 -- n, * --> q3",
+                       "q3 -- 0, b --> q1"])
+
+    def test_merge_accepts(self):
+        aut = cssautomaton.fromstring("a > b")
+        saut = cssautomaton.simplify(aut)
+        tree = etree.fromstring("<a><c/><b id='m'/></a>")
+        m = CSSSelector("#m")(tree).pop()
+        self.assertEqual(saut.accepts(m), aut.accepts(m))
+
+
 class TestEmptinessSelNormalisation(unittest.TestCase):
 
     def _do_test(self, sel, nsel):
@@ -419,6 +638,13 @@ class TestEmptinessSelNormalisation(unittest.TestCase):
 
         self.assertEqual(str(ncss), str(exp))
 
+        # the memoized version, the second call is a hit
+        autemptiness.reset_normalisation_memo()
+        for _ in xrange(2):
+            ncss = autemptiness._normalise_node_selector(css)
+            self.assertEqual(str(ncss), str(exp))
+        self.assertEqual(autemptiness.normalisation_memo_stats()["hits"], 1)
+
     def test_simple_cls(self):
         self._do_test("*.c", "*")
 
@@ -584,6 +810,198 @@ class TestNodeSelectorEmptiness(unittest.TestCase):
 
 
 
+class TestPosCons(unittest.TestCase):
+
+    def _do_test(self, nths, links, result):
+        """
+        :param nths:
+            List of (node, from_last, a, b, negated) as for poscons.satisfiable
+        :param links:
+            List of (node1, node2, d, at_least) as for poscons.satisfiable
+        :param result:
+            The expected result of poscons.satisfiable
+        """
+        self.assertEqual(poscons.satisfiable(nths, links), result)
+
+    def test_single(self):
+        self._do_test([("x", False, 2, 1, False)], [], True)
+
+    def test_conflict(self):
+        self._do_test([("x", False, 3, 0, False), ("x", False, 6, 1, False)],
+                      [],
+                      False)
+
+    def test_negated(self):
+        self._do_test([("x", False, 4, 0, False), ("x", False, 2, 0, True)],
+                      [],
+                      False)
+
+    def test_decreasing(self):
+        # :nth-child(-n+3):not(:nth-child(-n+2))
+        self._do_test([("x", False, -1, 3, False), ("x", False, -1, 2, True)],
+                      [],
+                      True)
+
+    def test_neighbours(self):
+        # :first-child + :nth-child(2n+1)
+        self._do_test([("x", False, 0, 1, False), ("y", False, 2, 1, False)],
+                      [("x", "y", 1, False)],
+                      False)
+        self._do_test([("x", False, 0, 1, False), ("y", False, 2, 0, False)],
+                      [("x", "y", 1, False)],
+                      True)
+
+    def test_siblings(self):
+        # :first-child ~ :nth-child(-n+1)
+        self._do_test([("x", False, 0, 1, False), ("y", False, -1, 1, False)],
+                      [("x", "y", 1, True)],
+                      False)
+        self._do_test([("x", False, 0, 1, False), ("y", False, 5, 0, False)],
+                      [("x", "y", 1, True)],
+                      True)
+
+    def test_from_last(self):
+        # :last-child + *
+        self._do_test([("x", True, 0, 1, False)], [("x", "y", 1, False)], False)
+        # :first-child:last-child:nth-child(2)
+        self._do_test([("x", False, 0, 1, False),
+                       ("x", True, 0, 1, False),
+                       ("x", False, 0, 2, False)],
+                      [],
+                      False)
+        # :nth-child(2n):nth-last-child(2n) + :nth-last-child(2n)
+        self._do_test([("x", False, 2, 0, False),
+                       ("x", True, 2, 0, False),
+                       ("y", True, 2, 0, False)],
+                      [("x", "y", 1, False)],
+                      False)
+        self._do_test([("x", False, 2, 0, False),
+                       ("x", True, 2, 0, False),
+                       ("y", True, 2, 1, False)],
+                      [("x", "y", 1, False)],
+                      True)
+
+    def test_inconsistent_links(self):
+        self._do_test([], [("x", "y", 1, False), ("y", "x", 1, False)], False)
+
+    def test_undecided(self):
+        # not a row
+        self._do_test([("x", False, 2, 0, False)],
+                      [("x", "y", 1, True), ("y", "x", 1, True)],
+                      None)
+        # two rows and a from_last constraint
+        self._do_test([("x", True, 2, 0, False), ("y", False, 2, 0, False)],
+                      [],
+                      None)
+        # too big a search
+        self._do_test([("x", False, 1000, 0, False), ("y", False, 999, 0, False)],
+                      [("x", "y", 1, True)],
+                      None)
+
+    def test_checker(self):
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            aut = cssautomaton.fromstring("a:first-child + b:nth-child(2n+1)")
+            self.assertTrue(autemptiness.isempty(aut))
+        self.assertTrue(profile.counts["native_pos_checks"] > 0)
+        self.assertEqual(profile.counts["z3_checks"], 0)
+
+    def test_memo(self):
+        # the second checker asks the same of-type queries as the first,
+        # with new variables
+        autemptiness.reset_positions_memo()
+        css = "e:nth-of-type(2n) + f:first-of-type ~ g:nth-last-of-type(3)"
+        first = buildprofile.BuildProfile()
+        with buildprofile.profiling(first):
+            self.assertFalse(autemptiness.isempty(cssautomaton.fromstring(css)))
+        second = buildprofile.BuildProfile()
+        with buildprofile.profiling(second):
+            self.assertFalse(autemptiness.isempty(cssautomaton.fromstring(css)))
+        self.assertTrue(first.counts["z3_checks"] > 0)
+        self.assertEqual(second.counts["z3_checks"], 0)
+        stats = autemptiness.positions_memo_stats()
+        self.assertEqual(stats["hits"], first.counts["z3_checks"])
+
+    def test_incremental_z3(self):
+        # the same of-type queries decided by pushing and popping and by
+        # the incremental solver, which asserts shared constraints once
+        sels = ["e:nth-of-type(2n) + f:first-of-type ~ g:nth-last-of-type(3)",
+                "e:nth-of-type(2n):nth-of-type(2n+1) ~ f",
+                "e:only-of-type + e:nth-last-of-type(2)",
+                "e:first-of-type ~ e:nth-of-type(2n+1):last-of-type"]
+        results = dict()
+        profiles = dict()
+        try:
+            for incremental in [False, True]:
+                autemptiness.incremental_z3 = incremental
+                autemptiness.reset_z3_solver()
+                profile = buildprofile.BuildProfile()
+                with buildprofile.profiling(profile):
+                    for rep in xrange(2):
+                        autemptiness.reset_positions_memo()
+                        results[incremental] = \
+                            [ autemptiness.isempty(cssautomaton.fromstring(css))
+                              for css in sels ]
+                profiles[incremental] = profile
+        finally:
+            autemptiness.incremental_z3 = False
+            autemptiness.reset_z3_solver()
+        self.assertEqual(results[True], [False, True, True, False])
+        self.assertEqual(results[False], results[True])
+        self.assertEqual(profiles[True].counts["z3_checks"],
+                         profiles[False].counts["z3_checks"])
+        self.assertTrue(profiles[True].counts["z3_assertions"] <
+                        profiles[False].counts["z3_assertions"])
+        self.assertTrue("z3" in profiles[True].timings)
+
+
+class TestSubsumption(unittest.TestCase):
+
+    def _tup(self, ids = [], targ = False, root = False, arrs = [],
+             pos_cons = [], pvs = None, pd = 0, pdstar = False):
+        return (0,
+                frozenset(ids), targ, root,
+                frozenset(arrs),
+                frozenset(pos_cons), pvs, pd, pdstar)
+
+    def test_obligations(self):
+        weak = self._tup(ids = ["i"])
+        for strong in [self._tup(ids = ["i", "j"]),
+                       self._tup(ids = ["i"], targ = True),
+                       self._tup(ids = ["i"], root = True),
+                       self._tup(ids = ["i"], arrs = [Arrow.sibling])]:
+            self.assertTrue(autemptiness._subsumes(weak, strong))
+            self.assertFalse(autemptiness._subsumes(strong, weak))
+        self.assertTrue(autemptiness._subsumes(weak, weak))
+        self.assertFalse(autemptiness._subsumes(weak, self._tup()))
+
+    def test_positions(self):
+        pvs = autemptiness.PositionVariables()
+        con = autemptiness.HashableZ3(True)
+        exact = self._tup(pos_cons = [con], pvs = pvs, pd = 1)
+        lower = self._tup(pos_cons = [con], pvs = pvs, pd = 1, pdstar = True)
+        further = self._tup(pos_cons = [con], pvs = pvs, pd = 2)
+        other = self._tup(pos_cons = [con],
+                          pvs = autemptiness.PositionVariables(),
+                          pd = 1)
+        self.assertTrue(autemptiness._subsumes(self._tup(), exact))
+        self.assertTrue(autemptiness._subsumes(lower, exact))
+        self.assertTrue(autemptiness._subsumes(lower, further))
+        self.assertFalse(autemptiness._subsumes(exact, lower))
+        self.assertFalse(autemptiness._subsumes(exact, further))
+        self.assertFalse(autemptiness._subsumes(exact, other))
+
+    def test_sibling_chain(self):
+        aut = cssautomaton.intersect(
+            cssautomaton.fromstring("a ~ b ~ c ~ d ~ e ~ f"),
+            cssautomaton.fromstring("* ~ f:first-child")
+        )
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            self.assertTrue(autemptiness.isempty(aut))
+        self.assertTrue(profile.counts["subsumed_tuples"] > 0)
+
+
 class TestEmptiness(unittest.TestCase):
 
     def _do_test(self, css, result):
@@ -752,6 +1170,28 @@ class TestIntersectionEmptiness(unittest.TestCase):
         aut2 = cssautomaton.fromstring(css2)
         aut = cssautomaton.intersect(aut1, aut2)
         self.assertEqual(autemptiness.isempty(aut), result)
+        self.assertEqual(autemptiness.isempty_intersection(aut1, aut2), result)
+
+    def test_backward_product_unreached(self):
+        aut1 = cssautomaton.fromstring("e1 > e2")
+        aut2 = cssautomaton.fromstring("e3")
+        # e2 and e3 do not meet, so nothing is reached from the final state
+        naut = autemptiness._backward_product(aut1, aut2)
+        self.assertEqual(naut.qinit, None)
+        self.assertEqual(naut.num_states(), 1)
+        self.assertEqual(naut.num_trans(), 0)
+
+    def test_backward_product_early_exit(self):
+        aut1 = cssautomaton.fromstring("e1 > e2")
+        aut2 = cssautomaton.fromstring("e1 e2")
+        self.assertEqual(autemptiness._backward_product(aut1, aut2), None)
+
+    def test_backward_product_constrained(self):
+        aut1 = cssautomaton.fromstring("e1 > e2:first-child")
+        aut2 = cssautomaton.fromstring("e1 e2")
+        naut = autemptiness._backward_product(aut1, aut2)
+        self.assertNotEqual(naut.qinit, None)
+        self.assertFalse(AutEmptinessChecker(naut).check())
 
     def test_simple_emp(self):
         self._do_test("e1", "e2", True)
@@ -780,6 +1220,368 @@ class TestIntersectionEmptiness(unittest.TestCase):
     def test_of_type_emp(self):
         self._do_test(":nth-of-type(1)", "e > a|e:first-child + a|e", True)
 
+class TestBlockingIndex(unittest.TestCase):
+
+    def _do_test(self, css1, css2, result):
+        """
+        :param css1"
+            String, CSS selector
+        :param css2:
+            String, CSS selector
+        :param result:
+            The blocking key expected to prune the pair, or None if the pair
+            should not be pruned
+        """
+        sig1 = simplecssbuilder._selector_signature(_parse_selector(css1))
+        sig2 = simplecssbuilder._selector_signature(_parse_selector(css2))
+        self.assertEqual(simplecssbuilder._signatures_conflict(sig1, sig2),
+                         result)
+
+    def test_element_conflict(self):
+        self._do_test(".c > a.d", "div.d", "element")
+
+    def test_element_nonconflict(self):
+        self._do_test("div a", ".c", None)
+
+    def test_namespace_conflict(self):
+        self._do_test("n1|a", "n2|*", "namespace")
+
+    def test_id_conflict(self):
+        self._do_test("#i1", "a#i2", "id")
+
+    def test_id_left_of_combinator(self):
+        self._do_test("#i1 > a", "#i2 > a", None)
+
+    def test_pseudo_conflict(self):
+        self._do_test("a:link", ".c:visited", "pseudo")
+
+    def test_pseudo_neg_conflict(self):
+        self._do_test("a:not(:hover)", "a:hover", "pseudo")
+
+    def test_pseudo_nonconflict(self):
+        self._do_test("a:hover", "a:focus", None)
+
+    def test_group_pairs(self):
+        css = cssfile.fromstring("""a { color: red }
+                                    div { color: blue }
+                                    #i { color: green }
+                                    n|*#j { color: red }
+                                    *:link { color: blue }
+                                    .c:visited { color: red }
+                                    :not(:hover) { color: green }
+                                    a:hover { color: blue }
+                                    *#i#j { color: green }
+                                    *.c { color: blue }""")
+        index = simplecssbuilder.BlockingIndex(css)
+        # one group of all selectors, whatever their specificity
+        selvals = [ sv
+                    for spec in css.get_specificities("color")
+                    for sv in css.get_values("color", spec) ]
+        expected = [ ((s1, v1), (s2, v2))
+                     for (i, (s1, v1)) in enumerate(selvals)
+                     for (s2, v2) in selvals[i + 1:]
+                     if v1 != v2 and index.compatible(s1, s2) ]
+        self.assertEqual(len(selvals), 10)
+        self.assertEqual(index.group_pairs(selvals), expected)
+
+class TestShortcutTiers(unittest.TestCase):
+
+    def _do_test(self, css1, css2, tier, result):
+        """
+        :param css1"
+            String, CSS selector
+        :param css2:
+            String, CSS selector
+        :param tier:
+            The name of the tier expected to decide the pair, or None if no
+            tier should decide it
+        :param result:
+            True iff the selectors overlap (checked against the automata)
+        """
+        sel1 = _parse_selector(css1)
+        sel2 = _parse_selector(css2)
+        decided = None
+        for (name, f) in simplecssbuilder._shortcut_tiers:
+            res = f(sel1, sel2)
+            if res is not None:
+                decided = name
+                self.assertEqual(res, result)
+                break
+        self.assertEqual(decided, tier)
+        self.assertEqual(simplecssbuilder._nontrivial_selectors_overlap(sel1,
+                                                                        sel2),
+                         result)
+
+    def test_compound_element(self):
+        self._do_test("e1 > a", "e2 div", "compound", False)
+
+    def test_root_parent(self):
+        self._do_test(":root", "e1 > *", "root", False)
+
+    def test_root_sibling(self):
+        self._do_test(":root", "e1 ~ *", "root", False)
+
+    def test_root_depth(self):
+        self._do_test(":root > a", "e1 > e2 > a", "root", False)
+
+    def test_root_depth_overlap(self):
+        self._do_test(":root > e1 > a", ".c > a", None, True)
+
+    def test_root_not_root(self):
+        self._do_test(":root", "a:not(:root)", "root", False)
+
+    def test_root_descendant(self):
+        self._do_test(":root a", "e1 > e2 > a", None, True)
+
+    def test_empty_ancestor(self):
+        self._do_test("e1:empty > a", "a", "empty", False)
+
+    def test_empty_not_empty(self):
+        self._do_test("e1 > a:empty", "a:not(:empty)", "empty", False)
+
+    def test_empty_sibling(self):
+        self._do_test("e1:empty + a", "a", None, True)
+
+    def test_simple_compound(self):
+        self._do_test("a.c:hover", "*#i.d", "simple_compound", True)
+
+    def test_universal_element(self):
+        self._do_test("*", "a", "simple_compound", True)
+
+    def test_class_chain(self):
+        self._do_test(".c > .d", ".e .d", "class_chain", True)
+
+    def test_merge_attributes(self):
+        self._do_test("input[type=text]:focus", "*[type=radio]",
+                      "compound_merge", False)
+
+    def test_merge_attributes_overlap(self):
+        self._do_test("input[type=text]:focus", ".c[type]",
+                      "compound_merge", True)
+
+    def test_merge_negated_class(self):
+        self._do_test("a.c:hover", "*:not(.c)", "compound_merge", False)
+
+    def test_merge_negated_element(self):
+        self._do_test("a.c", "*:not(a)", "compound_merge", False)
+
+    def test_merge_negated_element_overlap(self):
+        self._do_test("a.c", "*:not(b)", "compound_merge", True)
+
+    def test_merge_global_pseudo(self):
+        self._do_test(".c:target", ":not(:target)[x]", "compound_merge", False)
+
+    def test_merge_positional(self):
+        self._do_test("a:first-child", "a:nth-child(2)", None, False)
+
+    def test_merge_negated_universal(self):
+        # the automata over-approximate :not(*), so only check the tier
+        sel1 = _parse_selector("a:not(*)")
+        sel2 = _parse_selector("a")
+        self.assertEqual(simplecssbuilder._compound_merge_tier(sel1, sel2),
+                         False)
+
+class TestChainOverlap(unittest.TestCase):
+
+    def _do_test(self, css1, css2, result):
+        """
+        :param css1"
+            String, CSS selector
+        :param css2:
+            String, CSS selector
+        :param result:
+            True/False if the selectors overlap (checked against the
+            automata), None if outside the fragment of the chain checker
+        """
+        sel1 = _parse_selector(css1)
+        sel2 = _parse_selector(css2)
+        self.assertEqual(simplecssbuilder._chain_selectors_overlap(sel1, sel2),
+                         result)
+        if result is not None:
+            aut = cssautomaton.intersect(cssautomaton.fromselector(sel1),
+                                         cssautomaton.fromselector(sel2))
+            self.assertEqual(not autemptiness.isempty(aut), result)
+
+    def test_descendant(self):
+        self._do_test(".nav ul > li a", "div li > a", True)
+
+    def test_child_conflict(self):
+        self._do_test("ul > li > a", "ol > * > a", False)
+
+    def test_descendant_interleave(self):
+        self._do_test("ul > li > a", "ol a", True)
+
+    def test_child_lengths(self):
+        self._do_test(".a > .b > .c > d", ".e > d", True)
+
+    def test_merge_conflict(self):
+        self._do_test("b > a.c", "*:not(b) > a", False)
+
+    def test_shared_id(self):
+        # as for the automata, documents may repeat ids
+        self._do_test("#i > a", "#i b a", True)
+
+    def test_shared_target(self):
+        self._do_test(":target > a", ":target b a", False)
+
+    def test_shared_target_overlap(self):
+        self._do_test(":target a", "b:target > * > a", True)
+
+    def test_target_twice(self):
+        self._do_test(":target a", ":target > b > a", True)
+
+    def test_empty_ancestor(self):
+        self._do_test(".c a", "b:empty a", False)
+
+    def test_sibling(self):
+        self._do_test("b + a", "a", None)
+
+    def test_positional(self):
+        self._do_test("b:first-child a", "a", None)
+
+    def test_root(self):
+        self._do_test(":root > a", "b a", None)
+
+class TestSelectorTrie(unittest.TestCase):
+
+    _candidates = ["ul > li > a", "ol > li > a", "li > a", "nav li > a",
+                   "ul > li + a", "a.b", "span", "div span",
+                   "ul > li > a:first-child", "*"]
+
+    def _do_test(self, css, result, pruned):
+        """Checks overlapping_subset of css against _candidates
+
+        :param css:
+            String, CSS selector
+        :param result:
+            The set of strings of _candidates expected to overlap css
+        :param pruned:
+            The number of candidates the trie should skip
+        """
+        simplecssbuilder.reset_selectors_overlap_memo()
+        sel = _parse_selector(css)
+        candidates = map(_parse_selector, self._candidates)
+        trie = simplecssbuilder.SelectorTrie(candidates)
+        self.assertEqual(len(trie), len(candidates))
+
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            subset = simplecssbuilder.overlapping_subset(sel, trie)
+        self.assertEqual(subset, set(map(_parse_selector, result)))
+        self.assertEqual(profile.counts["trie_pruned"], pruned)
+        self.assertEqual(subset,
+                         set(c for c in candidates
+                             if simplecssbuilder.selectors_overlap(sel, c)))
+        self.assertEqual(simplecssbuilder.overlaps_any(sel, candidates),
+                         len(result) > 0)
+
+    def test_shared_suffix(self):
+        self._do_test("ul > li > a",
+                      ["ul > li > a", "li > a", "nav li > a", "a.b",
+                       "ul > li > a:first-child", "*"],
+                      # span, div span and ol > li > a, but not ul > li + a
+                      # whose li is a sibling rather than the parent
+                      3)
+
+    def test_descendant_query(self):
+        self._do_test("ol a",
+                      ["ol > li > a", "li > a", "nav li > a", "ul > li + a",
+                       "a.b", "*", "ul > li > a", "ul > li > a:first-child"],
+                      # only the rightmost compounds are aligned
+                      2)
+
+    def test_none(self):
+        self._do_test("img", ["*"], 9)
+
+    def test_trie_automaton(self):
+        # no shortcut decides these, one emptiness check on the automaton of
+        # the trie does
+        simplecssbuilder.reset_selectors_overlap_memo()
+        sel = _parse_selector("a:first-child")
+        candidates = [ _parse_selector(css)
+                       for css in ["ul > li > b + a", "ol > li > b + a",
+                                   "nav li > b ~ a", "c + b + a"] ]
+        trie = simplecssbuilder.SelectorTrie(candidates)
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            self.assertEqual(simplecssbuilder.overlapping_subset(sel, trie),
+                             set())
+            self.assertFalse(simplecssbuilder.overlaps_any(sel, trie))
+        self.assertEqual(profile.counts["trie_checks"], 1)
+        self.assertEqual(profile.counts["trie_disjoint"], 4)
+        self.assertEqual(profile.counts["nontrivial_checks"], 0)
+        for css in candidates:
+            self.assertFalse(simplecssbuilder.selectors_overlap(sel, css))
+
+    def test_trie_automaton_overlap(self):
+        simplecssbuilder.reset_selectors_overlap_memo()
+        sel = _parse_selector("a:first-child")
+        candidates = [ _parse_selector(css)
+                       for css in ["ul > li > b + a", "nav li > a",
+                                   "c + b + a"] ]
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            subset = simplecssbuilder.overlapping_subset(sel, candidates)
+        self.assertEqual(subset, set([candidates[1]]))
+        self.assertEqual(profile.counts["trie_checks"], 1)
+
+class TestJointOverlap(unittest.TestCase):
+
+    def _do_test(self, csss, result):
+        """Checks selectors_jointly_overlap against the emptiness of the
+        intersection of all the automata
+
+        :param csss:
+            List of strings, CSS selectors
+        :param result:
+            True iff the selectors should jointly overlap
+        """
+        simplecssbuilder.reset_selectors_overlap_memo()
+        sels = map(_parse_selector, csss)
+        self.assertEqual(simplecssbuilder.selectors_jointly_overlap(sels),
+                         result)
+        # memoized
+        self.assertEqual(simplecssbuilder.selectors_jointly_overlap(sels[::-1]),
+                         result)
+        aut = reduce(cssautomaton.intersect,
+                     map(cssautomaton.fromselector, sels))
+        self.assertEqual(not autemptiness.isempty(aut), result)
+
+    def test_single(self):
+        self._do_test(["a", "a"], True)
+
+    def test_pair(self):
+        self._do_test(["b > a", "c > a"], False)
+
+    def test_three(self):
+        self._do_test([".x", "div a", "b > a"], True)
+
+    def test_pairwise_conflict(self):
+        self._do_test(["a", "b", ".x"], False)
+
+    def test_joint_conflict(self):
+        # every two of these overlap
+        self._do_test([":nth-child(2n)", ":nth-child(3n)", ":nth-child(-n+5)"],
+                      False)
+
+    def test_four(self):
+        self._do_test(["ul a", "li > a", "a:first-child", "a.b"], True)
+
+    def test_shared_prefix(self):
+        simplecssbuilder.reset_selectors_overlap_memo()
+        (a, b, c, d) = map(_parse_selector, ["a.b", "a.c", "a.d", "a.e"])
+        self.assertTrue(simplecssbuilder.selectors_jointly_overlap([a, b, c]))
+        self.assertTrue((a, b) in simplecssbuilder._selectors_automata)
+        hits = simplecssbuilder._selectors_automata.stats()["hits"]
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            self.assertTrue(simplecssbuilder.selectors_jointly_overlap([d, b, a]))
+        self.assertEqual(profile.counts["joint_checks"], 1)
+        # the product for a.b and a.c was reused, the last selector is not
+        # multiplied in eagerly
+        self.assertTrue(simplecssbuilder._selectors_automata.stats()["hits"] > hits)
+        self.assertFalse((a, b, d) in simplecssbuilder._selectors_automata)
+
 class TestSimpleCSSBuilder(unittest.TestCase):
 
     def _do_test(self, css, simplecss):
@@ -826,6 +1628,31 @@ class TestSimpleCSSBuilder(unittest.TestCase):
                          4: *:target ~ div ~ a { margin: 7 }
                          1 < 4""")
 
+    def test_shared_pairs(self):
+        # the two selectors meet in the margin, color and width groups (not
+        # font-size, where the values are the same), but their overlap is
+        # decided once and gives an order edge in each group
+        css = """*.c > img ~ a { margin: 4; color: red; width: 75%;
+                                 font-size: 12pt }
+                 *:target ~ div ~ a { margin: 7; color: blue; width: 50%;
+                                      font-size: 12pt }"""
+        self._do_test(css,
+                      """1: *.c > img ~ a { margin: 4 }
+                         2: *.c > img ~ a { color: red }
+                         3: *.c > img ~ a { width: 75% }
+                         4: *.c > img ~ a { font-size: 12pt }
+                         5: *:target ~ div ~ a { margin: 7 }
+                         6: *:target ~ div ~ a { color: blue }
+                         7: *:target ~ div ~ a { width: 50% }
+                         8: *:target ~ div ~ a { font-size: 12pt }
+                         1 < 5
+                         2 < 6
+                         3 < 7""")
+        profile = simplecssbuilder.fromstring(css).profile
+        self.assertEqual(profile.counts["pairs"], 1)
+        self.assertEqual(profile.counts["nontrivial_checks"], 1)
+        self.assertEqual(profile.counts["order_edges"], 3)
+
     def test_loop(self):
         self._do_test("""*.a { margin: 0 }
                          *.b { margin: 1 }
@@ -835,6 +1662,332 @@ class TestSimpleCSSBuilder(unittest.TestCase):
                          3: *.a { margin: 0 }
                          2 < 3""")
 
+    def test_parallel(self):
+        css = """*.c > img ~ a { margin: 4; width: 75% }
+                 e1 > e2 ~ e3 e4 { margin: 3 }
+                 e1 > e5 ~ * > e6 e4 { margin: 2; width: 50% }
+                 *:target ~ div ~ a { margin: 7 }
+                 :nth-child(3n) + a { width: 25% }"""
+        serial = simplecssbuilder.fromstring(css)
+        parallel = simplecssbuilder.fromstring(css, jobs = 2)
+        self.assertEqual(set(parallel.edgeList), set(serial.edgeList))
+        self.assertEqual(set(parallel.edgeOrder), set(serial.edgeOrder))
+
+    def test_parallel_profile(self):
+        css = """*.c > img ~ a { margin: 4; width: 75% }
+                 e1 > e2 ~ e3 e4 { margin: 3 }
+                 e1 > e5 ~ * > e6 e4 { margin: 2; width: 50% }
+                 *:target ~ div ~ a { margin: 7 }
+                 :nth-child(3n) + a { width: 25% }"""
+        serial = simplecssbuilder.fromstring(css)
+        parallel = simplecssbuilder.fromstring(css, jobs = 2)
+        self.assertTrue(serial.profile.counts["nontrivial_checks"] > 0)
+        self.assertEqual(dict(parallel.profile.counts),
+                         dict(serial.profile.counts))
+        self.assertTrue("automata" in parallel.profile.timings)
+
+class TestIncrementalBuilder(unittest.TestCase):
+
+    def _do_test(self, base, extra):
+        """Tests that appending the rules of extra to a builder for base gives
+        the same simpleCSS as building base + extra from scratch.
+
+        :param base:
+            The initial css as a string
+        :param extra:
+            The css to append as a string
+        """
+        builder = simplecssbuilder.IncrementalBuilder(cssfile.fromstring(base))
+        builder.add_rules(cssfile.fromstring(extra).get_rules())
+        sim = builder.get_simple_css()
+        want = simplecssbuilder.fromstring(base + "\n" + extra)
+        self.assertEqual(set(sim.edgeList), set(want.edgeList))
+        self.assertEqual(set(sim.edgeOrder), set(want.edgeOrder))
+        self.assertEqual(sim.getTrClEdgeOrder(), want.getTrClEdgeOrder())
+
+    def test_new_rule(self):
+        self._do_test("""*.c > img ~ a { margin: 4; width: 75% }""",
+                      """*:target ~ div ~ a { margin: 7 }""")
+
+    def test_new_value(self):
+        self._do_test("""*.c { margin: 0; width: 100% }""",
+                      """*.c { margin: 4 }""")
+
+    def test_moved_rule(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { margin: 1 }""",
+                      """*.a { margin: 0 }""")
+
+    def test_several_rules(self):
+        self._do_test("""e1 > e2 ~ e3 e4 { margin: 3 }
+                         *.b { margin: 1 }""",
+                      """e1 > e5 ~ * > e6 e4 { margin: 2; width: 50% }
+                         *.a { margin: 0 }
+                         e4 { width: 10% }""")
+
+    def test_important(self):
+        self._do_test(""".a { color: red !important }""",
+                      """.b { color: blue !important }""")
+
+    def test_important_mixed(self):
+        self._do_test(""".a { color: red !important; margin: 0 }
+                         .b { margin: 1 }""",
+                      """.c, .b { color: blue !important; margin: 2 }
+                         .a { color: green }""")
+
+class TestStreamingBuilder(unittest.TestCase):
+
+    def _do_test(self, css):
+        """Tests that iterfromcssfile generates the rules and order of
+        fromcssfile, and write_stream writes the lines of its str
+
+        :param css:
+            The css as a string
+        """
+        css = cssfile.fromstring(css)
+        want = simplecssbuilder.fromcssfile(css)
+        parts = defaultdict(list)
+        for (kind, item) in simplecssbuilder.iterfromcssfile(css):
+            parts[kind].append(item)
+        self.assertEqual(len(parts["rule"]), len(want.edgeList))
+        self.assertEqual(set(parts["rule"]), set(want.edgeList))
+        self.assertEqual(set(parts["order"]), set(want.edgeOrder))
+        self.assertEqual(map(str, parts["complex"]),
+                         map(str, want.complexRules))
+
+        stream = StringIO()
+        simplecssbuilder.write_stream(css, stream)
+        self.assertEqual(sorted(stream.getvalue().split("\n")),
+                         sorted((str(want) + "\n").split("\n")))
+
+    def test_order(self):
+        self._do_test("""*.c > img ~ a { margin: 4; width: 75% }
+                         *:target ~ div ~ a { margin: 7 }
+                         a { width: 50% }""")
+
+    def test_important(self):
+        self._do_test("""*.a { margin: 0 !important }
+                         *.a { margin: 0 }
+                         *.b { margin: 1 !important }""")
+
+    def test_no_order(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { width: 1 }""")
+
+class TestRebuild(unittest.TestCase):
+
+    def _do_test(self, old, new):
+        """Tests that rebuilding from old to new gives the same simpleCSS as
+        building new from scratch.
+
+        :param old:
+            The old css as a string
+        :param new:
+            The new css as a string
+        """
+        old_css = cssfile.fromstring(old)
+        old_sim = simplecssbuilder.fromcssfile(old_css)
+        sim = simplecssbuilder.rebuild(old_css,
+                                       old_sim,
+                                       cssfile.fromstring(new))
+        want = simplecssbuilder.fromstring(new)
+        self.assertEqual(set(sim.edgeList), set(want.edgeList))
+        self.assertEqual(set(sim.edgeOrder), set(want.edgeOrder))
+
+    def test_unchanged(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { margin: 1 }""",
+                      """*.a { margin: 0 }
+                         *.b { margin: 1 }""")
+
+    def test_moved(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { margin: 1 }
+                         *.c { margin: 2 }""",
+                      """*.b { margin: 1 }
+                         *.c { margin: 2 }
+                         *.a { margin: 0 }""")
+
+    def test_changed_value(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { margin: 1 }
+                         e1 > e2 ~ e3 e4 { margin: 3 }""",
+                      """*.a { margin: 0 }
+                         *.b { margin: 2 }
+                         e1 > e2 ~ e3 e4 { margin: 3 }""")
+
+    def test_removed_duplicate(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { margin: 1 }
+                         *.a { margin: 0 }""",
+                      """*.a { margin: 0 }
+                         *.b { margin: 1 }""")
+
+    def test_important(self):
+        self._do_test("""*.a { margin: 0 }
+                         *.b { margin: 1 }""",
+                      """*.a { margin: 0 !important }
+                         *.b { margin: 1 }""")
+
+class TestOverlapCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "overlaps.db")
+
+    def tearDown(self):
+        simplecssbuilder.use_overlap_cache(None)
+        shutil.rmtree(self.dir)
+
+    def test_store_lookup(self):
+        cache = overlapcache.OverlapCache(self.filename)
+        cache.store("e1 > e2", "e3", False)
+        cache.store("e1 e2", "e2", True)
+        cache.close()
+        cache = overlapcache.OverlapCache(self.filename)
+        self.assertEqual(cache.lookup("e3", "e1 > e2"), False)
+        self.assertEqual(cache.lookup("e1 e2", "e2"), True)
+        self.assertEqual(cache.lookup("e1", "e2"), None)
+        cache.close()
+
+    def test_version(self):
+        current = overlapcache.version
+        try:
+            overlapcache.version = current - 1
+            cache = overlapcache.OverlapCache(self.filename)
+            cache.store("*:not(*) *", "* > li[x] > a:hover:empty", True)
+            cache.close()
+        finally:
+            overlapcache.version = current
+        cache = overlapcache.OverlapCache(self.filename)
+        self.assertEqual(cache.lookup("*:not(*) *", "* > li[x] > a:hover:empty"),
+                         None)
+        cache.close()
+
+    def test_build_uses_cache(self):
+        css = """e1 > e2 ~ e3 e4 { margin: 3 }
+                 e1 > e5 ~ * > e6 e4 { margin: 2 }"""
+        simplecssbuilder.use_overlap_cache(self.filename)
+        first = simplecssbuilder.fromstring(css)
+        self.assertEqual(first.profile.counts["nontrivial_checks"], 1)
+        simplecssbuilder.use_overlap_cache(self.filename)
+        second = simplecssbuilder.fromstring(css)
+        self.assertEqual(second.profile.counts["nontrivial_checks"], 0)
+        self.assertEqual(second.profile.caches["overlap_cache"]["hits"], 1)
+        self.assertEqual(set(first.edgeOrder), set(second.edgeOrder))
+
+    def test_parallel_build_uses_cache(self):
+        css = """e1 > e2 ~ e3 e4 { margin: 3 }
+                 e1 > e5 ~ * > e6 e4 { margin: 2 }"""
+        simplecssbuilder.use_overlap_cache(self.filename)
+        first = simplecssbuilder.fromstring(css, jobs = 2)
+        self.assertEqual(first.profile.counts["nontrivial_checks"], 1)
+        simplecssbuilder.use_overlap_cache(self.filename)
+        second = simplecssbuilder.fromstring(css, jobs = 2)
+        self.assertEqual(second.profile.counts["nontrivial_checks"], 0)
+        self.assertEqual(second.profile.caches["overlap_cache"]["hits"], 1)
+        self.assertEqual(set(first.edgeOrder), set(second.edgeOrder))
+
+class TestMemoCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = memocache.MemoCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), { "hits" : 3,
+                                          "misses" : 1,
+                                          "evictions" : 1,
+                                          "entries" : 2,
+                                          "size" : 2 })
+
+    def test_weighted_budget(self):
+        cache = memocache.MemoCache(5, len)
+        cache.put("a", "xx")
+        cache.put("b", "yyy")
+        cache.put("c", "z")
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.size, 4)
+        cache.put("d", "too long")
+        self.assertFalse("d" in cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_small_budget_build(self):
+        css = """e1 > e2 ~ e3 e4 { margin: 3 }
+                 e1 > e5 ~ * > e6 e4 { margin: 2 }
+                 .a e4 { margin: 1 }"""
+        expected = set(simplecssbuilder.fromstring(css).edgeOrder)
+        (overlap_budget, automata_budget) = (
+            simplecssbuilder.overlap_memo_budget,
+            simplecssbuilder.automata_memo_budget
+        )
+        try:
+            simplecssbuilder.overlap_memo_budget = 1
+            simplecssbuilder.automata_memo_budget = 1
+            bounded = simplecssbuilder.fromstring(css)
+            stats = simplecssbuilder.memo_stats()
+            self.assertTrue(stats["overlaps"]["entries"] <= 1)
+            self.assertEqual(stats["automata"]["entries"], 0)
+        finally:
+            simplecssbuilder.overlap_memo_budget = overlap_budget
+            simplecssbuilder.automata_memo_budget = automata_budget
+        self.assertEqual(set(bounded.edgeOrder), expected)
+
+class TestBuildProfile(unittest.TestCase):
+
+    def test_nested_timers(self):
+        profile = buildprofile.BuildProfile()
+        with buildprofile.profiling(profile):
+            with buildprofile.timer("outer"):
+                with buildprofile.timer("inner"):
+                    buildprofile.count("events", 2)
+        self.assertEqual(set(profile.timings), set(["outer", "inner"]))
+        self.assertEqual(profile.counts["events"], 2)
+        self.assertTrue(profile.timings["inner"] >= 0)
+        self.assertTrue(profile.timings["outer"] >= 0)
+
+    def test_merge(self):
+        worker = buildprofile.BuildProfile()
+        with buildprofile.profiling(worker):
+            with buildprofile.timer("z3"):
+                buildprofile.count("z3_checks")
+                buildprofile.cache_lookup("positions", False)
+                buildprofile.tier_result("chain", True)
+        worker = pickle.loads(pickle.dumps(worker))
+        profile = buildprofile.BuildProfile()
+        profile.count("z3_checks")
+        profile.tier_result("chain", False)
+        profile.merge(worker)
+        self.assertEqual(profile.counts["z3_checks"], 2)
+        self.assertEqual(profile.caches["positions"]["misses"], 1)
+        self.assertEqual(profile.tiers["chain"]["hits"], 1)
+        self.assertEqual(profile.tiers["chain"]["misses"], 1)
+        self.assertEqual(profile.timings["z3"], worker.timings["z3"])
+
+    def test_build_profile(self):
+        css = """e1 > e2 ~ e3 e4 { margin: 3 }
+                 e1 > e5 ~ * > e6 e4 { margin: 2 }
+                 div { margin: 1 }
+                 span { margin: 0 }"""
+        simple_css = simplecssbuilder.fromstring(css)
+        profile = json.loads(simple_css.profile.to_json())
+        self.assertEqual(profile["counts"]["pairs"], 1)
+        self.assertEqual(profile["counts"]["pruned_by_element"], 1)
+        self.assertEqual(profile["counts"]["nontrivial_checks"], 1)
+        self.assertEqual(profile["counts"]["edges"], 4)
+        # the product reaches its initial state by element transitions, so
+        # the emptiness checker is not needed
+        self.assertEqual(profile["counts"]["product_early_exits"], 1)
+        for phase in ["parse", "rule_table", "shortcut", "automata",
+                      "intersection", "normalisation", "closure"]:
+            self.assertTrue(phase in profile["timings"])
+        self.assertEqual(profile["caches"]["automata_memo"]["misses"], 2)
+        self.assertTrue("normalisation_memo" in profile["caches"])
+
 
 ################################################################
 ## Helper functions